@@ -6,7 +6,6 @@ import logging
 from enum import Enum
 from abc import ABC
 
-import numpy as np
 import torch
 from torch import nn
 
@@ -16,6 +15,7 @@ from algorithm.safe_mutations import Sensitivity
 class Mutation(Enum):
     SAFE_GRAD_SUM = 'SM-G-SUM'
     SAFE_GRAD_ABS = 'SM-G-ABS'
+    SAFE_GRAD_SKETCH = 'SM-G-SKETCH'
     SAFE_VECTOR = 'SM-VECTOR'
     SAFE_PROPORTIONAL = 'SM-PROPORTIONAL'
     DEFAULT = ''
@@ -25,6 +25,8 @@ class PolicyNet(nn.Module, ABC):
     """
         Abstract base class for all networks that are evolved. Implements initialization and
             evolve (mutate) methods.
+        All params are views on one contiguous flat buffer (in the order of self.parameters()), so
+            evolving, reverting and setting the params from a vector are in place, without allocations.
     """
 
     def __init__(self, rng_state=None, from_param_file=None, grad=False, options=None, vbn=False):
@@ -41,11 +43,20 @@ class PolicyNet(nn.Module, ABC):
         self.grad = grad
         self.vbn = vbn
 
+        # flat buffer with all params, the params before the last evolve and the last mutation
+        self._flat = None
+        self._backup = None
+        self._last_noise = None
+
         self.eval()
 
         self.mutations = Mutation((options and options.safe_mutations) or '')
         if self.mutations != Mutation.DEFAULT:
-            self.sensitivity_wrapper = Sensitivity(self, options.safe_mutation_underflow, self.mutations)
+            self.sensitivity_wrapper = Sensitivity(self, options.safe_mutation_underflow, self.mutations,
+                                                   options.safe_mutation_sketch_size,
+                                                   options.safe_mutation_reuse_every,
+                                                   options.safe_mutation_reuse_drift,
+                                                   options.safe_mutation_reuse_capacity)
             if self.mutations == Mutation.SAFE_VECTOR:
                 self.set_sensitivity_vector(options.safe_mutation_vector)
 
@@ -72,6 +83,7 @@ class PolicyNet(nn.Module, ABC):
 
         self.nb_learnable_params = sum(p.numel() for p in self.parameters() if p.requires_grad)
         self.nb_params = self.count_parameters()
+        self._flatten()
 
         # logging.info('Number of learnable params: {}'.format(self.nb_learnable_params))
 
@@ -80,46 +92,78 @@ class PolicyNet(nn.Module, ABC):
             for param in self.parameters():
                 param.requires_grad = False
 
-    def evolve(self, sigma, rng_state=None):
+    def evolve(self, sigma, rng_state=None, eps=None):
         """
         Evolve (mutate) the current params one step. Can either be (depending on mutation type
             set in self.mutations): standard mutation, proportional mutation, safe mutation by
             output grad sensitivity, or by a precalculated vector of sensitivities.
         :param  sigma: mutation power
-        :param  rng_state: optionally provide a random seed
+        :param  rng_state: optionally provide a random seed, the same seed and params always give the same
+                           mutation (used by seed chains)
+        :param  eps: optionally provide the standard normal noise to use (e.g. a slice of a noise table)
         :return delta: the mutation vector
         """
-        # rng = rng_state if rng_state is not None else random_state()
-        # torch.manual_seed(rng)
+        param_vector = self._flat
+
+        if eps is not None:
+            assert len(eps) == len(param_vector)
+            noise = torch.tensor(eps, dtype=param_vector.dtype).mul_(sigma)
+        else:
+            generator = None
+            if rng_state is not None:
+                generator = torch.Generator()
+                generator.manual_seed(int(rng_state))
+            noise = torch.empty_like(param_vector, requires_grad=False).normal_(mean=0.0, std=sigma,
+                                                                                generator=generator)
+        noise = self.scale_mutation(noise)
 
-        safe, proportional = False, False
-        if self.mutations in [Mutation.SAFE_GRAD_SUM, Mutation.SAFE_GRAD_ABS, Mutation.SAFE_VECTOR]:
-            safe = True
-        elif self.mutations == Mutation.SAFE_PROPORTIONAL:
-            proportional = True
+        for param in self.parameters():
+            param.requires_grad = False
 
-        param_vector = nn.utils.parameters_to_vector(self.parameters())
-        noise = torch.empty_like(param_vector, requires_grad=False).normal_(mean=0.0, std=sigma)
+        # keep the params before the mutation, so revert and mirror are exact
+        if self._backup is None:
+            self._backup = torch.empty_like(self._flat)
+        self._backup.copy_(self._flat)
+        self._last_noise = noise
+        self._flat.add_(noise)
 
-        if safe:
-            noise /= self.sensitivity_wrapper.get_sensitivity()
-            # logging.info('new noise: %s', noise)
-        if proportional:
-            params = torch.empty_like(param_vector).copy_(param_vector)
-            mean = params.abs().mean()
-            params[params == 0.0] = mean
-            noise *= params.abs()
+        # noise is not used by the net anymore, so its memory can be shared with the numpy array
+        return noise.numpy()
 
-        new_param_vector = param_vector + noise
-        self.set_from_vector(new_param_vector)
+    def revert(self):
+        """
+        Set the params back to what they were before the last evolve
+        """
+        assert self._last_noise is not None, 'evolve first!'
+        self._flat.copy_(self._backup)
 
-        for param in self.parameters():
-            param.requires_grad = False
+    def mirror(self):
+        """
+        Set the params to theta - delta, with theta the params before the last evolve and delta its mutation
+            (mirrored sampling)
+        """
+        assert self._last_noise is not None, 'evolve first!'
+        torch.sub(self._backup, self._last_noise, out=self._flat)
 
-        return torch.empty_like(noise).copy_(noise).numpy().astype(np.float32)
+    def scale_mutation(self, noise):
+        """
+        Scale a mutation vector according to the mutation type: divide by the sensitivities for safe
+            mutations, multiply by the magnitude of the params for proportional mutations.
+            This is linear and elementwise, so it can also be applied to a weighted sum of noise vectors.
+        :param noise: torch tensor with dim(theta) elements, scaled in place
+        """
+        if self.mutations in [Mutation.SAFE_GRAD_SUM, Mutation.SAFE_GRAD_ABS, Mutation.SAFE_GRAD_SKETCH,
+                              Mutation.SAFE_VECTOR]:
+            noise /= self.sensitivity_wrapper.get_sensitivity()
+            # logging.info('new noise: %s', noise)
+        elif self.mutations == Mutation.SAFE_PROPORTIONAL:
+            params = self._flat.abs()
+            params[params == 0.0] = params.mean()
+            noise *= params
+        return noise
 
     def calc_sensitivity(self, task_id, parent_id, experiences, batch_size, directory):
-        if self.mutations in [Mutation.SAFE_GRAD_SUM, Mutation.SAFE_GRAD_ABS]:
+        if self.mutations in [Mutation.SAFE_GRAD_SUM, Mutation.SAFE_GRAD_ABS, Mutation.SAFE_GRAD_SKETCH]:
             self.sensitivity_wrapper.calc_sensitivity(task_id, parent_id, experiences, batch_size, directory)
 
     def set_sensitivity_vector(self, vector):
@@ -162,10 +206,42 @@ class PolicyNet(nn.Module, ABC):
 
     def set_from_vector(self, vector):
         assert len(vector) == self.nb_learnable_params
-        nn.utils.vector_to_parameters(vector, self.parameters())
+        self._flat.copy_(vector)
 
     def parameter_vector(self):
-        return nn.utils.parameters_to_vector(self.parameters())
+        """
+        :return: the flat buffer the params are views on, copy it to keep the current params
+        """
+        return self._flat
+
+    def _flatten(self):
+        """
+        Move the params into one new contiguous buffer and make them views on it
+        """
+        params = list(self.parameters())
+        self._flat = torch.empty(sum(p.numel() for p in params), dtype=params[0].dtype, device=params[0].device)
+        self._backup, self._last_noise = None, None
+        offset = 0
+        for param in params:
+            n = param.numel()
+            self._flat[offset:offset + n].copy_(param.data.view(-1))
+            param.data = self._flat[offset:offset + n].view_as(param)
+            offset += n
+
+    def _is_flat(self):
+        offset = 0
+        for param in self.parameters():
+            if param.data_ptr() != self._flat[offset:].data_ptr():
+                return False
+            offset += param.numel()
+        return True
+
+    def _apply(self, fn):
+        # moving the net to another device or dtype replaces the params, put them in a new buffer again
+        super(PolicyNet, self)._apply(fn)
+        if self._flat is not None and not self._is_flat():
+            self._flatten()
+        return self
 
     def forward_for_sensitivity(self, x, orig_bs=0, i=-1):
         raise NotImplementedError
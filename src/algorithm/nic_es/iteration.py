@@ -3,7 +3,8 @@ import os
 
 from algorithm.policies import Policy
 from algorithm.tools.iteration import Iteration
-from algorithm.tools.utils import Config, copy_file_from_to, remove_file_if_exists, remove_all_files_but
+from algorithm.tools.seed_chain import SeedChain
+from algorithm.tools.utils import Config, copy_file_from_to, remove_file_if_exists, remove_all_files_but, mkdir_p
 
 
 class ESIteration(Iteration):
@@ -11,6 +12,7 @@ class ESIteration(Iteration):
     Subclass for NIC-ES iteration
         Parents are kept together with offspring in offspring dir: models/offspring
         elite are kept in models/elite
+        With seed chains, parents are SeedChains whose anchors are kept in models/anchors
     """
 
     def __init__(self, config: Config, exp: dict):
@@ -21,6 +23,13 @@ class ESIteration(Iteration):
         self._new_elite_path = os.path.join(self._elite_dir, '0_{i}_elite_params.pth')
         self._new_parent_path = os.path.join(self._offspring_dir, '0_{i}_parent_params.pth')
 
+        self._seed_chain = bool(config.seed_chain)
+        self._seed_chain_max_length = config.seed_chain_max_length if config.seed_chain_max_length else 10
+        self._anchors_dir = os.path.join(self._models_dir, 'anchors')
+        self._new_anchor_path = os.path.join(self._anchors_dir, '{it}_{i}_anchor_params.pth')
+        if self._seed_chain:
+            mkdir_p(self._anchors_dir)
+
         self._pop_size = exp['population_size'] if 'population_size' in exp else self._nb_offspring
         self._num_elite_cands = exp['num_elite_cands']
 
@@ -43,6 +52,18 @@ class ESIteration(Iteration):
         self._elites_to_evaluate = [(i, self._new_elite_path.format(i=i))
                                     for i, _ in enumerate(infos['elites_to_evaluate'])]
 
+        if self._seed_chain:
+            self._parents = []
+            for (i, parent) in infos['parents']:
+                # seed chains are stored as lists in the json
+                chain = SeedChain.from_infos(parent) if isinstance(parent, list) else SeedChain.of(parent)
+                if chain.anchor is not None:
+                    anchor_path = self._new_anchor_path.format(it=self._iteration, i=i)
+                    copy_file_from_to(chain.anchor, anchor_path)
+                    chain = chain._replace(anchor=anchor_path)
+                self._parents.append((i, chain))
+            return
+
         for (i, parent_path) in infos['parents']:
             copy_file_from_to(parent_path, self._new_parent_path.format(i=i))
         self._parents = [(i, self._new_parent_path.format(i=i)) for i, _ in enumerate(infos['parents'])]
@@ -80,13 +101,38 @@ class ESIteration(Iteration):
 
         self._elites_to_evaluate = self._elites_to_evaluate[:self._num_elite_cands]
 
-    def record_parents(self, parents: list):
+    def record_parents(self, parents: list, policy: Policy):
         new_parents = [(i, p) for i, p in enumerate(parents)]
-        self._parents = self._copy_and_clean_parents(new_parents)
-        self._add_elites_to_parents()
+        if self._seed_chain:
+            self._parents = new_parents
+            self._add_elites_to_parents()
+            self._parents = self._anchor_and_clean_parents(self._parents, policy)
+        else:
+            self._parents = self._copy_and_clean_parents(new_parents)
+            self._add_elites_to_parents()
         self._clean_offspring_dir()
         return None
 
+    def record_population(self, population):
+        """
+        Steady-state mode: the parents are the best elites so far and the current population, offspring that
+            drop out of the population are removed by the master
+        :param population: SteadyStatePopulation
+        """
+        self._parents = [(i, p) for i, p in enumerate(population.models())]
+        self._add_elites_to_parents()
+
+    def clean_orphaned_offspring(self, before):
+        """
+        Steady-state mode: remove offspring files that are older than time before and not in the population,
+            their results were dropped as stale so they will never be inserted
+        """
+        parents = [parent for _, parent in self._parents]
+        for file in os.listdir(self._offspring_dir):
+            path = os.path.join(self._offspring_dir, file)
+            if path not in parents and os.path.getmtime(path) < before:
+                remove_file_if_exists(path)
+
     def _add_elites_to_parents(self):
         elites = [e for (e, sc) in self.best_elites()]
         parents = [p for (i, p) in self._parents]
@@ -109,11 +155,35 @@ class ESIteration(Iteration):
 
         return copy.deepcopy(new_parents)
 
-    def set_next_elites_to_evaluate(self, best_individuals):
+    def _anchor_and_clean_parents(self, parents: list, policy: Policy):
+        """
+        Make sure every parent is a SeedChain with its anchor in the anchors dir. Parents that are files
+            (elites, initial parents) are copied to a new anchor, chains that got too long are re-anchored
+            (their params are written to a new anchor) to keep rebuilding them by the workers cheap.
+        :param parents: List<Tuple<int, str | SeedChain>>
+        :return: List<Tuple<int, SeedChain>>
+        """
+        new_parents = []
+        for i, parent in parents:
+            chain = SeedChain.of(parent)
+            anchor_path = self._new_anchor_path.format(it=self._iteration, i=i)
+
+            if chain.length() >= self._seed_chain_max_length:
+                chain = SeedChain(anchor=policy.serialize_seed_chain(chain, anchor_path))
+            elif chain.anchor is not None and os.path.dirname(chain.anchor) != self._anchors_dir:
+                copy_file_from_to(chain.anchor, anchor_path)
+                chain = chain._replace(anchor=anchor_path)
+            new_parents.append((i, chain))
+
+        # remove anchors that are no longer used by any parent
+        remove_all_files_but(self._anchors_dir, [chain.anchor for _, chain in new_parents])
+        return new_parents
+
+    def set_next_elites_to_evaluate(self, best_individuals, policy: Policy):
         elites_to_evaluate = [(i, ind) for i, ind in enumerate(best_individuals)]
-        self._elites_to_evaluate = self._copy_and_clean_elites(elites_to_evaluate)
+        self._elites_to_evaluate = self._copy_and_clean_elites(elites_to_evaluate, policy)
 
-    def _copy_and_clean_elites(self, elites):
+    def _copy_and_clean_elites(self, elites, policy: Policy):
         # copy new elite cands from offspring dir to elite dir and rename them
         new_elites_to_ev = []
         new_elite_filenames = []
@@ -122,7 +192,11 @@ class ESIteration(Iteration):
             new_elite_path = self._new_elite_path.format(i=i)
             new_elites_to_ev.append((i, new_elite_path))
             new_elite_filenames.append(new_elite_path)
-            copy_file_from_to(elite, new_elite_path)
+            if isinstance(elite, SeedChain):
+                # elites are evaluated on the validation set by loading their params from file
+                policy.serialize_seed_chain(elite, new_elite_path)
+            else:
+                copy_file_from_to(elite, new_elite_path)
 
         # remove previous elite
         remove_all_files_but(self.elite_dir(), new_elite_filenames)
@@ -140,6 +214,15 @@ class ESIteration(Iteration):
         evaluated = set(self._eval_results.keys())
         return len(evaluated) < len(self._elites_to_evaluate)
 
+    def eval_indices_left(self):
+        """
+        :return: the indices in elites_to_evaluate of the candidates that weren't evaluated yet
+        """
+        return [i for i, (cand_id, _) in enumerate(self._elites_to_evaluate) if cand_id not in self._eval_results]
+
+    def nb_evals_left(self):
+        return len(self.eval_indices_left())
+
     def _clean_offspring_dir(self):
         remove_all_files_but(self._offspring_dir,
                              [parent for _, parent in self._parents])
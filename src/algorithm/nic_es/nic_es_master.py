@@ -7,6 +7,7 @@ import copy
 import gc
 import logging
 import os
+import time
 from collections import namedtuple
 
 import psutil
@@ -15,13 +16,16 @@ import numpy as np
 import torch
 # from memory_profiler import profile
 
-from dist import MasterClient
+from dist import MasterClient, MasterTransport
 from algorithm.nic_es.experiment import ESExperiment
 from algorithm.nic_es.iteration import ESIteration
+from algorithm.nic_es.population import SteadyStatePopulation
+from algorithm.nets import Mutation
 from algorithm.policies import Policy
 from algorithm.tools.setup import setup_master, Config
 from algorithm.tools.snapshot import save_snapshot
 from algorithm.tools.statistics import Statistics
+from algorithm.tools.utils import remove_file_if_exists
 
 
 result_fields = ['worker_id', 'evaluated_model_id', 'fitness', 'evaluated_model',
@@ -30,13 +34,13 @@ result_fields = ['worker_id', 'evaluated_model_id', 'fitness', 'evaluated_model'
 ESResult = namedtuple('ESResult', field_names=result_fields, defaults=(None,) * len(result_fields))
 
 es_task_fields = ['elite', 'population', 'batch_data', 'parents', 'noise_stdev',
-                  'log_dir', 'elites', 'ref_batch']
+                  'log_dir', 'elites', 'ref_batch', 'batch_indices']
 ESTask = namedtuple('ESTask', field_names=es_task_fields, defaults=(None,) * len(es_task_fields))
 
 
 class ESMaster(object):
 
-    def __init__(self, exp, master_redis_cfg):
+    def __init__(self, exp, master_redis_cfg=None, master_client=None):
         setup_tuple = setup_master(exp)
         self.config: Config = setup_tuple[0]
         self.policy: Policy = setup_tuple[1]
@@ -44,8 +48,19 @@ class ESMaster(object):
         self.it: ESIteration = setup_tuple[3]
         self.experiment: ESExperiment = setup_tuple[4]
 
-        # redis master
-        self.master = MasterClient(master_redis_cfg)
+        if self.config.seed_chain:
+            # safe mutations by gradient use a sensitivity computed on the batch of one task,
+            # so they can't be replayed from a seed chain
+            assert self.policy.get_model().mutations not in (Mutation.SAFE_GRAD_SUM, Mutation.SAFE_GRAD_ABS,
+                                                             Mutation.SAFE_GRAD_SKETCH), \
+                'Seed chains are not supported with safe mutations by gradient'
+
+        if self.config.steady_state:
+            # the population keeps offspring files and evicts them one by one, chains have no file to evict
+            assert not self.config.seed_chain, 'Seed chains are not supported in steady-state mode'
+
+        # redis master, unless another transport is given
+        self.master: MasterTransport = master_client or MasterClient(master_redis_cfg)
         # this puts up a redis key, value pair with the experiment
         self.master.declare_experiment(exp)
 
@@ -55,6 +70,9 @@ class ESMaster(object):
     def run_master(self, plot):
         logging.info('run_master: {}'.format(locals()))
 
+        if self.config.steady_state:
+            return self.run_steady_state_master(plot)
+
         config, experiment, rs, master, policy, stats, it = \
             self.config, self.experiment, self.rs, self.master, self.policy, self.stats, self.it
 
@@ -72,76 +90,189 @@ class ESMaster(object):
 
                     # publish task
                     data = copy.deepcopy(batch_data)
-                    curr_task_id = master.declare_task(ESTask(
-                        elites=it.elites_to_evaluate(),
-                        parents=it.parents(),
-                        batch_data=data,
-                        noise_stdev=it.get_noise_stdev(),
-                        ref_batch=experiment.get_ref_batch(),
-                    ))
+                    curr_task_id = self.declare_task(data, nb_evolve=it.nb_models_left_to_evolve())
 
                     logging.info('********** Iteration {} **********'.format(it.iteration()))
                     logging.info('Searching {nb} params for NW'.format(nb=policy.nb_learnable_params()))
 
                     stats.reset_it_mem_usages()
+                    stats.reset_it_results()
 
-                    while it.models_left_to_evolve() or it.models_left_to_eval():
+                    while it.generation_open():
 
                         # this is just for logging
                         it.warn_waiting_for_evaluations()
 
-                        # wait for a result
-                        task_id, result = master.pop_result()
-                        assert isinstance(task_id, int) and isinstance(result, ESResult)
+                        # wait for a batch of results
+                        results = master.pop_results(max_n=config.result_batch_size or 100,
+                                                     timeout=it.pop_timeout(config.token_timeout or 60))
+                        stats.record_it_results(len(results))
+                        if not results:
+                            if not it.generation_open():
+                                # the deadline passed
+                                continue
+                            # tokens of the missing results were probably claimed by workers that died
+                            logging.warning('No results for a while, reissuing tokens')
+                            master.issue_tokens(curr_task_id, it.nb_models_left_to_evolve(), it.eval_indices_left())
+                            continue
 
                         # https://psutil.readthedocs.io/en/latest/#memory
                         master_mem_usage = psutil.Process(os.getpid()).memory_info().rss
                         stats.record_it_master_mem_usage(master_mem_usage)
-                        stats.record_it_worker_mem_usage(result.worker_id, result.mem_usage)
 
-                        it.record_worker_id(result.worker_id)
+                        evolve_results = []
+                        for task_id, result in results:
+                            assert isinstance(task_id, int) and isinstance(result, ESResult)
+                            stats.record_it_worker_mem_usage(result.worker_id, result.mem_usage)
+                            it.record_worker_id(result.worker_id)
 
-                        if result.evaluated_cand_id is not None:
-                            # this was an eval job, store the result only for current tasks
-                            if task_id == curr_task_id:
-                                it.record_eval_result(result)
+                            if result.evaluated_cand_id is not None:
+                                # this was an eval job, store the result only for current tasks
+                                if task_id == curr_task_id:
+                                    it.record_eval_result(result)
 
-                        elif result.evaluated_model_id is not None:
-                            # this was an evolve job, store results only for current tasks
-                            if task_id == curr_task_id:
-                                it.record_task_result(result)
-                                if rs.rand() < config.eval_prob:
-                                    logging.info('Incoming result: %.2f' % result.fitness.item())
+                            elif result.evaluated_model_id is not None:
+                                # this was an evolve job, store results only for current tasks
+                                if task_id == curr_task_id:
+                                    evolve_results.append(result)
+                                    if rs.rand() < config.eval_prob:
+                                        logging.info('Incoming result: %.2f' % result.fitness.item())
+
+                        stats.record_it_overproduced(it.record_task_results(evolve_results))
+
+                    # with a quorum or deadline, results that didn't come in yet are dropped
+                    stats.record_dropped_stats(it.nb_models_left_to_evolve(), it.nb_evals_left())
 
                     best_ev_acc, best_ev_elite = it.process_evaluated_elites()
-                    policy.set_model(best_ev_elite)
+                    if best_ev_elite is not None:
+                        policy.set_model(best_ev_elite)
 
                     parents, scores = self.selection(it.task_results(), experiment.population_size(),
                                                      experiment.num_elites())
 
                     best_individuals = parents[:experiment.num_elite_cands()]
-                    it.set_next_elites_to_evaluate(best_individuals)
+                    it.set_next_elites_to_evaluate(best_individuals, policy)
 
-                    it.record_parents(parents)
+                    it.record_parents(parents, policy)
                     if it.patience_reached() or it.schedule_reached():
                         experiment.increase_loader_batch_size(it.batch_size())
 
-                    stats.record_score_stats(scores)
-                    stats.record_bs_stats(it.batch_size())
-                    stats.record_step_time_stats()
-                    stats.record_norm_stats(policy.parameter_vector())
-                    stats.record_acc_stats(best_ev_acc)
-                    stats.record_best_acc_stats(it.best_elites()[0][1])
-                    stats.record_std_stats(it.noise_stdev())
-                    stats.update_mem_stats()
+                    self.record_generation(scores, best_ev_acc, plot)
+
+                    if it.patience_reached() or it.schedule_reached():
+                        # to use new trainloader!
+                        break
+
+        except KeyboardInterrupt:
+            save_snapshot(stats, it, experiment)
+            if plot:
+                stats.plot_stats(experiment.snapshot_dir())
+
+    def run_steady_state_master(self, plot):
+        """
+        Steady-state NIC-ES: no barrier between generations. Every incoming offspring is inserted in a
+            bounded population sorted by fitness, and every steady_state_publish_every results the task is
+            republished with the current population as parents. A generation is still counted every nb_offspring
+            results, for the elite evaluations, statistics and snapshots, but workers don't wait for it.
+        """
+        config, experiment, master, policy, stats, it = \
+            self.config, self.experiment, self.master, self.policy, self.stats, self.it
+
+        torch.set_grad_enabled(False)
+        torch.set_num_threads(0)
 
-                    stats.log_stats()
-                    it.log_stats()
+        population = SteadyStatePopulation(experiment.population_size() - experiment.num_elites())
+        publish_every = config.steady_state_publish_every or max(experiment.nb_offspring() // 10, 1)
+        # results computed on parents of one of the tasks of the last 2 generations are still useful
+        master.set_max_staleness(2 * -(-experiment.nb_offspring() // publish_every))
+        prev_gen_tstart = time.time()
+        # offspring that dropped out of the population while they were parents of the published task
+        evicted_parents = []
 
-                    if config.snapshot_freq != 0 and it.iteration() % config.snapshot_freq == 0:
-                        save_snapshot(stats, it, experiment)
-                        if plot:
-                            stats.plot_stats(experiment.snapshot_dir())
+        try:
+            while not config.max_nb_iterations or it.iteration() < config.max_nb_iterations:
+                it.incr_epoch()
+
+                for batch_data in experiment.get_trainloader():
+                    gc.collect()
+                    it.incr_iteration()
+                    stats.set_step_tstart()
+                    gen_tstart = time.time()
+
+                    # the batch stays the same during a generation, only the parents are republished
+                    data = copy.deepcopy(batch_data)
+                    gen_task_id = curr_task_id = self.declare_task(data, nb_evolve=experiment.nb_offspring())
+                    published_parents, evicted_parents = self.remove_evicted_parents(evicted_parents)
+                    nb_since_publish = 0
+
+                    logging.info('********** Iteration {} **********'.format(it.iteration()))
+
+                    stats.reset_it_mem_usages()
+                    stats.reset_it_results()
+
+                    while it.models_left_to_evolve():
+                        results = master.pop_results(max_n=config.result_batch_size or 100,
+                                                     timeout=config.token_timeout or 60)
+                        stats.record_it_results(len(results))
+                        if not results:
+                            logging.warning('No results for a while, reissuing tokens')
+                            master.issue_tokens(curr_task_id, it.nb_models_left_to_evolve(), it.eval_indices_left())
+                            continue
+
+                        master_mem_usage = psutil.Process(os.getpid()).memory_info().rss
+                        stats.record_it_master_mem_usage(master_mem_usage)
+
+                        evolve_results = []
+                        for task_id, result in results:
+                            assert isinstance(task_id, int) and isinstance(result, ESResult)
+                            stats.record_it_worker_mem_usage(result.worker_id, result.mem_usage)
+                            it.record_worker_id(result.worker_id)
+
+                            if result.evaluated_cand_id is not None:
+                                # elite files are reused every generation, only evals of this one are valid
+                                if task_id >= gen_task_id:
+                                    it.record_eval_result(result)
+                            elif result.evaluated_model_id is not None:
+                                evolve_results.append(result)
+
+                        # results that come in after the generation is complete still go in the population
+                        stats.record_it_overproduced(it.record_task_results(evolve_results))
+                        for result in evolve_results:
+                            evicted = population.insert(result.evaluated_model_id, result.evaluated_model,
+                                                        result.fitness.item())
+                            # workers may still load the parents of the published task
+                            if evicted in published_parents:
+                                evicted_parents.append(evicted)
+                            elif evicted is not None:
+                                remove_file_if_exists(evicted)
+
+                        # until the population is full, keep evolving the initial parents
+                        nb_since_publish += len(evolve_results)
+                        # the next generation publishes its own task
+                        if nb_since_publish >= publish_every and len(population) == population.capacity() \
+                                and it.models_left_to_evolve():
+                            it.record_population(population)
+                            # the tokens of the previous task are abandoned, only issue the ones still needed
+                            curr_task_id = self.declare_task(data, nb_evolve=it.nb_models_left_to_evolve())
+                            published_parents, evicted_parents = self.remove_evicted_parents(evicted_parents)
+                            nb_since_publish = 0
+
+                    # evaluations that didn't come in yet are skipped
+                    best_ev_acc, best_ev_elite = it.process_evaluated_elites()
+                    if best_ev_elite is not None:
+                        policy.set_model(best_ev_elite)
+
+                    it.set_next_elites_to_evaluate(population.best(experiment.num_elite_cands()), policy)
+                    if len(population) > 0:
+                        it.record_population(population)
+                    it.clean_orphaned_offspring(before=prev_gen_tstart)
+                    prev_gen_tstart = gen_tstart
+
+                    if it.patience_reached() or it.schedule_reached():
+                        experiment.increase_loader_batch_size(it.batch_size())
+
+                    scores = np.sort([result.fitness.item() for result in it.task_results()])[::-1]
+                    self.record_generation(scores, best_ev_acc, plot)
 
                     if it.patience_reached() or it.schedule_reached():
                         # to use new trainloader!
@@ -152,6 +283,56 @@ class ESMaster(object):
             if plot:
                 stats.plot_stats(experiment.snapshot_dir())
 
+    def declare_task(self, data, nb_evolve):
+        config, experiment, it = self.config, self.experiment, self.it
+        return self.master.declare_task(ESTask(
+            elites=it.elites_to_evaluate(),
+            parents=it.parents(),
+            batch_data=None if config.publish_batch_indices else data,
+            batch_indices=experiment.to_batch_indices(data) if config.publish_batch_indices else None,
+            noise_stdev=it.get_noise_stdev(),
+            ref_batch=experiment.get_ref_batch(),
+        ), tokens=(nb_evolve, it.eval_indices_left()))
+
+    def remove_evicted_parents(self, evicted_parents):
+        """
+        Steady-state mode: after a new task is published, the offspring that were evicted while they were parents
+            of the previous one are no longer referenced and can be removed
+        :return: the parents of the new task, an empty list of evicted parents
+        """
+        published_parents = set(parent for _, parent in self.it.parents())
+        for evicted in evicted_parents:
+            if evicted not in published_parents:
+                remove_file_if_exists(evicted)
+        return published_parents, []
+
+    def record_generation(self, scores, best_ev_acc, plot):
+        config, experiment, master, policy, stats, it = \
+            self.config, self.experiment, self.master, self.policy, self.stats, self.it
+
+        stats.record_score_stats(scores)
+        stats.record_bs_stats(it.batch_size())
+        stats.record_step_time_stats()
+        stats.record_results_per_sec_stats()
+        stats.record_overproduced_stats()
+        stats.record_stale_results(master.pop_stale_count())
+        stats.record_norm_stats(policy.parameter_vector())
+        stats.record_acc_stats(best_ev_acc)
+        stats.record_best_acc_stats(it.best_elites()[0][1])
+        stats.record_std_stats(it.noise_stdev())
+        stats.update_mem_stats()
+        it.record_heartbeats(master.get_workers())
+        if it.sensitivity_reuse() is not None:
+            stats.record_sensitivity_reuse_stats(*it.sensitivity_reuse())
+
+        stats.log_stats()
+        it.log_stats()
+
+        if config.snapshot_freq != 0 and it.iteration() % config.snapshot_freq == 0:
+            save_snapshot(stats, it, experiment)
+            if plot:
+                stats.plot_stats(experiment.snapshot_dir())
+
     @staticmethod
     def selection(curr_task_results, pop_size, num_elites):
         scored_models = [(result.evaluated_model_id, result.evaluated_model, result.fitness.item())
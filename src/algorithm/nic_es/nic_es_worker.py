@@ -11,25 +11,28 @@ import torch
 # from memory_profiler import profile
 from algorithm.nic_es.nic_es_master import ESTask, ESResult
 from algorithm.nic_es.experiment import ESExperiment
-from dist import WorkerClient
+from dist import WorkerClient, WorkerTransport
+from dist_local import LocalWorkerClient
 from algorithm.policies import Policy
+from algorithm.tools.seed_chain import SeedChain
 from algorithm.tools.setup import Config, setup_worker
-from algorithm.tools.utils import mkdir_p
+from algorithm.tools.utils import mkdir_p, random_state
+from algorithm.tools.worker_registry import HeartbeatSender
 
 logger = logging.getLogger(__name__)
 
 
 class ESWorker(object):
 
-    def __init__(self, master_redis_cfg, relay_redis_cfg):
+    def __init__(self, master_redis_cfg, relay_redis_cfg, worker_client=None):
         self.rs = np.random.RandomState()
         self.worker_id = self.rs.randint(2 ** 31)
         self.offspring_dir = ''
         self.offspring_path = ''
         self.eval_dir = ''
 
-        # redis client
-        self.worker = WorkerClient(master_redis_cfg, relay_redis_cfg)
+        # redis client, unless another transport is given
+        self.worker: WorkerTransport = worker_client or WorkerClient(relay_redis_cfg, master_redis_cfg)
         self.exp = self.worker.get_experiment()
 
         self.offspring_dir = os.path.join(self.exp['log_dir'], 'models', 'offspring')
@@ -44,6 +47,15 @@ class ESWorker(object):
         self.policy: Policy = setup_tuple[1]
         self.experiment: ESExperiment = setup_tuple[2]
 
+        # (task_id, batch) of the last batch rebuilt from published indices
+        self._cached_batch = None, None
+        # task for which no more tokens were left, and since when
+        self._idle_task_id, self._idle_since = None, 0.
+
+        self.heartbeat = HeartbeatSender(self.worker, self.worker_id, self.config.heartbeat_interval or 10.,
+                                         model_cache=self.policy.model_cache,
+                                         sensitivity=self.policy.sensitivity_wrapper())
+
         self.placeholder = torch.FloatTensor(1)
 
     # @profile(stream=open('output/memory_profile_worker.txt', 'w+'))
@@ -64,25 +76,22 @@ class ESWorker(object):
         while True:
 
             it_id += 1
-            time.sleep(0.1)
-            mem_usages = []
-
-            eval_or_evolve = rs.rand()
-            # this is here to make workers stop when they have already generated 3 times the population size
-            # within one generation because master is running behind on tasks or waiting for evaluations
-            # (as opposed to evolutions)
-            if len(os.listdir(self.offspring_dir)) > 3 * self.experiment.nb_offspring():
-                time.sleep(2)
-                # logging.warning('Too many files in offspring dir: %s / %s',
-                #                 len(os.listdir(self.offspring_dir)),
-                #                 self.experiment.nb_offspring())
-                if eval_or_evolve >= config.eval_prob:
-                    continue
+            self.heartbeat.beat()
 
             task_id, task_data = worker.get_current_task()
             task_tstart = time.time()
             assert isinstance(task_id, int) and isinstance(task_data, ESTask)
 
+            # claim an eval or evolve job of this task, if there are none left wait for the next task
+            # (the master reissues tokens of jobs it doesn't get results for, so check again after a while)
+            if task_id == self._idle_task_id and time.time() - self._idle_since < 1.:
+                time.sleep(0.05)
+                continue
+            cand_index, evolve = self.claim_job(task_id)
+            if cand_index is None and not evolve:
+                self._idle_task_id, self._idle_since = task_id, time.time()
+                continue
+
             # uncomment to calculate sensitivities for current policy on entire training set
             # policy.calculate_all_sensitivities(task_data, self.experiment.trainloader,
             #                                    self.offspring_dir, self.experiment.orig_batch_size())
@@ -90,40 +99,72 @@ class ESWorker(object):
 
             self.policy.set_ref_batch(task_data.ref_batch)
 
-            if eval_or_evolve < config.eval_prob:
-                logger.info('EVAL RUN')
-                try:
-                    result = self.accuracy(task_id, policy, task_data)
-                    worker.push_result(task_id, result)
-
-                except FileNotFoundError as e:
-                    logger.error(e)
-
-            else:
-                # logging.info('EVOLVE RUN')
-                try:
-
+            job_tstart = time.time()
+            try:
+                if not evolve:
+                    logger.info('EVAL RUN')
+                    result = self.accuracy(task_id, policy, task_data, cand_index)
+                else:
+                    # logging.info('EVOLVE RUN')
                     result = self.fitness(it_id, policy, task_data, task_id)
-                    worker.push_result(task_id, result)
+                worker.push_result(task_id, result)
+                self.heartbeat.record_job(evolve, time.time() - job_tstart)
 
-                except FileNotFoundError as e:
-                    logging.error(e)
+            except FileNotFoundError as e:
+                logger.error(e)
+                self.release_job(task_id, cand_index, evolve)
+            except BaseException:
+                self.release_job(task_id, cand_index, evolve)
+                raise
 
             del task_data
             gc.collect()
             # self.write_alive_tensors()
 
-    def accuracy(self, task_id, policy, task_data):
+    def claim_job(self, task_id):
+        """
+        Claim a token for an eval job with probability config.eval_prob, an evolve job otherwise,
+            or a job of the other kind if there are no tokens left for the chosen one
+        :return: (index of the candidate to evaluate or None, whether an evolve job was claimed)
+        """
+        if self.rs.rand() < self.config.eval_prob:
+            cand_index = self.worker.claim_eval_token(task_id)
+            if cand_index is not None:
+                return cand_index, False
+            return None, self.worker.claim_evolve_token(task_id)
+
+        if self.worker.claim_evolve_token(task_id):
+            return None, True
+        return self.worker.claim_eval_token(task_id), False
+
+    def release_job(self, task_id, cand_index, evolve):
+        if evolve:
+            self.worker.release_evolve_token(task_id)
+        else:
+            self.worker.release_eval_token(task_id, cand_index)
+
+    def batch_data(self, task_id, task_data):
+        """
+        The batch of the task, rebuilt once per task from its indices if the master only published those
+        """
+        if task_data.batch_indices is None:
+            # arrays in the task are read-only views on the received message, a shallow copy is enough
+            return copy.copy(task_data.batch_data)
+        if self._cached_batch[0] != task_id:
+            self._cached_batch = task_id, self.experiment.from_batch_indices(task_data.batch_indices)
+        return copy.copy(self._cached_batch[1])
+
+    def accuracy(self, task_id, policy, task_data, index):
         """
         Compute accuracy of one of the elite candidates of last generation on validation set
+        :param index: index of the candidate in task_data.elites
         """
         mem_usages = [psutil.Process(os.getpid()).memory_info().rss]
 
-        index = self.rs.randint(len(task_data.elites))
         cand_id, cand = task_data.elites[index]
         mem_usages.append(psutil.Process(os.getpid()).memory_info().rss)
 
-        policy.set_model(cand)
+        policy.set_model(cand, task_id=task_id)
         mem_usages.append(psutil.Process(os.getpid()).memory_info().rss)
 
         score = policy.accuracy_on(self.experiment.valloader, self.config, self.eval_dir)
@@ -144,7 +185,7 @@ class ESWorker(object):
         Pick a parent, mutate it and compute the fitness of the resulting individual on
             the current minibatch (that is published by the master)
         """
-        batch_data = copy.deepcopy(task_data.batch_data)
+        batch_data = self.batch_data(task_id, task_data)
 
         # parent selection
         if self.experiment.selection() == 'tournament':
@@ -163,16 +204,27 @@ class ESWorker(object):
 
         mem_usages = [psutil.Process(os.getpid()).memory_info().rss]
 
+        seed_chain = None
         if parent is None:
             # 0'th iteration: first models still have to be generated
-            model = policy.generate_model()
+            if self.config.seed_chain:
+                seed = random_state()
+                model = policy.generate_model(start_rng=seed)
+                seed_chain = SeedChain(init_seed=seed)
+            else:
+                model = policy.generate_model()
             policy.set_model(model)
         else:
             # calculate sensitivity if necessary and evolve model
-            policy.set_model(parent)
+            policy.set_model(parent, task_id=task_id)
             policy.calc_sensitivity(task_id, parent_id, batch_data, self.experiment.orig_batch_size(),
                                     self.offspring_dir)
-            policy.evolve_model(task_data.noise_stdev)
+            if self.config.seed_chain:
+                seed = random_state()
+                policy.evolve_model(task_data.noise_stdev, rng_state=seed)
+                seed_chain = SeedChain.of(parent).mutated(seed, task_data.noise_stdev)
+            else:
+                policy.evolve_model(task_data.noise_stdev)
 
         mem_usages.append(psutil.Process(os.getpid()).memory_info().rss)
 
@@ -184,19 +236,20 @@ class ESWorker(object):
         return ESResult(
             worker_id=self.worker_id,
             evaluated_model_id=parent_id,
-            # this saves the params to a file on disk
-            evaluated_model=policy.serialized(path=self.offspring_path.format(w=self.worker_id,
-                                                                              i=it_id)),
+            # this saves the params to a file on disk, unless the offspring is encoded by its seed chain
+            evaluated_model=seed_chain if seed_chain is not None else
+            policy.serialized(path=self.offspring_path.format(w=self.worker_id, i=it_id)),
             fitness=np.array([fitness], dtype=np.float),
             mem_usage=max(mem_usages)
         )
 
 
-def start_and_run_worker(i, master_redis_cfg, relay_redis_cfg):
+def start_and_run_worker(i, master_redis_cfg, relay_redis_cfg, local_transport=None):
     logging.basicConfig(
         format='[%(asctime)s pid=%(process)d] %(message)s',
         level=logging.INFO,
     )
 
-    es_worker = ESWorker(master_redis_cfg, relay_redis_cfg)
+    worker_client = LocalWorkerClient(local_transport) if local_transport else None
+    es_worker = ESWorker(master_redis_cfg, relay_redis_cfg, worker_client=worker_client)
     es_worker.run_worker()
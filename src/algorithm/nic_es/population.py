@@ -0,0 +1,49 @@
+import bisect
+
+import numpy as np
+
+
+class SteadyStatePopulation(object):
+    """
+    Population of steady-state NIC-ES: the best offspring received so far, sorted by fitness (best first)
+        and bounded in size. Offspring are inserted one by one as their results come in.
+    """
+
+    def __init__(self, capacity):
+        self._capacity = capacity
+        # negated fitnesses, ascending, so bisect keeps the best individual first
+        self._keys = []
+        self._members = []
+
+    def insert(self, model_id, model, fitness):
+        """
+        :return: the model that dropped out of the population (the inserted one if it isn't good enough),
+                 or None if the population wasn't full yet
+        """
+        key = -fitness
+        if len(self._keys) >= self._capacity and key >= self._keys[-1]:
+            return model
+
+        i = bisect.bisect_right(self._keys, key)
+        self._keys.insert(i, key)
+        self._members.insert(i, (model_id, model))
+
+        if len(self._keys) > self._capacity:
+            self._keys.pop()
+            return self._members.pop()[1]
+        return None
+
+    def models(self):
+        return [model for (_, model) in self._members]
+
+    def best(self, n):
+        return self.models()[:n]
+
+    def fitnesses(self):
+        return -np.array(self._keys)
+
+    def capacity(self):
+        return self._capacity
+
+    def __len__(self):
+        return len(self._members)
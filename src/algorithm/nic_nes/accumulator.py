@@ -0,0 +1,119 @@
+import logging
+import os
+import time
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+
+class GradientAccumulator(object):
+    """
+    Collects the fitnesses and mutations of one NIC-NES generation while the results come in, in buffers
+        that are allocated once and reused every generation. At the end of the generation the weighted
+        sum of the mutations is computed with a single matrix-vector product.
+    Mutations are either full noise vectors, or offsets in a SharedNoiseTable.
+    """
+
+    def __init__(self, capacity, memmap_dir=None, block_size=16):
+        """
+        :param capacity:    max nb of results per generation (nb_offspring)
+        :param memmap_dir:  if set, the noise matrix is memory-mapped to a file in this dir instead of kept in RAM
+        :param block_size:  nb of noise table slices that are gathered per matrix-vector product
+        """
+        self._capacity = capacity
+        self._memmap_dir = memmap_dir
+        self._block_size = block_size
+
+        self._fitnesses = np.empty((capacity, 2), dtype=np.float64)
+        self._noise_indices = np.empty(capacity, dtype=np.int64)
+        self._staleness = np.zeros(capacity, dtype=np.int64)
+        # allocated when the first mutation comes in, because only then dim(theta) is known
+        self._noise = None
+        self._block = None
+
+        self._count = 0
+        self._reduction_time = 0.
+
+    def reset(self):
+        self._count = 0
+
+    def add(self, fitness, noise=None, noise_index=None, staleness=0):
+        """
+        :param fitness:     array with 2 elements: fitness of theta + noise and of theta - noise
+        :param noise:       the mutation vector, or None if noise_index is given
+        :param noise_index: offset of the mutation in the noise table
+        :param staleness:   nb of updates of theta since the mutation was evaluated (async NIC-NES)
+        """
+        if self._count >= self._capacity:
+            logger.warning('[accumulator] Full, dropping result')
+            return
+
+        i = self._count
+        self._fitnesses[i] = fitness
+        self._staleness[i] = staleness
+        if noise is not None:
+            if self._noise is None:
+                self._noise = self._allocate((self._capacity, len(noise)), 'noise')
+            self._noise[i] = noise
+        else:
+            assert noise_index is not None
+            self._noise_indices[i] = noise_index
+        self._count += 1
+
+    def _allocate(self, shape, name):
+        if self._memmap_dir:
+            path = os.path.join(self._memmap_dir, 'accumulator_{}_{}.dat'.format(name, os.getpid()))
+            logger.info('[accumulator] Memory-mapping {} to {}'.format(shape, path))
+            return np.memmap(path, dtype=np.float32, mode='w+', shape=shape)
+        return np.empty(shape, dtype=np.float32)
+
+    def weighted_sum(self, weights, noise_table=None, dim=None):
+        """
+        :param weights:     numpy array with size (count,), one weight per mutation
+        :param noise_table: SharedNoiseTable, needed if the mutations were added as offsets
+        :param dim:         dim(theta), needed if the mutations were added as offsets
+        :return: numpy array of dimension (dim(theta),): sum_i weights[i] * mutation[i]
+        """
+        assert len(weights) == self._count
+        start_time = time.time()
+        weights = np.asarray(weights, dtype=np.float32)
+
+        if self._noise is not None:
+            total = np.dot(weights, self._noise[:self._count])
+        else:
+            # gather the noise table slices in a preallocated block, one matrix-vector product per block
+            assert noise_table is not None and dim is not None
+            if self._block is None or self._block.shape[1] != dim:
+                self._block = np.empty((self._block_size, dim), dtype=np.float32)
+            total = np.zeros(dim, dtype=np.float32)
+            for start in range(0, self._count, self._block_size):
+                end = min(start + self._block_size, self._count)
+                for j, index in enumerate(self._noise_indices[start:end]):
+                    self._block[j] = noise_table.get(index, dim)
+                total += np.dot(weights[start:end], self._block[:end - start])
+
+        self._reduction_time = time.time() - start_time
+        return total
+
+    def holds_indices(self):
+        return self._noise is None
+
+    def fitnesses(self):
+        return self._fitnesses[:self._count]
+
+    def noise_indices(self):
+        return self._noise_indices[:self._count]
+
+    def staleness(self):
+        return self._staleness[:self._count]
+
+    def count(self):
+        return self._count
+
+    def nbytes(self):
+        return sum(a.nbytes for a in (self._fitnesses, self._noise_indices, self._staleness, self._noise, self._block)
+                   if a is not None)
+
+    def reduction_time(self):
+        return self._reduction_time
@@ -1,15 +1,16 @@
 import os
 
-import numpy as np
-
 from algorithm.nets import PolicyNet
+from algorithm.nic_nes.accumulator import GradientAccumulator
 from algorithm.tools.iteration import Iteration
-from algorithm.tools.utils import mkdir_p, copy_file_from_to, remove_all_files_from_dir
+from algorithm.tools.utils import mkdir_p, copy_file_from_to, remove_all_files_from_dir, remove_file_if_exists
 
 
 class NESIteration(Iteration):
     """
     Subclass for NIC-NES iteration
+        In async mode every update of the current model is written to a new file in models/current, so workers
+        that are still busy with one of the last max_staleness versions can keep loading it
     """
 
     def __init__(self, config, exp):
@@ -17,54 +18,141 @@ class NESIteration(Iteration):
 
         self._current_dir = os.path.join(self._models_dir, 'current')
         mkdir_p(self._current_dir)
-        self._current_path = os.path.join(self._current_dir, '0_current_params.pth')
+        self._current_path = os.path.join(self._current_dir, '{v}_current_params.pth')
 
         self._model = None
+        self._version = 0
+        self._max_staleness = 0
+        self._versions = []
+        # score of the last evaluation, async iterations may end before one comes in
+        self._last_score = 0.
+        # async mode: staleness of the tasks (so distinct tasks) whose results went into the current update
+        self._update_tasks = set()
+
+        # mutations are not kept in the task results but written to the accumulator as they come in
+        self._accumulator = GradientAccumulator(self._nb_offspring, memmap_dir=config.accumulator_memmap_dir)
 
     def init_from_infos(self, infos: dict):
         super().init_from_infos(infos)
-        copy_file_from_to(infos['current_model'], self._current_path)
-        self._model = self._current_path.format(i=0)
+        copy_file_from_to(infos['current_model'], self._current_path.format(v=0))
+        self._model = self._current_path.format(v=0)
+        self._last_score = infos.get('last_score', 0.)
 
     def init_from_zero(self, exp, policy):
-        self._model = policy.generate_model().serialize(path=self._current_path)
+        self._model = policy.generate_model().serialize(path=self._current_path.format(v=0))
 
     def init_from_single(self, param_file_name: str, exp, policy):
         self._model = (policy
                        .generate_model(from_param_file=param_file_name)
-                       .serialize(path=self._current_path))
+                       .serialize(path=self._current_path.format(v=0)))
 
     def to_dict(self):
         return {
             **super().to_dict(),
             'current_model': self._model,
+            'last_score': self._last_score,
         }
 
-    def record_eval_result(self, result):
+    def incr_iteration(self):
+        super().incr_iteration()
+        self._accumulator.reset()
+
+    def incr_update(self, nb_results):
+        """
+        Async mode: collect nb_results evolve results for the next update of the current model, within the
+            same iteration
+        """
+        self._accumulator.reset()
+        self._update_tasks = set()
+        self.set_nb_models_to_evaluate(nb_results)
+
+    def record_update_samples(self):
+        """
+        Async mode: an update uses results of several tasks, every one of them evaluated on its own batch
+        """
+        self._nb_samples_used += len(self._update_tasks) * self._batch_size
+
+    def _samples_per_iteration(self):
+        # async mode counts the samples per update, see record_update_samples
+        return 0 if self._max_staleness else super()._samples_per_iteration()
+
+    def record_task_result(self, result, staleness=0):
+        self._accumulator.add(result.fitness, noise=result.evolve_noise, noise_index=result.noise_index,
+                              staleness=staleness)
+        super().record_task_result(result._replace(evolve_noise=None))
+
+    def record_task_results(self, results, staleness=None):
+        """
+        :param staleness: per result, the nb of updates of the current model since its task (default 0)
+        :return: the nb of results that weren't needed
+        """
+        staleness = staleness if staleness is not None else [0] * len(results)
+        needed = results[:self.nb_models_left_to_evolve()]
+        for result, s in zip(needed, staleness):
+            self.record_task_result(result, staleness=s)
+            self._update_tasks.add(s)
+        return len(results) - len(needed)
+
+    def record_eval_result(self, result, model=None):
+        """
+        :param model: the current model the result was computed on, if it isn't the current one anymore
+        """
         prev = self._eval_results.get(0, ('', None))[1] or float('-inf')
-        self._eval_results.update({
-            0: (self._model, max(result.eval_score, prev))
-        })
+        if result.eval_score >= prev:
+            self._eval_results.update({
+                0: (model or self._model, result.eval_score)
+            })
+            self._last_score = result.eval_score
 
     def models_left_to_eval(self):
         return not bool(self._eval_results)
 
+    def nb_evals_left(self):
+        return int(self.models_left_to_eval())
+
     def set_model(self, model: PolicyNet):
         assert isinstance(model, PolicyNet)
-        remove_all_files_from_dir(self._current_dir)
-        self._model = model.serialize(path=self._current_path)
+        if not self._max_staleness:
+            remove_all_files_from_dir(self._current_dir)
+            self._model = model.serialize(path=self._current_path.format(v=0))
+            return
+
+        self._version += 1
+        self._model = model.serialize(path=self._current_path.format(v=self._version))
+        self._versions.append(self._model)
+        if len(self._versions) > self._max_staleness + 1:
+            self._versions.pop(0)
+            self._clean_current_dir()
+
+    def set_max_staleness(self, max_staleness):
+        """
+        Async mode: keep the files of the last max_staleness versions of the current model
+        """
+        self._max_staleness = max_staleness
+        self._versions = [self._model]
+
+    def _clean_current_dir(self):
+        # sensitivities are written after the model of their task, so they are cleaned together with it
+        oldest = os.path.getmtime(self._versions[0])
+        for file in os.listdir(self._current_dir):
+            path = os.path.join(self._current_dir, file)
+            if os.path.getmtime(path) < oldest:
+                remove_file_if_exists(path)
 
     def current_model(self):
         return self._model
 
     def score(self):
-        return self._eval_results.get(0, ('', None))[1] or float(0)
+        return self._last_score
 
     def fitnesses(self):
-        return np.stack([r.fitness for r in self._task_results])
+        return self._accumulator.fitnesses()
 
     def flat_fitnesses(self):
-        return np.concatenate([r.fitness for r in self._task_results])
+        return self._accumulator.fitnesses().ravel()
+
+    def accumulator(self):
+        return self._accumulator
 
-    def noise_vecs(self):
-        return np.stack([r.evolve_noise for r in self._task_results])
+    def current_dir(self):
+        return self._current_dir
@@ -16,7 +16,8 @@ import torch
 # from memory_profiler import profile
 
 from algorithm.nic_nes.iteration import NESIteration
-from dist import MasterClient
+from algorithm.nic_nes.noise_table import SharedNoiseTable
+from dist import MasterClient, MasterTransport
 from algorithm.nic_nes.experiment import NESExperiment
 from algorithm.policies import Policy
 from algorithm.tools.setup import Config, setup_master
@@ -24,16 +25,17 @@ from algorithm.tools.snapshot import save_snapshot
 from algorithm.tools.statistics import Statistics
 
 
-nes_task_fields = ['current', 'batch_data', 'noise_stdev', 'log_dir', 'ref_batch', 'batch_size']
+nes_task_fields = ['current', 'batch_data', 'noise_stdev', 'log_dir', 'ref_batch', 'batch_size',
+                   'batch_indices']
 NESTask = namedtuple('NESTask', field_names=nes_task_fields, defaults=(None,) * len(nes_task_fields))
 
-result_fields = ['worker_id', 'eval_score', 'evolve_noise', 'fitness', 'mem_usage']
+result_fields = ['worker_id', 'eval_score', 'evolve_noise', 'fitness', 'mem_usage', 'noise_index']
 NESResult = namedtuple('NESResult', field_names=result_fields, defaults=(None,) * len(result_fields))
 
 
 class NESMaster(object):
 
-    def __init__(self, exp, master_redis_cfg):
+    def __init__(self, exp, master_redis_cfg=None, master_client=None):
         setup_tuple = setup_master(exp)
         self.config: Config = setup_tuple[0]
         self.policy: Policy = setup_tuple[1]
@@ -42,10 +44,14 @@ class NESMaster(object):
         self.experiment: NESExperiment = setup_tuple[4]
 
         self.policy.set_model(self.it.current_model())
-        self.optimizer = self.experiment.init_optimizer(self.policy.parameter_vector().numpy())
+        self.optimizer = self.experiment.init_optimizer(self.policy.parameter_vector().numpy().copy())
 
-        # redis master
-        self.master = MasterClient(master_redis_cfg)
+        # with a noise table workers only report the offset of their noise in the table
+        self.noise_table = SharedNoiseTable(self.config.noise_table_size, self.config.noise_table_seed or 123) \
+            if self.config.noise_table_size else None
+
+        # redis master, unless another transport is given
+        self.master: MasterTransport = master_client or MasterClient(master_redis_cfg)
         # this puts up a redis key, value pair with the experiment
         self.master.declare_experiment(exp)
 
@@ -59,6 +65,9 @@ class NESMaster(object):
         """
         logging.info('run_master: {}'.format(locals()))
 
+        if self.config.async_nes:
+            return self.run_async_master(plot)
+
         config, experiment, rs, master, policy, stats, it, optimizer = \
             self.config, self.experiment, self.rs, self.master, self.policy, self.stats, self.it, self.optimizer
 
@@ -76,108 +85,254 @@ class NESMaster(object):
 
                     # publish task to relay so workers can take it
                     data = copy.deepcopy(batch_data)
-                    curr_task_id = master.declare_task(NESTask(
-                        current=it.current_model(),
-                        batch_data=data,
-                        noise_stdev=it.get_noise_stdev(),
-                        ref_batch=experiment.get_ref_batch(),
-                        batch_size=it.batch_size()
-                    ))
+                    curr_task_id = self.declare_task(data)
 
                     logging.info('********** Iteration {} **********'.format(it.iteration()))
                     logging.info('Searching {nb} params for NW'.format(nb=policy.nb_learnable_params()))
 
                     stats.reset_it_mem_usages()
+                    stats.reset_it_results()
 
-                    while it.models_left_to_evolve() or it.models_left_to_eval():
+                    while it.generation_open():
 
                         # this is just for logging
                         it.warn_waiting_for_evaluations()
 
-                        # wait for a result
-                        task_id, result = master.pop_result()
-                        assert isinstance(task_id, int) and isinstance(result, NESResult)
+                        # wait for a batch of results, or until the deadline of the generation
+                        results = master.pop_results(max_n=config.result_batch_size or 100, timeout=it.pop_timeout())
+                        stats.record_it_results(len(results))
+                        if not results:
+                            continue
 
                         # some memory usage tracking
                         # https://psutil.readthedocs.io/en/latest/#memory
                         master_mem_usage = psutil.Process(os.getpid()).memory_info().rss
                         stats.record_it_master_mem_usage(master_mem_usage)
-                        stats.record_it_worker_mem_usage(result.worker_id, result.mem_usage)
 
-                        it.record_worker_id(result.worker_id)
+                        evolve_results = []
+                        for task_id, result in results:
+                            assert isinstance(task_id, int) and isinstance(result, NESResult)
+                            stats.record_it_worker_mem_usage(result.worker_id, result.mem_usage)
+                            it.record_worker_id(result.worker_id)
+
+                            if result.eval_score is not None:
+                                # this was an evaluation job, store the result only for current tasks
+                                if task_id == curr_task_id:
+                                    it.record_eval_result(result)
 
-                        if result.eval_score is not None:
-                            # this was an evaluation job, store the result only for current tasks
-                            if task_id == curr_task_id:
-                                it.record_eval_result(result)
+                            elif result.fitness is not None:
+                                # this was an evolution job, so contains mutation and score
+                                # store results only for current tasks
+                                if task_id == curr_task_id:
+                                    evolve_results.append(result)
 
-                        elif result.fitness is not None:
-                            # this was an evolution job, so contains mutation and score
-                            # store results only for current tasks
-                            if task_id == curr_task_id:
-                                it.record_task_result(result)
+                        stats.record_it_overproduced(it.record_task_results(evolve_results))
+
+                    # with a quorum or deadline, results that didn't come in yet are dropped
+                    stats.record_dropped_stats(it.nb_models_left_to_evolve(), it.nb_evals_left())
 
                     it.process_evaluated_elites()
+                    self.update(curr_task_id, data)
+                    self.record_generation(plot)
+
+                    if it.patience_reached() or it.schedule_reached():
+                        # to use new trainloader when increased batch size!
+                        break
+
+        except KeyboardInterrupt:
+            save_snapshot(stats, it, experiment)
+            if plot:
+                stats.plot_stats(experiment.snapshot_dir())
 
-                    # compute a gradient estimate from the mutations and the scores
-                    grad_estimate = self.gradient_estimate(it.fitnesses(), it.noise_vecs())
-                    # caution l2 * theta is correct because L2 regularization adds a (1/2)* l2 * sum(theta^2) term
-                    # to the loss function, the derivative of this w.r.t. theta = l2 * theta
-                    reg_term = config.l2coeff * policy.parameter_vector().numpy()
+    def run_async_master(self, plot: bool):
+        """
+        Async NIC-NES: no barrier between generations. The current model is updated every async_update_every
+            evolve results, with the results of tasks up to async_max_staleness updates old. Results are weighted
+            by 1 / (1 + staleness) in the gradient estimate. Every nb_offspring results (a generation) are an
+            iteration, like in sync mode: the patience, schedule, evaluations and statistics advance per iteration.
+        """
+        config, experiment, master, stats, it = self.config, self.experiment, self.master, self.stats, self.it
 
-                    if config.l2coeff:
-                        logging.info('Impact of l2 regularization (l2, reg / grad): %s, %s / %s = %s',
-                                     config.l2coeff, np.linalg.norm(reg_term), np.linalg.norm(grad_estimate),
-                                     np.linalg.norm(reg_term) / np.linalg.norm(grad_estimate))
+        torch.set_grad_enabled(False)
+        torch.set_num_threads(0)
 
-                    update_ratio, theta = optimizer.update(-grad_estimate + reg_term)
+        update_every = config.async_update_every or max(experiment.nb_offspring() // 4, 1)
+        assert update_every <= experiment.nb_offspring(), 'async_update_every can be at most nb_offspring'
+        updates_per_iteration = -(-experiment.nb_offspring() // update_every)
+        max_staleness = config.async_max_staleness or 2 * updates_per_iteration
+        master.set_max_staleness(max_staleness)
+        it.set_max_staleness(max_staleness)
 
-                    # set the policy to the resulting parameters
-                    policy.set_from_parameter_vector(vector=theta)
-                    it.set_model(policy.get_model())
+        # current model per accepted task, to attribute evaluations to the model that was evaluated
+        task_models = {}
+        nb_updates = 0
+        # fitnesses and staleness of the results of all updates of the iteration
+        scores, staleness = [], []
 
-                    if it.patience_reached() or it.schedule_reached():
-                        experiment.increase_loader_batch_size(it.batch_size())
-                        optimizer.stepsize /= config.stepsize_divisor
-
-                    stats.record_update_ratio(update_ratio)
-                    stats.record_score_stats(it.flat_fitnesses())
-                    stats.record_bs_stats(it.batch_size())
-                    stats.record_step_time_stats()
-                    stats.record_norm_stats(policy.parameter_vector())
-                    stats.record_acc_stats(it.score())
-                    stats.record_best_acc_stats(it.best_elites()[0][1])
-                    stats.record_std_stats(it.noise_stdev())
-                    stats.update_mem_stats()
-
-                    stats.log_stats()
-                    it.log_stats()
-
-                    if config.snapshot_freq != 0 and it.iteration() % config.snapshot_freq == 0:
-                        save_snapshot(stats, it, experiment)
-                        if plot:
-                            stats.plot_stats(experiment.snapshot_dir())
+        try:
+            while not config.max_nb_iterations or it.iteration() < config.max_nb_iterations:
+                it.incr_epoch()
 
-                    if it.patience_reached() or it.schedule_reached():
-                        # to use new trainloader when increased batch size!
-                        break
+                for batch_data in experiment.get_trainloader():
+                    gc.collect()
+                    if nb_updates % updates_per_iteration == 0:
+                        it.incr_iteration()
+                        stats.set_step_tstart()
+                        stats.reset_it_mem_usages()
+                        stats.reset_it_results()
+                        scores, staleness = [], []
+                        logging.info('********** Iteration {} **********'.format(it.iteration()))
+
+                    it.incr_update(update_every)
+                    data = copy.deepcopy(batch_data)
+                    curr_task_id = self.declare_task(data)
+                    task_models[curr_task_id] = it.current_model()
+                    task_models = {t: m for t, m in task_models.items() if t >= curr_task_id - max_staleness}
+
+                    while it.models_left_to_evolve():
+                        results = master.pop_results(max_n=config.result_batch_size or 100)
+                        stats.record_it_results(len(results))
+
+                        master_mem_usage = psutil.Process(os.getpid()).memory_info().rss
+                        stats.record_it_master_mem_usage(master_mem_usage)
+
+                        evolve_results, evolve_staleness = [], []
+                        for task_id, result in results:
+                            assert isinstance(task_id, int) and isinstance(result, NESResult)
+                            stats.record_it_worker_mem_usage(result.worker_id, result.mem_usage)
+                            it.record_worker_id(result.worker_id)
+
+                            if result.eval_score is not None:
+                                it.record_eval_result(result, model=task_models.get(task_id))
+                            elif result.fitness is not None:
+                                evolve_results.append(result)
+                                evolve_staleness.append(curr_task_id - task_id)
+
+                        stats.record_it_overproduced(it.record_task_results(evolve_results, evolve_staleness))
+
+                    it.record_update_samples()
+                    nb_updates += 1
+                    end_of_iteration = nb_updates % updates_per_iteration == 0
+                    scores.append(it.flat_fitnesses().copy())
+                    staleness.append(it.accumulator().staleness().copy())
+                    if end_of_iteration:
+                        # evaluations are not waited for, they are attributed to the iteration they come in during
+                        it.process_evaluated_elites()
+                    self.update(curr_task_id, data, end_of_iteration=end_of_iteration)
+
+                    if end_of_iteration:
+                        stats.record_staleness_stats(np.concatenate(staleness))
+                        self.record_generation(plot, scores=np.concatenate(scores))
+
+                        if it.patience_reached() or it.schedule_reached():
+                            # to use new trainloader when increased batch size!
+                            break
 
         except KeyboardInterrupt:
             save_snapshot(stats, it, experiment)
             if plot:
                 stats.plot_stats(experiment.snapshot_dir())
 
-    def gradient_estimate(self, fitnesses, noise_vecs):
+    def declare_task(self, data):
+        config, experiment, it = self.config, self.experiment, self.it
+        return self.master.declare_task(NESTask(
+            current=it.current_model(),
+            batch_data=None if config.publish_batch_indices else data,
+            batch_indices=experiment.to_batch_indices(data) if config.publish_batch_indices else None,
+            noise_stdev=it.get_noise_stdev(),
+            ref_batch=experiment.get_ref_batch(),
+            batch_size=it.batch_size()
+        ))
+
+    def update(self, curr_task_id, data, end_of_iteration=True):
+        """
+        Update the current model with a gradient estimate from the results in the accumulator
+        :param end_of_iteration: async mode updates several times per iteration, the curriculum and statistics
+                                 only advance with the last update
+        """
+        config, experiment, policy, stats, it, optimizer = \
+            self.config, self.experiment, self.policy, self.stats, self.it, self.optimizer
+
+        # compute a gradient estimate from the mutations and the scores
+        if it.accumulator().holds_indices():
+            # safe mutations: the workers stored the sensitivity of this task, load it
+            # (in async mode results of older tasks are scaled by this sensitivity too)
+            policy.calc_sensitivity(curr_task_id, 0, data, experiment.orig_batch_size(), it.current_dir())
+        grad_estimate = self.gradient_estimate(it.fitnesses(), it.accumulator(), it.noise_stdev())
+        # caution l2 * theta is correct because L2 regularization adds a (1/2)* l2 * sum(theta^2) term
+        # to the loss function, the derivative of this w.r.t. theta = l2 * theta
+        reg_term = config.l2coeff * policy.parameter_vector().numpy()
+
+        if config.l2coeff:
+            logging.info('Impact of l2 regularization (l2, reg / grad): %s, %s / %s = %s',
+                         config.l2coeff, np.linalg.norm(reg_term), np.linalg.norm(grad_estimate),
+                         np.linalg.norm(reg_term) / np.linalg.norm(grad_estimate))
+
+        update_ratio, theta = optimizer.update(-grad_estimate + reg_term)
+
+        # set the policy to the resulting parameters
+        policy.set_from_parameter_vector(vector=theta)
+        it.set_model(policy.get_model())
+
+        if not end_of_iteration:
+            return
+
+        if it.patience_reached() or it.schedule_reached():
+            experiment.increase_loader_batch_size(it.batch_size())
+            optimizer.stepsize /= config.stepsize_divisor
+
+        stats.record_update_ratio(update_ratio)
+
+    def record_generation(self, plot: bool, scores=None):
+        config, experiment, master, policy, stats, it = \
+            self.config, self.experiment, self.master, self.policy, self.stats, self.it
+
+        stats.record_reduction_stats(it.accumulator().nbytes(), it.accumulator().reduction_time())
+        stats.record_score_stats(it.flat_fitnesses() if scores is None else scores)
+        stats.record_bs_stats(it.batch_size())
+        stats.record_step_time_stats()
+        stats.record_results_per_sec_stats()
+        stats.record_overproduced_stats()
+        stats.record_stale_results(master.pop_stale_count())
+        stats.record_norm_stats(policy.parameter_vector())
+        stats.record_acc_stats(it.score())
+        stats.record_best_acc_stats(it.best_elites()[0][1])
+        stats.record_std_stats(it.noise_stdev())
+        stats.update_mem_stats()
+        it.record_heartbeats(master.get_workers())
+        if it.sensitivity_reuse() is not None:
+            stats.record_sensitivity_reuse_stats(*it.sensitivity_reuse())
+
+        stats.log_stats()
+        it.log_stats()
+
+        if config.snapshot_freq != 0 and it.iteration() % config.snapshot_freq == 0:
+            save_snapshot(stats, it, experiment)
+            if plot:
+                stats.plot_stats(experiment.snapshot_dir())
+
+    def gradient_estimate(self, fitnesses, accumulator, sigma):
         """
         :param fitnesses: numpy array with size (F, 2)
-                          contains two scores per mutation vector in noise_vecs
+                          contains two scores per mutation vector in the accumulator
                           --> one for theta + delta and one for theta - delta (mirrored sampling)
-        :param noise_vecs: numpy array with size (F, dim(theta))
+        :param accumulator: GradientAccumulator that holds the F mutations (or their noise table offsets)
+        :param sigma: the noise stdev the workers used, needed if the accumulator holds offsets
         :return: numpy array of dimension (dim(theta),)
         """
         ranked_fitnesses = self.compute_centered_ranks(fitnesses)
         weights = ranked_fitnesses[:, 0] - ranked_fitnesses[:, 1]
-        gradient_est, _ = self.batched_weighted_sum(weights, noise_vecs)
+        # async mode: results computed on older versions of theta count less
+        weights = weights / (1. + accumulator.staleness())
+
+        if accumulator.holds_indices():
+            # the mutation scaling (safe/proportional) is elementwise and linear, so it can be applied
+            # once to the weighted sum of the standard normal noise table slices
+            weighted_eps = accumulator.weighted_sum(weights, self.noise_table, self.policy.nb_learnable_params())
+            gradient_est = self.policy.scale_mutation(torch.from_numpy(weighted_eps * sigma)).numpy()
+        else:
+            gradient_est = accumulator.weighted_sum(weights)
+
         gradient_est /= ranked_fitnesses.size
         return gradient_est
 
@@ -203,34 +358,3 @@ class NESMaster(object):
         ranks = np.empty(len(x), dtype=int)
         ranks[x.argsort()] = np.arange(len(x))
         return ranks
-
-    @staticmethod
-    def batched_weighted_sum(weights, vecs, batch_size=500):
-        """
-        Taken from https://github.com/openai/evolution-strategies-starter
-
-        Used to compute a dot product in batches to reduce memory usage
-        """
-        total = 0.
-        num_items_summed = 0
-        for batch_weights, batch_vecs in zip(NESMaster.itergroups(weights, batch_size),
-                                             NESMaster.itergroups(vecs, batch_size)):
-            assert len(batch_weights) == len(batch_vecs) <= batch_size
-            total += np.dot(np.asarray(batch_weights, dtype=np.float32), np.asarray(batch_vecs, dtype=np.float32))
-            num_items_summed += len(batch_weights)
-        return total, num_items_summed
-
-    @staticmethod
-    def itergroups(items, group_size):
-        """
-        Taken from https://github.com/openai/evolution-strategies-starter
-        """
-        assert group_size >= 1
-        group = []
-        for x in items:
-            group.append(x)
-            if len(group) == group_size:
-                yield tuple(group)
-                del group[:]
-        if group:
-            yield tuple(group)
@@ -10,20 +10,23 @@ import torch
 # from memory_profiler import profile
 from algorithm.nic_nes.nic_nes_master import NESTask, NESResult
 from algorithm.nic_nes.experiment import NESExperiment
-from dist import WorkerClient
+from algorithm.nic_nes.noise_table import SharedNoiseTable
+from dist import WorkerClient, WorkerTransport
+from dist_local import LocalWorkerClient
 from algorithm.policies import Policy
 from algorithm.tools.setup import Config, setup_worker
 from algorithm.tools.utils import mkdir_p
+from algorithm.tools.worker_registry import HeartbeatSender
 
 
 class NESWorker(object):
 
-    def __init__(self, master_redis_cfg, relay_redis_cfg):
+    def __init__(self, master_redis_cfg, relay_redis_cfg, worker_client=None):
         self.rs = np.random.RandomState()
         self.worker_id = os.getpid()
 
-        # redis client
-        self.worker = WorkerClient(master_redis_cfg, relay_redis_cfg)
+        # redis client, unless another transport is given
+        self.worker: WorkerTransport = worker_client or WorkerClient(relay_redis_cfg, master_redis_cfg)
         self.exp = self.worker.get_experiment()
 
         self.eval_dir = os.path.join(self.exp['log_dir'], 'eval_{}'.format(os.getpid()))
@@ -35,6 +38,16 @@ class NESWorker(object):
         self.policy: Policy = setup_tuple[1]
         self.experiment: NESExperiment = setup_tuple[2]
 
+        self.noise_table = SharedNoiseTable(self.config.noise_table_size, self.config.noise_table_seed or 123) \
+            if self.config.noise_table_size else None
+
+        # (task_id, batch) of the last batch rebuilt from published indices
+        self._cached_batch = None, None
+
+        self.heartbeat = HeartbeatSender(self.worker, self.worker_id, self.config.heartbeat_interval or 10.,
+                                         model_cache=self.policy.model_cache,
+                                         sensitivity=self.policy.sensitivity_wrapper())
+
         self.placeholder = torch.FloatTensor(1)
 
     # @profile(stream=open('output/memory_profile_worker.txt', 'w+'))
@@ -54,7 +67,7 @@ class NESWorker(object):
 
             it_id += 1
             torch.set_grad_enabled(False)
-            time.sleep(0.01)
+            self.heartbeat.beat()
 
             task_id, task_data = worker.get_current_task()
             task_tstart = time.time()
@@ -67,6 +80,7 @@ class NESWorker(object):
                 try:
                     result = self.accuracy(task_id, policy, task_data)
                     worker.push_result(task_id, result)
+                    self.heartbeat.record_job(False, time.time() - task_tstart)
 
                 except FileNotFoundError as e:
                     # Happens sometimes because master process is cleaning up files between iterations
@@ -78,6 +92,7 @@ class NESWorker(object):
 
                     result = self.fitness(task_id, policy, task_data)
                     worker.push_result(task_id, result)
+                    self.heartbeat.record_job(True, time.time() - task_tstart)
 
                 except FileNotFoundError as e:
                     # Happens sometimes because master process is cleaning up files between iterations
@@ -89,6 +104,17 @@ class NESWorker(object):
             # (Nothing suspicious was found)
             # self.write_alive_tensors()
 
+    def batch_data(self, task_id, task_data):
+        """
+        The batch of the task, rebuilt once per task from its indices if the master only published those
+        """
+        if task_data.batch_indices is None:
+            # arrays in the task are read-only views on the received message, a shallow copy is enough
+            return copy.copy(task_data.batch_data)
+        if self._cached_batch[0] != task_id:
+            self._cached_batch = task_id, self.experiment.from_batch_indices(task_data.batch_indices)
+        return copy.copy(self._cached_batch[1])
+
     def accuracy(self, task_id, policy, task_data):
         """
         Compute the accuracy of the current individual on the validation set
@@ -98,7 +124,7 @@ class NESWorker(object):
         mem_usages = [psutil.Process(os.getpid()).memory_info().rss]
 
         current_path = task_data.current
-        policy.set_model(current_path)
+        policy.set_model(current_path, task_id=task_id)
         mem_usages.append(psutil.Process(os.getpid()).memory_info().rss)
 
         score = policy.accuracy_on(self.experiment.valloader, self.config, self.eval_dir)
@@ -120,7 +146,7 @@ class NESWorker(object):
         # take published batch or take random batch from own dataloader
         if self.config.single_batch:
             logging.debug('taking published batch')
-            batch_data = copy.deepcopy(task_data.batch_data)
+            batch_data = self.batch_data(task_id, task_data)
         else:
             loader = self.experiment.get_trainloader()
             if loader.batch_size != task_data.batch_size:
@@ -128,9 +154,7 @@ class NESWorker(object):
             batch_data = next(loader)
 
         current_path = task_data.current
-        policy.set_model(current_path)
-        current_params = torch.empty_like(policy.parameter_vector()).copy_(policy.parameter_vector())
-        # copy.deepcopy(policy.parameter_vector())
+        policy.set_model(current_path, task_id=task_id)
 
         mem_usages.append(psutil.Process(os.getpid()).memory_info().rss)
 
@@ -139,7 +163,13 @@ class NESWorker(object):
         policy.calc_sensitivity(task_id, 0, batch_data,
                                 self.experiment.orig_batch_size(), self.sensitivity_dir)
         # theta <-- theta + noise
-        noise_vector = policy.evolve_model(task_data.noise_stdev)
+        noise_index = None
+        if self.noise_table is not None:
+            noise_index = self.noise_table.sample_index(self.rs, policy.nb_learnable_params())
+            eps = self.noise_table.get(noise_index, policy.nb_learnable_params())
+            noise_vector = policy.evolve_model(task_data.noise_stdev, eps=eps)
+        else:
+            noise_vector = policy.evolve_model(task_data.noise_stdev)
         mem_usages.append(psutil.Process(os.getpid()).memory_info().rss)
 
         # compute fitness
@@ -148,14 +178,14 @@ class NESWorker(object):
         mem_usages.append(psutil.Process(os.getpid()).memory_info().rss)
 
         # theta <-- theta - noise (mirrored sampling) and compute fitness again
-        policy.set_from_parameter_vector(current_params - torch.from_numpy(noise_vector))
-        mem_usages.append(psutil.Process(os.getpid()).memory_info().rss)
+        policy.mirror_model()
         neg_fitness = policy.rollout(placeholder=self.placeholder,
                                      data=batch_data, config=self.config)
-        del current_params
         return NESResult(
             worker_id=self.worker_id,
-            evolve_noise=noise_vector,
+            # the master rebuilds the noise from its offset in the noise table, if there is one
+            evolve_noise=noise_vector if noise_index is None else None,
+            noise_index=noise_index,
             fitness=np.stack((pos_fitness, neg_fitness)),
             mem_usage=max(mem_usages)
         )
@@ -175,11 +205,12 @@ class NESWorker(object):
             f.write(to_write)
 
 
-def start_and_run_worker(i, master_redis_cfg, relay_redis_cfg):
+def start_and_run_worker(i, master_redis_cfg, relay_redis_cfg, local_transport=None):
     logging.basicConfig(
         format='[%(asctime)s pid=%(process)d] %(message)s',
         level=logging.INFO,
     )
 
-    nes_worker = NESWorker(master_redis_cfg, relay_redis_cfg)
+    worker_client = LocalWorkerClient(local_transport) if local_transport else None
+    nes_worker = NESWorker(master_redis_cfg, relay_redis_cfg, worker_client=worker_client)
     nes_worker.run_worker()
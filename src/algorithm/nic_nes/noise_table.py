@@ -0,0 +1,124 @@
+"""
+    Idea of a shared noise table from https://github.com/openai/evolution-strategies-starter
+    The table is written to a memory-mapped .npy file so it is built once per node and shared by
+    all processes on it, instead of once per process.
+"""
+import logging
+import os
+import tempfile
+import time
+
+import numpy as np
+
+from algorithm.tools.utils import pid_alive, read_lock, remove_file_if_exists, remove_lock_if_owned
+
+logger = logging.getLogger(__name__)
+
+
+class SharedNoiseTable(object):
+    """
+    Large deterministic table of standard normal noise. Workers mutate with a slice of this table and only
+        report the offset of that slice, so the master can rebuild the mutation from the offset.
+    """
+
+    # seconds after which the lock of a builder that doesn't make progress is broken
+    STALE_AFTER = 60
+
+    def __init__(self, size, seed=123, directory=None, chunk_size=10 ** 7):
+        self._size = int(size)
+        self._seed = seed
+        self._chunk_size = chunk_size
+
+        if directory is None:
+            # /dev/shm keeps the table in RAM, shared between processes on the same node
+            directory = '/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir()
+        self._path = os.path.join(directory, 'nic_noise_table_s{}_n{}.npy'.format(seed, self._size))
+
+        if not os.path.exists(self._path):
+            self._build()
+
+        self._noise = np.load(self._path, mmap_mode='r')
+        assert self._noise.dtype == np.float32 and self._noise.size == self._size
+        logger.info('Using noise table {} with {} floats'.format(self._path, self._size))
+
+    def _build(self):
+        lock_path = self._path + '.lock'
+        try:
+            fd = os.open(lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            # another process on this node is building the table, wait for it
+            while not os.path.exists(self._path):
+                if not os.path.exists(lock_path) or self._break_if_stale(lock_path):
+                    # builder died before finishing
+                    return self._build()
+                time.sleep(1)
+            return
+
+        token = str(os.getpid())
+        try:
+            os.write(fd, token.encode())
+            start_time = time.time()
+            tmp_path = self._path + '.{}.tmp'.format(os.getpid())
+            table = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=np.float32, shape=(self._size,))
+
+            # fill in chunks so the table never has to fit in memory twice
+            rs = np.random.RandomState(self._seed)
+            for start in range(0, self._size, self._chunk_size):
+                end = min(start + self._chunk_size, self._size)
+                table[start:end] = rs.randn(end - start)
+                # touch the lock, so waiters see the build is progressing
+                self._touch(lock_path, token)
+            table.flush()
+            del table
+
+            os.rename(tmp_path, self._path)
+            logger.info('Built noise table {} in {:.2f}s'.format(self._path, time.time() - start_time))
+        finally:
+            os.close(fd)
+            # a waiter may have broken the lock if this build was too slow, and be building with its own lock
+            remove_lock_if_owned(lock_path, token)
+
+    @staticmethod
+    def _touch(lock_path, token):
+        if read_lock(lock_path) != token:
+            return
+        try:
+            os.utime(lock_path)
+        except FileNotFoundError:
+            pass
+
+    def _break_if_stale(self, lock_path):
+        """
+        The lock is stale if its builder is dead, or hasn't filled a chunk in STALE_AFTER seconds (e.g. it hangs
+            before writing its pid). The table is per node, so the pid is one of this node.
+        :return: whether the lock was broken, then the waiter builds the table itself
+        """
+        pid = read_lock(lock_path)
+        try:
+            age = time.time() - os.path.getmtime(lock_path)
+        except FileNotFoundError:
+            return False
+        if pid is None:
+            return False
+
+        dead = pid.isdigit() and not pid_alive(int(pid))
+        if not dead and age < self.STALE_AFTER:
+            return False
+
+        # only if it is still the lock that was judged stale, and only one of several waiters breaks it
+        if not remove_lock_if_owned(lock_path, pid):
+            return False
+        logger.warning('Broke stale noise table lock of process {}'.format(pid or '?'))
+        if dead:
+            # the half built table of the dead builder takes as much memory as the table
+            remove_file_if_exists(self._path + '.{}.tmp'.format(pid))
+        return True
+
+    def get(self, i, dim):
+        return self._noise[i:i + dim]
+
+    def sample_index(self, rs, dim):
+        return rs.randint(0, self._size - dim + 1)
+
+    def size(self):
+        return self._size
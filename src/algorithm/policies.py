@@ -1,4 +1,3 @@
-import copy
 from collections import namedtuple
 from enum import Enum
 import logging
@@ -10,6 +9,8 @@ import torchvision
 import torch
 
 from algorithm.nets import PolicyNet
+from algorithm.tools.model_cache import ModelCache
+from algorithm.tools.seed_chain import SeedChain
 from algorithm.tools.utils import mkdir_p, random_state
 
 
@@ -36,7 +37,8 @@ PolicyOptions = namedtuple('PolicyOptions', field_names=_opt_fields,
 _model_opt_fields = ['vocab_size', 'input_encoding_size', 'rnn_type', 'rnn_size', 'num_layers',
                      'drop_prob_lm', 'seq_length', 'fc_feat_size', 'vbn', 'vbn_e', 'vbn_affine', 'layer_n',
                      'layer_n_affine', 'safe_mutation_underflow', 'safe_mutations', 'safe_mutation_vector',
-                     'safe_mutation_batch_size']
+                     'safe_mutation_batch_size', 'safe_mutation_sketch_size', 'safe_mutation_reuse_every',
+                     'safe_mutation_reuse_drift', 'safe_mutation_reuse_capacity']
 ModelOptions = namedtuple('ModelOptions', field_names=_model_opt_fields,
                           defaults=(0,) * len(_model_opt_fields))
 
@@ -54,6 +56,7 @@ class Policy(ABC):
             self.fitness = None
 
         self.policy_net: PolicyNet = None
+        self.model_cache: ModelCache = None
 
         assert isinstance(dataset, SuppDataset)
         self.dataset = dataset
@@ -87,6 +90,13 @@ class Policy(ABC):
         assert self.policy_net is not None, 'set model first!'
         self.policy_net.calc_sensitivity(task_id, parent_id, experiences, batch_size, directory)
 
+    def sensitivity_wrapper(self):
+        """
+        :return: the Sensitivity of the model if it uses safe mutations, else None
+        """
+        assert self.policy_net is not None, 'set model first!'
+        return getattr(self.policy_net, 'sensitivity_wrapper', None)
+
     def set_ref_batch(self, ref_batch):
         self.ref_batch = ref_batch
 
@@ -100,6 +110,9 @@ class Policy(ABC):
         return self.NETS[self.net]
 
     def parameter_vector(self):
+        """
+        :return: a view on the params of the model, copy it to keep the current params
+        """
         assert self.policy_net is not None, 'set model first!'
         return self.policy_net.parameter_vector()
 
@@ -122,11 +135,25 @@ class Policy(ABC):
         assert isinstance(model, PolicyNet), '{}'.format(type(model))
         self.policy_net = model
 
-    def set_model(self, model):
+    def set_model_cache(self, model_cache: ModelCache):
+        # the cache holds param vectors, that's only the whole state of nets without buffers
+        assert not any(True for _ in self.policy_net.buffers())
+        self.model_cache = model_cache
+
+    def set_model(self, model, task_id=None):
+        """
+        :param model: PolicyNet, state dict, path to a .pth file or SeedChain
+        :param task_id: id of the task the model is part of, models from files or seed chains are then
+                        taken from (or added to) the model cache, if there is one
+        """
         assert self.policy_net is not None
         assert isinstance(model, PolicyNet) or isinstance(model, dict) or \
-               isinstance(model, str), '{}'.format(type(model))
-        if isinstance(model, PolicyNet):
+               isinstance(model, str) or isinstance(model, SeedChain), '{}'.format(type(model))
+        if task_id is not None and self.model_cache is not None and isinstance(model, (str, SeedChain)):
+            self._set_from_cache(model, task_id)
+        elif isinstance(model, SeedChain):
+            self._set_from_seed_chain(model)
+        elif isinstance(model, PolicyNet):
             self._set_from_statedict_model(model.state_dict())
         elif isinstance(model, dict):
             self._set_from_statedict_model(model)
@@ -136,6 +163,19 @@ class Policy(ABC):
             logging.error('Trying to set policy model from invalid input, setting random model instead')
             self._set_from_statedict_model(self.generate_model().state_dict())
 
+    def _set_from_cache(self, model, task_id):
+        key = (task_id, model)
+        vector = self.model_cache.get(key)
+        if vector is not None:
+            self.policy_net.set_from_vector(vector)
+            return
+
+        if isinstance(model, SeedChain):
+            self._set_from_seed_chain(model)
+        else:
+            self._set_from_path_model(model)
+        self.model_cache.put(key, self.policy_net.parameter_vector().clone())
+
     def _set_from_path_model(self, serialized):
         assert self.policy_net is not None, 'Set model first!'
         self.policy_net.from_serialized(serialized)
@@ -144,20 +184,58 @@ class Policy(ABC):
         assert isinstance(serialized, dict), '{}'.format(type(serialized))
         assert self.policy_net is not None, 'Set model first!'
 
-        copied = copy.deepcopy(serialized)
-        self.policy_net.load_state_dict(copied)
+        # load_state_dict copies the tensors into the params of the net, no need to copy them first
+        self.policy_net.load_state_dict(serialized)
+
+    def _set_from_seed_chain(self, chain):
+        assert self.policy_net is not None, 'Set model first!'
+        self._load_seed_chain(self.policy_net, chain)
+
+    def _load_seed_chain(self, net, chain):
+        """
+        Rebuild the params a seed chain encodes in net: load (or generate) the anchor and replay the mutations
+        """
+        if chain.anchor is not None:
+            net.from_serialized(chain.anchor)
+        else:
+            net.load_state_dict(self.generate_model(start_rng=chain.init_seed).state_dict())
+        for seed, sigma in chain.mutations:
+            net.evolve(sigma, rng_state=seed)
+
+    def serialize_seed_chain(self, chain, path):
+        """
+        Write the params a seed chain encodes to a .pth file, without changing the current model
+        """
+        net = self.generate_model()
+        self._load_seed_chain(net, chain)
+        return net.serialize(path=path)
 
     def generate_model(self, from_param_file=None, start_rng=None):
         if from_param_file:
             return self.get_net_class()(from_param_file=from_param_file, options=self.model_options, vbn=self.vbn)
-        elif start_rng:
-            return self.get_net_class()(rng_state=start_rng, options=self.model_options, vbn=self.vbn)
+        elif start_rng is not None:
+            # seed the torch rng so the same start_rng always gives the same initial params
+            with torch.random.fork_rng(devices=[]):
+                torch.manual_seed(start_rng)
+                return self.get_net_class()(rng_state=start_rng, options=self.model_options, vbn=self.vbn)
         else:
             return self.get_net_class()(rng_state=random_state(), options=self.model_options, vbn=self.vbn)
 
-    def evolve_model(self, sigma):
+    def evolve_model(self, sigma, rng_state=None, eps=None):
+        assert self.policy_net is not None, 'set model first!'
+        return self.policy_net.evolve(sigma, rng_state, eps)
+
+    def revert_model(self):
+        assert self.policy_net is not None, 'set model first!'
+        self.policy_net.revert()
+
+    def mirror_model(self):
+        assert self.policy_net is not None, 'set model first!'
+        self.policy_net.mirror()
+
+    def scale_mutation(self, noise):
         assert self.policy_net is not None, 'set model first!'
-        return self.policy_net.evolve(sigma)
+        return self.policy_net.scale_mutation(noise)
 
     def get_model(self):
         return self.policy_net
@@ -2,18 +2,41 @@
     Contains code from https://github.com/uber-research/safemutations
 """
 
+import inspect
 import logging
-import os
 import time
+from collections import deque
 
 import torch
 
-from algorithm.tools.utils import find_file_with_pattern
+from algorithm.tools.sensitivity_store import SensitivityStore
+
+# batched backward passes need torch >= 1.11, older versions compute the vector-jacobian products one at a time
+BATCHED_GRADS = 'is_grads_batched' in inspect.signature(torch.autograd.grad).parameters
 
 
 class Sensitivity(object):
 
-    def __init__(self, net, underflow, method):
+    # max memory for the grads of one chunk of outputs in the sensitivity calculation
+    VJP_CHUNK_BYTES = 256 * 2 ** 20
+
+    # default nb of random output directions of SM-G-SKETCH
+    SKETCH_SIZE = 16
+
+    # default max nb of computed sensitivities kept to be reused, each one takes 4 bytes per param
+    REUSE_CAPACITY = 4
+
+    # nb of params the drift between param vectors is estimated on, the mutations change all params
+    FINGERPRINT_SIZE = 2 ** 12
+
+    def __init__(self, net, underflow, method, sketch_size=None, reuse_every=0, reuse_drift=0., reuse_capacity=None):
+        """
+        :param reuse_every:     if set, a sensitivity computed for params at most reuse_drift away (relative L2
+                                distance) from the current ones is reused for the next reuse_every - 1 tasks
+                                instead of being recomputed, so surviving elites and slowly changing NES params
+                                don't need a new one every generation
+        :param reuse_capacity:  max nb of computed sensitivities kept to be reused
+        """
         self._sensitivity = None
         self._sens_iteration = -1
         self._parent_id = -1
@@ -21,6 +44,16 @@ class Sensitivity(object):
         self._orig_batch_size = 0
         self._underflow = underflow
         self._type = method
+        self._sketch_size = sketch_size or self.SKETCH_SIZE
+        self._batched_vjps = BATCHED_GRADS
+
+        self._reuse_every = reuse_every
+        self._reuse_drift = reuse_drift or 0.
+        # (param fingerprint, sensitivity, task_id, computation time) of the last computed sensitivities
+        self._computed = deque(maxlen=reuse_capacity or self.REUSE_CAPACITY)
+        self._fingerprint_indices = None
+        self.nb_reused, self.nb_computed = 0, 0
+        self.time_saved = 0.
 
     def get_sensitivity(self):
         return self._sensitivity
@@ -32,24 +65,63 @@ class Sensitivity(object):
         self._sensitivity = sensitivity
 
     def calc_sensitivity(self, task_id, parent_id, experiences, batch_size, directory):
-        sensitivity_pattern = 'sens_t{t}_p{p}_[0-9]*?.pt'.format(t=task_id, p=parent_id)  # _[0-9]*?
-
         if self._sensitivity is not None and self._sens_iteration == task_id and self._parent_id == parent_id:
             # logging.info('took sensitivity from own attribute')
             return
 
-        elif find_file_with_pattern(sensitivity_pattern, directory):
-            try:
-                filename = find_file_with_pattern(sensitivity_pattern, directory)
-                self._sensitivity = torch.load(os.path.join(directory, filename))
-                self._sens_iteration, self._parent_id = task_id, parent_id
-                logging.info('took sensitivity from file')
-                return
-            except (RuntimeError, EOFError):
-                time.sleep(2)
-                self.calc_sensitivity(task_id, parent_id, experiences, batch_size, directory)
-        # else:
+        store = SensitivityStore(directory)
+        sensitivity = store.get_or_compute(task_id, parent_id,
+                                           lambda: self._reuse_or_compute(task_id, experiences, batch_size))
+        self._sensitivity = sensitivity
+        self._sens_iteration, self._parent_id = task_id, parent_id
+        logging.info('Sensitivity parent {}: min {:.2f}, mean {:.2f}, max {:.2f}'
+                     .format(parent_id, sensitivity.min().item(), sensitivity.mean().item(),
+                             sensitivity.max().item()))
+        del experiences
+
+    def _reuse_or_compute(self, task_id, experiences, batch_size):
+        if self._reuse_every:
+            reusable = self._reusable(task_id)
+            if reusable is not None:
+                sensitivity, time_elapsed = reusable
+                self.nb_reused += 1
+                self.time_saved += time_elapsed
+                logging.info('Reused sensitivity')
+                return sensitivity
 
+        start_time = time.time()
+        sensitivity = self._compute_sensitivity(experiences, batch_size)
+        self.nb_computed += 1
+        if self._reuse_every:
+            self._computed.append((self._fingerprint(), sensitivity, task_id, time.time() - start_time))
+        return sensitivity
+
+    def _reusable(self, task_id):
+        """
+        :return: (sensitivity, time it took to compute) of the most recent sensitivity that was computed less than
+                 reuse_every tasks ago for params close enough to the current ones, or None
+        """
+        params = self._fingerprint()
+        for prev_params, sensitivity, prev_task_id, time_elapsed in reversed(self._computed):
+            if task_id - prev_task_id >= self._reuse_every:
+                continue
+            drift = (params - prev_params).norm() / prev_params.norm()
+            if drift <= self._reuse_drift:
+                return sensitivity, time_elapsed
+        return None
+
+    def _fingerprint(self):
+        """
+        :return: copy of the current params at FINGERPRINT_SIZE fixed random positions, instead of a clone of
+                 all params per kept sensitivity
+        """
+        params = self.net.parameter_vector()
+        if self._fingerprint_indices is None:
+            generator = torch.Generator().manual_seed(0)
+            self._fingerprint_indices = torch.randperm(params.numel(), generator=generator)[:self.FINGERPRINT_SIZE]
+        return params[self._fingerprint_indices]
+
+    def _compute_sensitivity(self, experiences, batch_size):
         start_time = time.time()
         torch.set_grad_enabled(True)
         for param in self.net.parameters():
@@ -65,23 +137,11 @@ class Sensitivity(object):
         torch.set_grad_enabled(False)
         for param in self.net.parameters():
             param.requires_grad = False
-        for param in sensitivity:
-            param.requires_grad = False
 
         time_elapsed = time.time() - start_time
         logging.info('Safe mutation sensitivity computed in {:.2f}s on {} samples'
                      .format(time_elapsed, batch_size))
-
-        if not find_file_with_pattern(sensitivity_pattern, directory):
-            sensitivity_filename = 'sens_t{t}_p{p}_{i}.pt'.format(t=task_id, p=parent_id, i=os.getpid())
-            torch.save(sensitivity.clone().detach().requires_grad_(False),
-                       os.path.join(directory, sensitivity_filename))
-        self._sensitivity = sensitivity.clone().detach().requires_grad_(False)
-        self._sens_iteration, self._parent_id = task_id, parent_id
-        logging.info('Sensitivity parent {}: min {:.2f}, mean {:.2f}, max {:.2f}'
-                     .format(parent_id, sensitivity.min().item(), sensitivity.mean().item(),
-                            sensitivity.max().item()))
-        del sensitivity, experiences
+        return sensitivity.detach().requires_grad_(False)
 
     def _calc_sensitivity(self, experiences):
         from algorithm.nets import Mutation
@@ -89,61 +149,134 @@ class Sensitivity(object):
             return self._calc_sum_sensitivity(experiences)
         elif self._type == Mutation.SAFE_GRAD_ABS:
             return self._calc_abs_sensitivity(experiences)
+        elif self._type == Mutation.SAFE_GRAD_SKETCH:
+            return self._calc_sketch_sensitivity(experiences)
 
     def _calc_sum_sensitivity(self, experiences):
         # TODO consider dividing by batch size
 
         old_output = self.net.forward_for_sensitivity(experiences, self._orig_batch_size)
-        num_outputs = old_output.size(1)
-        batch_size = old_output.size(0)
-
-        jacobian = torch.zeros(num_outputs, self.net.nb_params)
-        grad_output = torch.zeros(*old_output.size())
-
-        for k in range(num_outputs):
-            self.net.zero_grad()
-            grad_output.zero_()
-            grad_output[:, k] = 1.0
-
-            old_output.backward(gradient=grad_output, retain_graph=True)
-            jacobian[k] = self.net.extract_grad()
-        self.net.zero_grad()
-
-        sensitivity = torch.sqrt((jacobian ** 2).sum(0))  # * proportion
+        batch_size, num_outputs = old_output.size()
+
+        # sum over the outputs of the squared gradients, without storing the num_outputs x nb_params jacobian
+        squared_sum = torch.zeros(self.net.nb_params)
+        eye = torch.eye(num_outputs, dtype=old_output.dtype, device=old_output.device)
+        chunk = self._vjp_chunk_size()
+        for start in range(0, num_outputs, chunk):
+            end = min(start + chunk, num_outputs)
+            # grad_outputs[j] is 1 in column start + j for every element of the batch
+            grad_outputs = eye[start:end].unsqueeze(1).expand(end - start, batch_size, num_outputs)
+            squared_sum += self._vjps(old_output, grad_outputs).pow(2).sum(0)
+
+        sensitivity = torch.sqrt(squared_sum)  # * proportion
         sensitivity /= batch_size
 
-        copy = sensitivity.clone().detach().requires_grad_(False)
-        del old_output, jacobian, grad_output, experiences, num_outputs, sensitivity
-        return copy
+        del old_output, experiences, squared_sum
+        return sensitivity
 
     def _calc_abs_sensitivity(self, experiences):
-
+        """
+        Without vbn the outputs of every element of the batch only depend on that element, so the per sample grads
+            are the grads of the single outputs of one forward pass on the whole batch. With vbn the batch
+            statistics mix the elements, so every element gets its own forward pass (like the original loop).
+        """
         old_output = self.net.forward_for_sensitivity(experiences, self._orig_batch_size)
-        num_outputs = old_output.size(1)
-        batch_size = old_output.size(0)
-
-        jacobian = torch.zeros(num_outputs, self.nb_params, batch_size)
-        grad_output = torch.zeros((1, num_outputs))
-
-        for k in range(num_outputs):
-            for i in range(batch_size):
-                old_output_i = self.net.forward_for_sensitivity(experiences, i=i)
-
-                self.net.zero_grad()
-                grad_output.zero_()
-                grad_output[0, k] = 1.0
-
-                old_output_i.backward(gradient=grad_output, retain_graph=True)
-                jacobian[k, :, i] = self.net.extract_grad()
-
-        self.net.zero_grad()
-
-        jacobian = torch.abs(jacobian).mean(2)
-        sensitivity = torch.sqrt((jacobian ** 2).sum(0))
+        batch_size, num_outputs = old_output.size()
+        per_sample = bool(self.net.vbn)
+        if per_sample:
+            del old_output
+
+        # chunks of (outputs x samples) pairs, every vjp selects one output of one sample
+        pairs = self._vjp_chunk_size()
+        samples = 1 if per_sample else min(batch_size, pairs)
+        outputs = max(1, pairs // samples)
+
+        squared_sum = torch.zeros(self.net.nb_params)
+        for k_start in range(0, num_outputs, outputs):
+            nk = min(outputs, num_outputs - k_start)
+            # sum over the batch of |grad| of outputs k_start, ..., k_start + nk - 1
+            abs_sum = torch.zeros(nk, self.net.nb_params)
+            for i_start in range(0, batch_size, samples):
+                ni = min(samples, batch_size - i_start)
+                if per_sample:
+                    output, row_start = self.net.forward_for_sensitivity(experiences, i=i_start), 0
+                else:
+                    output, row_start = old_output, i_start
+
+                # nk x ni grid of (output, sample) pairs
+                k = torch.arange(nk).unsqueeze(1).expand(nk, ni)
+                i = torch.arange(ni).unsqueeze(0).expand(nk, ni)
+                grad_outputs = output.new_zeros(nk, ni, *output.size())
+                grad_outputs[k, i, i + row_start, k + k_start] = 1.0
+
+                grads = self._vjps(output, grad_outputs.view(nk * ni, *output.size()))
+                abs_sum += grads.abs_().view(nk, ni, -1).sum(1)
+                del grads, grad_outputs, output
+            squared_sum += (abs_sum / batch_size).pow(2).sum(0)
+
+        sensitivity = torch.sqrt(squared_sum)
+
+        del experiences, squared_sum, abs_sum
+        if not per_sample:
+            del old_output
+        return sensitivity
+
+    def _calc_sketch_sensitivity(self, experiences):
+        """
+        Estimate of the SM-G-SUM sensitivity from sketch_size random directions in output space instead of one
+            backward pass per output: for a standard normal v, E[(J^T v)^2] is the sum over the outputs of the
+            squared grads, so the estimate is unbiased (for the squared sensitivity) and its cost is independent
+            of the nb of outputs.
+        """
+        old_output = self.net.forward_for_sensitivity(experiences, self._orig_batch_size)
+        batch_size, num_outputs = old_output.size()
+
+        squared_sum = torch.zeros(self.net.nb_params)
+        chunk = self._vjp_chunk_size()
+        for start in range(0, self._sketch_size, chunk):
+            n = min(chunk, self._sketch_size - start)
+            # like SM-G-SUM every direction is the same for every element of the batch
+            directions = old_output.new_empty(n, 1, num_outputs).normal_().expand(n, batch_size, num_outputs)
+            squared_sum += self._vjps(old_output, directions).pow(2).sum(0)
+        squared_sum /= self._sketch_size
+
+        sensitivity = torch.sqrt(squared_sum)
+        sensitivity /= batch_size
 
-        copy = sensitivity.clone().detach().requires_grad_(False)
-        del old_output, jacobian, grad_output, experiences, num_outputs, sensitivity
-        return copy
+        del old_output, experiences, squared_sum
+        return sensitivity
+
+    def _vjp_chunk_size(self):
+        # the grads are stored twice, per param and concatenated
+        return max(1, self.VJP_CHUNK_BYTES // (8 * self.net.nb_params))
+
+    def _vjps(self, output, grad_outputs):
+        """
+        Vector-jacobian products of output w.r.t. the params, computed in one batched backward pass (torch >= 1.11,
+            else one backward pass per vector).
+        :param output:       output of the net, with its graph
+        :param grad_outputs: n x output size, the vectors to multiply the jacobian with
+        :return: n x nb_params tensor, in the order of self.net.parameters()
+        """
+        params = list(self.net.parameters())
+        n = grad_outputs.size(0)
+
+        grads = None
+        if self._batched_vjps and n > 1:
+            try:
+                grads = torch.autograd.grad(output, params, grad_outputs=grad_outputs,
+                                            retain_graph=True, allow_unused=True, is_grads_batched=True)
+            except (RuntimeError, TypeError) as e:
+                # not every op has a batching rule in every torch version, then do one backward pass per vector
+                logging.warning('Batched vector-jacobian products failed, one at a time: {}'.format(e))
+                self._batched_vjps = False
+        if grads is None:
+            grads = [torch.stack(g) if g[0] is not None else None for g in zip(*(
+                torch.autograd.grad(output, params, grad_outputs=grad_outputs[j], retain_graph=True, allow_unused=True)
+                for j in range(n)))]
+
+        return torch.cat([grad.detach().reshape(n, -1) if grad is not None else output.new_zeros(n, param.numel())
+                          for param, grad in zip(params, grads)], dim=1)
 
     def _calc_second_sensitivity(self):
         raise NotImplementedError
@@ -101,6 +101,16 @@ class Experiment(ABC):
     def get_trainloader(self):
         return self.trainloader
 
+    def to_batch_indices(self, batch_data):
+        """
+        Compact description of a train batch, from which from_batch_indices can rebuild it
+            (used with config.publish_batch_indices)
+        """
+        raise NotImplementedError
+
+    def from_batch_indices(self, batch_indices):
+        raise NotImplementedError
+
     def nb_offspring(self):
         return self._nb_offspring
 
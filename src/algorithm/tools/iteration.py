@@ -1,11 +1,14 @@
 import logging
+import math
 import os
+import time
 
 from abc import ABC
 
 from algorithm.policies import Policy
 from algorithm.tools.podium import Podium
 from algorithm.tools.utils import check_if_filepath_exists, Config, log
+from algorithm.tools.worker_registry import WorkerRegistry
 
 
 class Iteration(ABC):
@@ -33,14 +36,18 @@ class Iteration(ABC):
         self._nb_models_to_evaluate = 0
         self._task_results = []
         self._eval_results = {}
-        self._worker_ids = []
+        self._worker_ids = set()
         self._waiting_for_eval_run = False
+        self._generation_tstart = time.time()
 
         # ENTIRE EXPERIMENT
         self._stdev_divisor = config.stdev_divisor
         self._bs_multiplier = config.bs_multiplier
         self._patience = config.patience
         self._nb_offspring = exp['nb_offspring']
+        # close a generation early: at this fraction of the offspring, or this many seconds after it started
+        self._quorum = config.quorum
+        self._generation_deadline = config.generation_deadline
 
         self._log_dir = exp['log_dir']
         self._models_dir = os.path.join(self._log_dir, 'models')
@@ -49,6 +56,9 @@ class Iteration(ABC):
         self._podium = Podium(config.patience, os.path.join(self._models_dir, 'best'),
                               num_elites=exp['num_elites'])
 
+        # last heartbeats of the workers, a worker is dead after missing 3 of them
+        self._workers = WorkerRegistry(timeout=3 * (config.heartbeat_interval or 10.))
+
     def to_dict(self):
         return {
             'iter': self._iteration,
@@ -59,6 +69,7 @@ class Iteration(ABC):
             'times_orig_bs': self._times_orig_bs,
             'nb_samples_used': self._nb_samples_used,
             'best_elites': self.best_elites(),
+            **self._workers.to_dict(),
         }
 
     def init_from_infos(self, infos: dict):
@@ -100,6 +111,7 @@ class Iteration(ABC):
 
         log('UniqueWorkers', len(self._worker_ids))
         log('UniqueWorkersFrac', len(self._worker_ids) / len(self._task_results))
+        self._workers.log_stats()
 
     def patience_reached(self):
         return self._patience_reached
@@ -111,6 +123,16 @@ class Iteration(ABC):
         self._task_results.append(result)
         self._nb_models_to_evaluate -= 1
 
+    def record_task_results(self, results):
+        """
+        Record a batch of evolve results, only as many as are still needed in this iteration
+        :return: the nb of results that weren't needed
+        """
+        needed = results[:self.nb_models_left_to_evolve()]
+        for result in needed:
+            self.record_task_result(result)
+        return len(results) - len(needed)
+
     def record_eval_result(self, result):
         raise NotImplementedError
 
@@ -168,7 +190,7 @@ class Iteration(ABC):
     def incr_iteration(self):
         self._task_results = []
         self._eval_results = {}
-        self._worker_ids = []
+        self._worker_ids = set()
 
         self.set_nb_models_to_evaluate(self._nb_offspring)
         self.set_waiting_for_elite_ev(False)
@@ -176,7 +198,8 @@ class Iteration(ABC):
         self._schedule_reached = False
 
         self._iteration += 1
-        self._nb_samples_used += self._batch_size
+        self._nb_samples_used += self._samples_per_iteration()
+        self._generation_tstart = time.time()
 
         if self.check_schedule_limit():
             logging.warning('Next curriculum step reached; old std {}, bs: {}'
@@ -186,11 +209,49 @@ class Iteration(ABC):
             logging.warning('Next curriculum step reached; new std {}, bs: {}'
                             .format(self._noise_stdev, self.batch_size()))
 
+    def _samples_per_iteration(self):
+        # one batch per generation
+        return self._batch_size
+
     def check_schedule_limit(self):
         return self._schedule_limit and \
                self._iteration >= self._schedule_start and \
                (self._iteration - self._schedule_start) % self._schedule_limit == 0
 
+    def generation_open(self):
+        """
+        :return: whether the master should keep waiting for results of this generation. It is closed when all
+            results came in, when the quorum of offspring and all evaluations came in, or after the deadline.
+            Never before at least one offspring came in, selection and gradient estimation need it.
+        """
+        if not (self.models_left_to_evolve() or self.models_left_to_eval()):
+            return False
+        if not self._task_results:
+            return True
+        if self.deadline_passed():
+            return False
+        return not (self.quorum_reached() and not self.models_left_to_eval())
+
+    def quorum_reached(self):
+        return bool(self._quorum) and len(self._task_results) >= math.ceil(self._quorum * self._nb_offspring)
+
+    def deadline_passed(self):
+        return bool(self._generation_deadline) and \
+               time.time() - self._generation_tstart >= self._generation_deadline
+
+    def pop_timeout(self, default=0):
+        """
+        :param default: timeout without deadline, 0 means wait forever
+        :return: seconds to wait for results before checking the deadline again (whole seconds, for redis < 6)
+        """
+        if not self._generation_deadline or self.deadline_passed():
+            return default
+        left = math.ceil(self._generation_deadline - (time.time() - self._generation_tstart))
+        return min(default, left) if default else left
+
+    def nb_evals_left(self):
+        raise NotImplementedError
+
     def set_batch_size(self, value):
         self._batch_size = value
 
@@ -204,12 +265,20 @@ class Iteration(ABC):
         self._waiting_for_eval_run = value
 
     def record_worker_id(self, worker_id):
-        self._worker_ids.append(worker_id)
-        self._worker_ids = list(set(self._worker_ids))
+        self._worker_ids.add(worker_id)
+
+    def record_heartbeats(self, heartbeats: dict):
+        self._workers.update(heartbeats)
+
+    def sensitivity_reuse(self):
+        return self._workers.sensitivity_reuse()
 
     def models_left_to_evolve(self):
         return self._nb_models_to_evaluate > 0
 
+    def nb_models_left_to_evolve(self):
+        return max(self._nb_models_to_evaluate, 0)
+
     def models_left_to_eval(self):
         raise NotImplementedError
 
@@ -0,0 +1,65 @@
+import logging
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+
+class ModelCache(object):
+    """
+    Worker side LRU cache of the flat param vectors of models that were loaded from a file (or rebuilt from
+        a seed chain), so parents and elites that are used by many jobs are only loaded once per task.
+        Keys include the task id, because the master reuses the same file names every generation.
+    Bounded by the total size of the cached vectors.
+    """
+
+    def __init__(self, max_bytes):
+        self._max_bytes = max_bytes
+        self._vectors = OrderedDict()
+        self._nbytes = 0
+
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        """
+        :return: the cached param vector (don't change it in place), or None
+        """
+        vector = self._vectors.get(key)
+        if vector is None:
+            self.misses += 1
+            return None
+        self._vectors.move_to_end(key)
+        self.hits += 1
+        return vector
+
+    def put(self, key, vector):
+        """
+        :param vector: torch tensor, it is kept as is so pass a copy
+        """
+        nbytes = self._nbytes_of(vector)
+        if nbytes > self._max_bytes:
+            return
+        if key in self._vectors:
+            self._nbytes -= self._nbytes_of(self._vectors.pop(key))
+
+        # evict the least recently used vectors until the new one fits
+        while self._vectors and self._nbytes + nbytes > self._max_bytes:
+            _, evicted = self._vectors.popitem(last=False)
+            self._nbytes -= self._nbytes_of(evicted)
+
+        self._vectors[key] = vector
+        self._nbytes += nbytes
+
+    @staticmethod
+    def _nbytes_of(vector):
+        return vector.numel() * vector.element_size()
+
+    def hit_rate(self):
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.
+
+    def nbytes(self):
+        return self._nbytes
+
+    def __len__(self):
+        return len(self._vectors)
@@ -0,0 +1,43 @@
+"""
+    Seed-chain encoding of NIC-ES individuals: instead of saving every offspring to a .pth file, an individual
+    is identified by the params it descends from (its anchor) plus the (seed, sigma) mutations applied since.
+    Idea from https://github.com/uber-research/deep-neuroevolution (compact representation)
+"""
+from collections import namedtuple
+
+_seed_chain_fields = ['anchor', 'init_seed', 'mutations']
+
+
+class SeedChain(namedtuple('SeedChain', field_names=_seed_chain_fields, defaults=(None, None, ()))):
+    """
+    :param anchor:      path to a .pth file with the params the chain starts from, or None if it starts
+                        from a randomly initialized model
+    :param init_seed:   seed to generate the randomly initialized model with (only if anchor is None)
+    :param mutations:   tuple of (seed, sigma) tuples, in the order they were applied
+    """
+    __slots__ = ()
+
+    @staticmethod
+    def of(model):
+        """
+        :param model: SeedChain or str: path to a .pth file
+        """
+        if isinstance(model, SeedChain):
+            return model
+        assert isinstance(model, str), '{}'.format(type(model))
+        return SeedChain(anchor=model)
+
+    @staticmethod
+    def from_infos(infos):
+        """
+        Rebuild a SeedChain from how it is stored in a checkpoint .json (as a list)
+        """
+        anchor, init_seed, mutations = infos
+        return SeedChain(anchor=anchor, init_seed=init_seed,
+                         mutations=tuple((int(seed), float(sigma)) for seed, sigma in mutations))
+
+    def mutated(self, seed, sigma):
+        return self._replace(mutations=self.mutations + ((int(seed), float(sigma)),))
+
+    def length(self):
+        return len(self.mutations)
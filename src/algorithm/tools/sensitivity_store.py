@@ -0,0 +1,127 @@
+import logging
+import os
+import socket
+import threading
+import time
+import uuid
+
+import torch
+
+from algorithm.tools.utils import pid_alive, read_lock, remove_file_if_exists, remove_lock_if_owned
+
+logger = logging.getLogger(__name__)
+
+
+class SensitivityStore(object):
+    """
+    Sensitivity vectors shared by all workers, one file per (task_id, parent_id) in a directory on the
+        shared file system, so a lookup is a single open instead of a scan of the directory.
+    Single flight: the first worker that needs a sensitivity takes a lock file and computes it, the others
+        wait until it is written. Files are written to a tmp file and renamed, so they are never read half written.
+    The lock holds a unique host:pid:nonce token and its holder touches it while computing, so the lock of a
+        killed worker is broken once its holder is dead or the lock wasn't touched for stale_after seconds.
+    """
+
+    def __init__(self, directory, poll_interval=.5, stale_after=30.):
+        """
+        :param stale_after: seconds without a touch after which a lock is stale, the holder touches it
+                            every stale_after / 4 seconds
+        """
+        self._directory = directory
+        self._poll_interval = poll_interval
+        self._stale_after = stale_after
+
+    def path(self, task_id, parent_id):
+        return os.path.join(self._directory, 'sens_t{t}_p{p}.pt'.format(t=task_id, p=parent_id))
+
+    def get(self, task_id, parent_id):
+        """
+        :return: the stored sensitivity, or None
+        """
+        try:
+            return torch.load(self.path(task_id, parent_id))
+        except FileNotFoundError:
+            return None
+
+    def get_or_compute(self, task_id, parent_id, compute):
+        """
+        :param compute: function without arguments that computes the sensitivity, only called if no other
+                        worker is computing it
+        """
+        path = self.path(task_id, parent_id)
+        lock_path = path + '.lock'
+        token = '{}:{}:{}'.format(socket.gethostname(), os.getpid(), uuid.uuid4().hex)
+
+        while True:
+            sensitivity = self.get(task_id, parent_id)
+            if sensitivity is not None:
+                logger.info('took sensitivity from file')
+                return sensitivity
+
+            try:
+                fd = os.open(lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+                break
+            except FileExistsError:
+                # another worker is computing it, or it died and the lock is broken once stale
+                stale_token = self._stale_token(lock_path)
+                if stale_token is not None and remove_lock_if_owned(lock_path, stale_token):
+                    logger.warning('Broke stale sensitivity lock {} of {}'.format(lock_path, stale_token or '?'))
+                else:
+                    time.sleep(self._poll_interval)
+
+        os.write(fd, token.encode())
+        os.close(fd)
+        done = threading.Event()
+        toucher = threading.Thread(target=self._touch, args=(lock_path, token, done), daemon=True)
+        toucher.start()
+        try:
+            # it may have been written between the get and taking the lock
+            sensitivity = self.get(task_id, parent_id)
+            if sensitivity is not None:
+                return sensitivity
+            return self._compute_and_put(path, compute)
+        finally:
+            done.set()
+            toucher.join()
+            remove_lock_if_owned(lock_path, token)
+
+    def _touch(self, lock_path, token, done):
+        while not done.wait(self._stale_after / 4):
+            if read_lock(lock_path) != token:
+                return
+            try:
+                os.utime(lock_path)
+            except FileNotFoundError:
+                return
+
+    def _stale_token(self, lock_path):
+        """
+        :return: the token of the lock if it is stale (its holder is dead or didn't touch it for stale_after
+                 seconds), else None
+        """
+        token = read_lock(lock_path)
+        try:
+            age = time.time() - os.path.getmtime(lock_path)
+        except FileNotFoundError:
+            return None
+        if token is None:
+            return None
+
+        host, _, pid = token.partition(':')
+        pid = pid.partition(':')[0]
+        if host == socket.gethostname() and pid.isdigit() and not pid_alive(int(pid)):
+            return token
+        return token if age > self._stale_after else None
+
+    @staticmethod
+    def _compute_and_put(path, compute):
+        sensitivity = compute()
+        tmp_path = path + '.{}.tmp'.format(os.getpid())
+        try:
+            torch.save(sensitivity, tmp_path)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            # e.g. the master cleaned the directory, the other workers will compute it themselves
+            logger.warning('Could not store sensitivity {}: {}'.format(path, e))
+            remove_file_if_exists(tmp_path)
+        return sensitivity
@@ -3,6 +3,7 @@ import os
 
 from algorithm.tools.experiment import ExperimentFactory
 from algorithm.tools.iteration import IterationFactory
+from algorithm.tools.model_cache import ModelCache
 from algorithm.policies import SuppDataset, PolicyFactory
 from algorithm.tools.statistics import Statistics
 from algorithm.tools.utils import Config, mkdir_p
@@ -14,6 +15,10 @@ def setup_worker(exp):
     experiment = ExperimentFactory.create(SuppDataset(exp['dataset']), exp, config, master=False)
     policy = PolicyFactory.create(dataset=SuppDataset(exp['dataset']), exp=exp)
 
+    model_cache_mb = config.model_cache_mb if config.model_cache_mb is not None else 1024
+    if model_cache_mb:
+        policy.set_model_cache(ModelCache(max_bytes=model_cache_mb * 2 ** 20))
+
     return config, policy, experiment
 
 
@@ -6,7 +6,7 @@ import psutil
 
 import matplotlib.pyplot as plt
 
-from algorithm.tools.utils import log
+from algorithm.tools.utils import log, readable_bytes
 
 
 class Statistics(object):
@@ -33,6 +33,18 @@ class Statistics(object):
         self._it_master_mem_usages = []
 
         self._update_ratio_stats = []
+        self._reduction_time_stats = []
+        self._reduction_mem_stats = []
+        self._results_per_sec_stats = []
+        self._stale_results_stats = []
+        self._overproduced_stats = []
+        self._staleness_stats = []
+        self._dropped_offspring_stats = []
+        self._dropped_evals_stats = []
+        self._sens_reuse_stats = []
+        self._sens_time_saved_stats = []
+        self._it_nb_results = 0
+        self._it_nb_overproduced = 0
 
     def init_from_infos(self, infos):
 
@@ -46,6 +58,26 @@ class Statistics(object):
         self._mem_stats = infos['mem_stats'] if 'mem_stats' in infos else self._mem_stats
         self._update_ratio_stats = infos['update_ratio_stats'] if 'update_ratio_stats' in infos \
             else self._update_ratio_stats
+        self._reduction_time_stats = infos['reduction_time_stats'] if 'reduction_time_stats' in infos \
+            else self._reduction_time_stats
+        self._reduction_mem_stats = infos['reduction_mem_stats'] if 'reduction_mem_stats' in infos \
+            else self._reduction_mem_stats
+        self._results_per_sec_stats = infos['results_per_sec_stats'] if 'results_per_sec_stats' in infos \
+            else self._results_per_sec_stats
+        self._stale_results_stats = infos['stale_results_stats'] if 'stale_results_stats' in infos \
+            else self._stale_results_stats
+        self._overproduced_stats = infos['overproduced_stats'] if 'overproduced_stats' in infos \
+            else self._overproduced_stats
+        self._staleness_stats = infos['staleness_stats'] if 'staleness_stats' in infos \
+            else self._staleness_stats
+        self._dropped_offspring_stats = infos['dropped_offspring_stats'] if 'dropped_offspring_stats' in infos \
+            else self._dropped_offspring_stats
+        self._dropped_evals_stats = infos['dropped_evals_stats'] if 'dropped_evals_stats' in infos \
+            else self._dropped_evals_stats
+        self._sens_reuse_stats = infos['sens_reuse_stats'] if 'sens_reuse_stats' in infos \
+            else self._sens_reuse_stats
+        self._sens_time_saved_stats = infos['sens_time_saved_stats'] if 'sens_time_saved_stats' in infos \
+            else self._sens_time_saved_stats
         self._time_elapsed = infos['time_elapsed'] if 'time_elapsed' in infos else self._time_elapsed
         self._best_acc_so_far_stats = infos['best_acc_so_far_stats'] \
             if 'best_acc_so_far_stats' in infos else self._best_acc_so_far_stats
@@ -61,6 +93,16 @@ class Statistics(object):
             'bs_stats': self._bs_stats,
             'mem_stats': self._mem_stats,
             'update_ratio_stats': self._update_ratio_stats,
+            'reduction_time_stats': self._reduction_time_stats,
+            'reduction_mem_stats': self._reduction_mem_stats,
+            'results_per_sec_stats': self._results_per_sec_stats,
+            'stale_results_stats': self._stale_results_stats,
+            'overproduced_stats': self._overproduced_stats,
+            'staleness_stats': self._staleness_stats,
+            'dropped_offspring_stats': self._dropped_offspring_stats,
+            'dropped_evals_stats': self._dropped_evals_stats,
+            'sens_reuse_stats': self._sens_reuse_stats,
+            'sens_time_saved_stats': self._sens_time_saved_stats,
             'time_elapsed': self._time_elapsed,
             'best_acc_so_far_stats': self._best_acc_so_far_stats,
         }
@@ -77,9 +119,22 @@ class Statistics(object):
             'batch_size': (self._bs_stats, 'Batch size'),
             'noise_std': (self._std_stats, 'Noise stdev'),
             'reward_std': (self._score_stds, 'Score stdev'),
+            'results_per_sec': (self._results_per_sec_stats, 'Results per sec'),
+            'stale_results': (self._stale_results_stats, 'Stale results dropped'),
+            'overproduced': (self._overproduced_stats, 'Evolve results not needed'),
         }
         if self._update_ratio_stats:
             kwargs.update({'update_ratio': (self._update_ratio_stats, 'Update ratio')})
+        if self._reduction_time_stats:
+            kwargs.update({'reduction_time': (self._reduction_time_stats, 'Gradient reduction time')})
+        if self._dropped_offspring_stats:
+            kwargs.update({'dropped_offspring': (self._dropped_offspring_stats, 'Offspring missing at close'),
+                           'dropped_evals': (self._dropped_evals_stats, 'Evaluations missing at close')})
+        if self._staleness_stats:
+            kwargs.update({'staleness': (self._staleness_stats, 'Mean staleness of results')})
+        if self._sens_reuse_stats:
+            kwargs.update({'sens_reuse': (self._sens_reuse_stats, 'Sensitivities reused'),
+                           'sens_time_saved': (self._sens_time_saved_stats, 'Sensitivity time saved')})
         self._plot(log_dir, self._score_stats, **kwargs)
 
     @staticmethod
@@ -112,11 +167,28 @@ class Statistics(object):
 
         if self._update_ratio_stats:
             log('UpdateRatio', self._update_ratio_stats[-1])
+        if self._reduction_time_stats:
+            log('ReductionTime', self._reduction_time_stats[-1])
+            log('ReductionMem', readable_bytes(self._reduction_mem_stats[-1]))
 
         step_tend = time.time()
         log('TimeElapsedThisIter', step_tend - self._step_tstart)
         log('TimeElapsed', self._time_elapsed)
         log('MemUsage', self._mem_stats[1][-1])
+        if self._results_per_sec_stats:
+            log('ResultsPerSec', self._results_per_sec_stats[-1])
+        if self._stale_results_stats:
+            log('StaleResults', self._stale_results_stats[-1])
+        if self._overproduced_stats:
+            log('Overproduced', self._overproduced_stats[-1])
+        if self._dropped_offspring_stats:
+            log('DroppedOffspring', self._dropped_offspring_stats[-1])
+            log('DroppedEvals', self._dropped_evals_stats[-1])
+        if self._staleness_stats:
+            log('Staleness', self._staleness_stats[-1])
+        if self._sens_reuse_stats:
+            log('SensitivityReuse', self._sens_reuse_stats[-1])
+            log('SensitivityTimeSaved', self._sens_time_saved_stats[-1])
 
     def record_score_stats(self, scores: np.ndarray):
         """
@@ -155,6 +227,49 @@ class Statistics(object):
 
         self._it_worker_mem_usages.update({worker_id: value})
 
+    def reset_it_results(self):
+        self._it_nb_results = 0
+        self._it_nb_overproduced = 0
+
+    def record_it_results(self, nb_results):
+        self._it_nb_results += nb_results
+
+    def record_it_overproduced(self, nb_results):
+        self._it_nb_overproduced += nb_results
+
+    def record_results_per_sec_stats(self):
+        # call after record_step_time_stats
+        step_time = self._time_stats[-1]
+        self._results_per_sec_stats.append(self._it_nb_results / step_time if step_time > 0 else 0.)
+
+    def record_overproduced_stats(self):
+        self._overproduced_stats.append(self._it_nb_overproduced)
+
+    def record_stale_results(self, nb_stale_results):
+        self._stale_results_stats.append(nb_stale_results)
+
+    def record_staleness_stats(self, staleness: np.ndarray):
+        """
+        :param staleness: per result used in the update, the nb of updates since its task
+        """
+        self._staleness_stats.append(float(np.mean(staleness)) if len(staleness) else 0.)
+
+    def record_dropped_stats(self, nb_offspring, nb_evals):
+        """
+        :param nb_offspring: nb of offspring results still missing when the generation was closed
+        :param nb_evals: nb of elite evaluations still missing when the generation was closed
+        """
+        self._dropped_offspring_stats.append(nb_offspring)
+        self._dropped_evals_stats.append(nb_evals)
+
+    def record_sensitivity_reuse_stats(self, reuse_rate, time_saved):
+        """
+        :param reuse_rate: fraction of the sensitivities needed by the workers that were reused
+        :param time_saved: total seconds of sensitivity computation the workers saved by reusing
+        """
+        self._sens_reuse_stats.append(reuse_rate)
+        self._sens_time_saved_stats.append(time_saved)
+
     def record_it_master_mem_usage(self, master_mem_usage):
         self._it_master_mem_usages.append(master_mem_usage)
 
@@ -171,6 +286,14 @@ class Statistics(object):
     def record_update_ratio(self, update_ratio):
         self._update_ratio_stats.append(update_ratio)
 
+    def record_reduction_stats(self, nbytes, time_spent):
+        """
+        :param nbytes: memory held by the buffers the gradient estimate is computed from
+        :param time_spent: seconds spent computing the gradient estimate from these buffers
+        """
+        self._reduction_mem_stats.append(nbytes)
+        self._reduction_time_stats.append(time_spent)
+
     def set_step_tstart(self):
         self._step_tstart = time.time()
 
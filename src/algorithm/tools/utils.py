@@ -6,6 +6,7 @@ import os
 import re
 import shutil
 import sys
+import uuid
 import torch
 from collections import namedtuple
 
@@ -15,7 +16,16 @@ config_fields = [
     'l2coeff', 'noise_stdev', 'stdev_divisor', 'eval_prob', 'snapshot_freq', 'log_dir',
     'batch_size', 'patience', 'val_batch_size', 'num_val_batches',
     'num_val_items', 'cuda', 'max_nb_iterations', 'ref_batch_size', 'bs_multiplier', 'stepsize_divisor',
-    'single_batch', 'schedule_limit', 'schedule_start'
+    'single_batch', 'schedule_limit', 'schedule_start', 'seed_chain', 'seed_chain_max_length',
+    'noise_table_size', 'noise_table_seed', 'accumulator_memmap_dir',
+    'result_batch_size',
+    'publish_batch_indices',
+    'token_timeout',
+    'steady_state', 'steady_state_publish_every',
+    'async_nes', 'async_update_every', 'async_max_staleness',
+    'quorum', 'generation_deadline',
+    'heartbeat_interval',
+    'model_cache_mb'
 ]
 Config = namedtuple('Config', field_names=config_fields, defaults=(None,) * len(config_fields))
 
@@ -140,6 +150,51 @@ def remove_file_if_exists(path):
         pass
 
 
+def pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        # exists, but belongs to another user
+        return True
+    return True
+
+
+def read_lock(lock_path):
+    """
+    :return: the token in a lock file, '' if its holder didn't write it yet, None if there is no lock
+    """
+    try:
+        with open(lock_path) as f:
+            return f.read()
+    except FileNotFoundError:
+        return None
+
+
+def remove_lock_if_owned(lock_path, token):
+    """
+    Remove a lock file only if it still holds token. It is first renamed to a path of this process, so it can't
+        be replaced between the check and the removal, and put back if it turns out to be another one.
+    :return: whether the lock was removed
+    """
+    own_path = '{}.{}.{}'.format(lock_path, os.getpid(), uuid.uuid4().hex)
+    try:
+        os.rename(lock_path, own_path)
+    except FileNotFoundError:
+        return False
+
+    owned = read_lock(own_path) == token
+    if not owned:
+        try:
+            os.link(own_path, lock_path)
+        except FileExistsError:
+            # yet another lock was taken meanwhile, its holder computes the same thing
+            pass
+    remove_file_if_exists(own_path)
+    return owned
+
+
 def remove_file_with_pattern(pattern, directory):
     for file in os.listdir(directory):
         if re.search(pattern, file):
@@ -0,0 +1,158 @@
+import logging
+import os
+import socket
+import time
+from collections import namedtuple
+
+import psutil
+
+from algorithm.tools.utils import log, readable_bytes
+
+logger = logging.getLogger(__name__)
+
+heartbeat_fields = ['host', 'pid', 'worker_id', 'jobs_done', 'evolve_jobs', 'eval_jobs', 'avg_evolve_time',
+                    'avg_eval_time', 'rss', 'time', 'model_cache_hits', 'model_cache_misses',
+                    'sensitivities_reused', 'sensitivities_computed', 'sensitivity_time_saved']
+Heartbeat = namedtuple('Heartbeat', field_names=heartbeat_fields, defaults=(None,) * len(heartbeat_fields))
+
+
+class HeartbeatSender(object):
+    """
+    Worker side: counts the jobs of this worker and how long they take, and sends a heartbeat
+        with these counts to the master every interval seconds
+    """
+
+    def __init__(self, worker, worker_id, interval=10., model_cache=None, sensitivity=None):
+        """
+        :param worker: WorkerTransport
+        :param model_cache: ModelCache of the worker, if it has one
+        :param sensitivity: Sensitivity of the net of the worker, if it uses safe mutations
+        """
+        self._worker = worker
+        self._model_cache = model_cache
+        self._sensitivity = sensitivity
+        self._key = '{}:{}'.format(socket.gethostname(), os.getpid())
+        self._worker_id = worker_id
+        self._interval = interval
+
+        self._evolve_jobs, self._eval_jobs = 0, 0
+        # job durations since the last heartbeat
+        self._evolve_times, self._eval_times = [], []
+        self._avg_evolve_time, self._avg_eval_time = None, None
+        self._last_beat = 0.
+
+    def record_job(self, evolve, duration):
+        if evolve:
+            self._evolve_jobs += 1
+            self._evolve_times.append(duration)
+        else:
+            self._eval_jobs += 1
+            self._eval_times.append(duration)
+
+    def beat(self):
+        """
+        Send a heartbeat if the last one is older than the interval, cheap to call after every job
+        """
+        now = time.time()
+        if now - self._last_beat < self._interval:
+            return
+        self._last_beat = now
+
+        # averages over the jobs since the last heartbeat, or the previous ones if there were none
+        if self._evolve_times:
+            self._avg_evolve_time = sum(self._evolve_times) / len(self._evolve_times)
+        if self._eval_times:
+            self._avg_eval_time = sum(self._eval_times) / len(self._eval_times)
+        self._evolve_times, self._eval_times = [], []
+
+        host, pid = self._key.rsplit(':', 1)
+        self._worker.heartbeat(self._key, Heartbeat(
+            host=host,
+            pid=int(pid),
+            worker_id=self._worker_id,
+            jobs_done=self._evolve_jobs + self._eval_jobs,
+            evolve_jobs=self._evolve_jobs,
+            eval_jobs=self._eval_jobs,
+            avg_evolve_time=self._avg_evolve_time,
+            avg_eval_time=self._avg_eval_time,
+            rss=psutil.Process(os.getpid()).memory_info().rss,
+            time=now,
+            model_cache_hits=self._model_cache.hits if self._model_cache else None,
+            model_cache_misses=self._model_cache.misses if self._model_cache else None,
+            sensitivities_reused=self._sensitivity.nb_reused if self._sensitivity else None,
+            sensitivities_computed=self._sensitivity.nb_computed if self._sensitivity else None,
+            sensitivity_time_saved=self._sensitivity.time_saved if self._sensitivity else None,
+        ))
+
+
+class WorkerRegistry(object):
+    """
+    Master side: the last heartbeat of every worker (by host:pid), and the rate at which it produced
+        results between its last two heartbeats. Workers without a heartbeat for timeout seconds
+        are considered dead.
+    """
+
+    def __init__(self, timeout=60.):
+        self._timeout = timeout
+        # key --> (Heartbeat, results per sec, time the heartbeat was received)
+        self._workers = {}
+
+    def update(self, heartbeats: dict):
+        """
+        :param heartbeats: dict with the last Heartbeat of every worker, by key
+        """
+        now = time.time()
+        for key, heartbeat in heartbeats.items():
+            prev = self._workers.get(key)
+            if prev is None or heartbeat.jobs_done < prev[0].jobs_done:
+                # new worker, or a new process that got the pid of a dead one
+                self._workers[key] = (heartbeat, None, now)
+            elif heartbeat.time != prev[0].time:
+                # worker clocks may differ from the master's, rates are computed with the worker's own clock
+                rate = (heartbeat.jobs_done - prev[0].jobs_done) / (heartbeat.time - prev[0].time)
+                self._workers[key] = (heartbeat, rate, now)
+
+    def alive(self):
+        now = time.time()
+        return {key: (hb, rate) for key, (hb, rate, received) in self._workers.items()
+                if now - received < self._timeout}
+
+    def est_evolve_per_sec(self):
+        """
+        :return: nb of evolve jobs per sec the alive workers can do together, based on their average job times
+        """
+        return sum(1. / hb.avg_evolve_time for hb, _ in self.alive().values() if hb.avg_evolve_time)
+
+    def sensitivity_reuse(self):
+        """
+        :return: (fraction of the sensitivities the alive workers needed that they reused, seconds of computation
+                 that saved them in total), or None if they didn't need any
+        """
+        alive = self.alive().values()
+        reused = sum(hb.sensitivities_reused or 0 for hb, _ in alive)
+        computed = sum(hb.sensitivities_computed or 0 for hb, _ in alive)
+        if not reused + computed:
+            return None
+        return reused / (reused + computed), sum(hb.sensitivity_time_saved or 0. for hb, _ in alive)
+
+    def log_stats(self):
+        alive = self.alive()
+        log('AliveWorkers', len(alive))
+        log('EstEvolvePerSec', self.est_evolve_per_sec())
+        hits = sum(hb.model_cache_hits or 0 for hb, _ in alive.values())
+        misses = sum(hb.model_cache_misses or 0 for hb, _ in alive.values())
+        if hits + misses:
+            log('ModelCacheHitRate', hits / (hits + misses))
+
+        by_time = sorted(((hb.avg_evolve_time, key) for key, (hb, _) in alive.items() if hb.avg_evolve_time),
+                         reverse=True)
+        for avg_evolve_time, key in by_time[:3]:
+            hb, rate = alive[key]
+            logger.info('Slow worker {}: {:.2f}s per evolve job, {} jobs, {:.2f} jobs/s, rss {}'
+                        .format(key, avg_evolve_time, hb.jobs_done, rate or 0., readable_bytes(hb.rss)))
+
+    def to_dict(self):
+        return {
+            'workers': {key: {**hb._asdict(), 'jobs_per_sec': rate}
+                        for key, (hb, rate, _) in self._workers.items()},
+        }
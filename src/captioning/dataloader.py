@@ -112,8 +112,11 @@ class DataLoader(data.Dataset):
         import atexit
         atexit.register(cleanup)
 
-    def get_captions(self, ix, seq_per_img):
-        # fetch the sequence labels
+    def get_caption_ix(self, ix, seq_per_img):
+        """
+        Randomly pick seq_per_img captions of image ix
+        :return: numpy array with the seq_per_img rows of the picked captions in the labels h5 file
+        """
         ix1 = self.label_start_ix[ix] - 1  # label_start_ix starts from 1
         ix2 = self.label_end_ix[ix] - 1
         ncap = ix2 - ix1 + 1  # number of captions available for this image
@@ -122,15 +125,20 @@ class DataLoader(data.Dataset):
 
         if ncap < seq_per_img:
             # we need to subsample (with replacement)
-            seq = np.zeros([seq_per_img, self.seq_length], dtype='int')
-            for q in range(seq_per_img):
-                ixl = random.randint(ix1, ix2)
-                seq[q, :] = self.h5_label_file['labels'][ixl, :self.seq_length]
+            return np.array([random.randint(ix1, ix2) for _ in range(seq_per_img)])
         else:
             ixl = random.randint(ix1, ix2 - seq_per_img + 1)
-            seq = self.h5_label_file['labels'][ixl: ixl + seq_per_img, :self.seq_length]
+            return np.arange(ixl, ixl + seq_per_img)
 
-        return seq
+    def get_captions(self, ix, seq_per_img, label_ix=None):
+        # fetch the sequence labels
+        if label_ix is None:
+            label_ix = self.get_caption_ix(ix, seq_per_img)
+
+        labels = self.h5_label_file['labels']
+        if np.all(np.diff(label_ix) == 1):
+            return labels[label_ix[0]: label_ix[-1] + 1, :self.seq_length]
+        return np.stack([labels[ixl, :self.seq_length] for ixl in label_ix])
 
     def get_batch(self, split, batch_size=None, seq_per_img=None):
         batch_size = batch_size or self.batch_size
@@ -138,32 +146,54 @@ class DataLoader(data.Dataset):
 
         fc_batch = []  # np.ndarray((batch_size * seq_per_img, self.opt.fc_feat_size), dtype = 'float32')
         # att_batch = []  # np.ndarray((batch_size * seq_per_img, 14, 14, self.opt.att_feat_size), dtype = 'float32')
-        label_batch = np.zeros([batch_size * seq_per_img, self.seq_length + 2], dtype='int')
-        # mask_batch = np.zeros([batch_size * seq_per_img, self.seq_length + 2], dtype='float32')
+        ixs, label_ixs = [], []
 
         wrapped = False
 
-        infos = []
-        gts = []
-
         for i in range(batch_size):
             # fetch image
             tmp_fc, tmp_att, ix, tmp_wrapped = self._prefetch_process[split].get()
             fc_batch.append(tmp_fc)
             # att_batch.append(tmp_att)
-
-            label_batch[i * seq_per_img: (i + 1) * seq_per_img, 1: self.seq_length + 1] = \
-                self.get_captions(ix, seq_per_img)
+            ixs.append(ix)
+            label_ixs.append(self.get_caption_ix(ix, seq_per_img))
 
             if tmp_wrapped:
                 wrapped = True
 
+        return self._collate(split, fc_batch, ixs, label_ixs, wrapped)
+
+    def get_batch_from_indices(self, split, ixs, label_ixs):
+        """
+        Rebuild a batch that was taken by get_batch (possibly by another process) from the images and
+            captions it contains, as recorded in its infos
+        :param ixs:         image index of every image in the batch
+        :param label_ixs:   for every image, the rows of its captions in the labels h5 file
+        """
+        fc_batch = [self[ix][0] for ix in ixs]
+        return self._collate(split, fc_batch, ixs, label_ixs, False)
+
+    def _collate(self, split, fc_batch, ixs, label_ixs, wrapped):
+        batch_size = len(ixs)
+        seq_per_img = len(label_ixs[0])
+
+        label_batch = np.zeros([batch_size * seq_per_img, self.seq_length + 2], dtype='int')
+        # mask_batch = np.zeros([batch_size * seq_per_img, self.seq_length + 2], dtype='float32')
+
+        infos = []
+        gts = []
+
+        for i, (ix, label_ix) in enumerate(zip(ixs, label_ixs)):
+            label_batch[i * seq_per_img: (i + 1) * seq_per_img, 1: self.seq_length + 1] = \
+                self.get_captions(ix, seq_per_img, label_ix=label_ix)
+
             # Used for reward evaluation
             gts.append(self.h5_label_file['labels'][self.label_start_ix[ix] - 1: self.label_end_ix[ix]])
 
             # record associated info as well
             info_dict = {}
             info_dict['ix'] = ix
+            info_dict['label_ix'] = label_ix
             info_dict['id'] = self.info['images'][ix]['id']
             info_dict['file_path'] = self.info['images'][ix]['file_path']
             infos.append(info_dict)
@@ -1,5 +1,6 @@
 from collections import namedtuple
 
+import numpy as np
 import torch
 
 from algorithm.tools.experiment import Experiment
@@ -48,6 +49,15 @@ class MSCocoExperiment(Experiment):
     def take_ref_batch(self, batch_size):
         return self.trainloader.take_ref_batch(bs=batch_size)
 
+    def to_batch_indices(self, batch_data):
+        return {
+            'ix': np.array([info['ix'] for info in batch_data['infos']]),
+            'label_ix': np.stack([info['label_ix'] for info in batch_data['infos']]),
+        }
+
+    def from_batch_indices(self, batch_indices):
+        return self.trainloader.from_indices(batch_indices['ix'], batch_indices['label_ix'])
+
 
 class MSCocoDataLdrWrapper:
     """
@@ -78,5 +88,8 @@ class MSCocoDataLdrWrapper:
     def __len__(self):
         return self.loader.length_of_split(self.split) // self.loader.batch_size
 
+    def from_indices(self, ixs, label_ixs):
+        return self.loader.get_batch_from_indices(self.split, ixs, label_ixs)
+
     def take_ref_batch(self, bs):
         return torch.from_numpy(self.loader.get_batch(self.split, batch_size=bs)['fc_feats'])
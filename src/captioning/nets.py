@@ -95,6 +95,10 @@ class LSTMCore(nn.Module):
             self.h2h_ln = nn.LayerNorm(5 * self.rnn_size, elementwise_affine=opt.layer_n_affine)
             self.c_ln = nn.LayerNorm(self.rnn_size, elementwise_affine=opt.layer_n_affine)
 
+        # [i2h | h2h] weights and i2h + h2h biases of the fused step, not params (refreshed by fuse_weights)
+        self._fused_weight = None
+        self._fused_bias = None
+
     def forward(self, xt, state):
         if self.vbn:
             xt_i2h = self.i2h_bn(self.i2h(xt))
@@ -133,6 +137,49 @@ class LSTMCore(nn.Module):
         state = (next_h.unsqueeze(0), next_c.unsqueeze(0))
         return output, state
 
+    def fuse_weights(self):
+        """
+        Copy the current i2h and h2h params to the combined weights of forward_fused, call after every change
+            of the params
+        """
+        weight = self.i2h.weight
+        if self._fused_weight is None or self._fused_weight.device != weight.device \
+                or self._fused_weight.dtype != weight.dtype:
+            self._fused_weight = weight.new_empty(5 * self.rnn_size, self.input_encoding_size + self.rnn_size)
+            self._fused_bias = weight.new_empty(5 * self.rnn_size)
+        self._fused_weight[:, :self.input_encoding_size].copy_(self.i2h.weight)
+        self._fused_weight[:, self.input_encoding_size:].copy_(self.h2h.weight)
+        torch.add(self.i2h.bias, self.h2h.bias, out=self._fused_bias)
+
+    def forward_fused(self, xt, h, c, xh, gates, tmp):
+        """
+        Same as forward (without vbn or layer norm, without autograd), with one matmul over the concatenated
+            input and hidden state and without allocations: the next state is written over the current one.
+            All buffers are contiguous, older torch versions don't support non-contiguous out= tensors.
+        :param xt:    B x input_encoding_size
+        :param h:     B x rnn_size, replaced by the next h
+        :param c:     B x rnn_size, replaced by the next c
+        :param xh:    B x (input_encoding_size + rnn_size) buffer for xt followed by h
+        :param gates: B x 5 * rnn_size buffer
+        :param tmp:   B x rnn_size buffer
+        :return: the next h
+        """
+        xh[:, :self.input_encoding_size].copy_(xt)
+        xh[:, self.input_encoding_size:].copy_(h)
+        torch.addmm(self._fused_bias, xh, self._fused_weight.t(), out=gates)
+        sigmoid_chunk = gates[:, :3 * self.rnn_size].sigmoid_()
+
+        in_gate = sigmoid_chunk[:, :self.rnn_size]
+        forget_gate = sigmoid_chunk[:, self.rnn_size:2 * self.rnn_size]
+        out_gate = sigmoid_chunk[:, 2 * self.rnn_size:]
+
+        in_transform = torch.max(gates[:, 3 * self.rnn_size:4 * self.rnn_size], gates[:, 4 * self.rnn_size:],
+                                 out=tmp)
+
+        c.mul_(forget_gate).addcmul_(in_gate, in_transform)
+        torch.mul(out_gate, torch.tanh(c, out=tmp), out=h)
+        return h
+
 
 class FCModel(CaptionModel):
     def __init__(self, rng_state=None, from_param_file=None, grad=False, options=None, vbn=False):
@@ -173,6 +220,9 @@ class FCModel(CaptionModel):
             # ]))
             # self.core = torch.nn.Sequential(self.core, self.core_bn)
 
+        # buffers of greedy decoding, reused by all rollouts with the same batch size
+        self._decoding_buffers = None
+
         self.initialize_params()
 
     def init_hidden(self, bsz):
@@ -181,6 +231,8 @@ class FCModel(CaptionModel):
                 weight.new_zeros(self.num_layers, bsz, self.rnn_size))
 
     def _sample(self, fc_feats, greedy=True):
+        if greedy and not self._normalized() and not torch.is_grad_enabled():
+            return self._sample_greedy_fused(fc_feats)
 
         # we assume model is on single device
         device = next(self.parameters()).device
@@ -243,3 +295,87 @@ class FCModel(CaptionModel):
                     break
 
         return seq, seq_logprobs
+
+    def _sample_greedy_fused(self, fc_feats):
+        """
+        Same as _sample with greedy decoding, with the fused LSTM step and buffers that are allocated once per
+            batch size instead of every step. Only the sequences that are returned are new tensors.
+        Rows that finished are dropped: the n unfinished rows are compacted to the first n rows of the buffers,
+            so later steps only decode them. The positions after the end of a sequence are left 0 (instead of
+            the masked continuation of the full batch decoding), the fitness criteria mask them out anyway.
+        """
+        batch_size = fc_feats.size(0)
+        buffers = self._get_decoding_buffers(fc_feats)
+        xt, h, c = buffers['xt'], buffers['h'], buffers['c']
+        xh, gates, tmp = buffers['xh'], buffers['gates'], buffers['tmp']
+        logits, lse, sample_logprobs = buffers['logits'], buffers['lse'], buffers['sample_logprobs']
+        it, unfinished = buffers['it'], buffers['unfinished']
+
+        self.core.fuse_weights()
+        h.zero_()
+        c.zero_()
+        seq = fc_feats.new_zeros(batch_size, self.seq_length, dtype=torch.long)
+        seq_logprobs = fc_feats.new_zeros(batch_size, self.seq_length)
+
+        # rows[i] is the row in seq of the i'th row of the buffers
+        rows = torch.arange(batch_size, device=fc_feats.device)
+        n = batch_size
+        for t in range(self.seq_length + 2):
+            # the first n rows of the buffers are contiguous, so they can be used as out= tensors
+            if t == 0:
+                torch.addmm(self.img_embed.bias, fc_feats, self.img_embed.weight.t(), out=xt)
+            else:
+                if t == 1:  # input <bos>
+                    it.zero_()
+                torch.index_select(self.embed.weight, 0, it[:n], out=xt[:n])
+
+            output = self.core.forward_fused(xt[:n], h[:n], c[:n], xh[:n], gates[:n], tmp[:n])
+            if t == self.seq_length + 1:  # skip if we achieve maximum length
+                break
+
+            # the logprob of the greedy word is its logit minus the logsumexp of the logits
+            torch.addmm(self.logit.bias, output, self.logit.weight.t(), out=logits[:n])
+            torch.max(logits[:n], 1, out=(sample_logprobs[:n], it[:n]))
+            sample_logprobs[:n].sub_(torch.logsumexp(logits[:n], 1, out=lse[:n]))
+
+            if t >= 1:
+                seq[:, t - 1].index_copy_(0, rows, it[:n])  # seq[t] the input of t+2 time step
+                seq_logprobs[:, t - 1].index_copy_(0, rows, sample_logprobs[:n])
+
+                # stop when all finished, else only keep decoding the unfinished rows
+                torch.gt(it[:n], 0, out=unfinished[:n])
+                nb_unfinished = int(unfinished[:n].sum())
+                if nb_unfinished == 0:
+                    break
+                if nb_unfinished < n:
+                    keep = unfinished[:n].nonzero().squeeze(1)
+                    rows = rows[keep]
+                    h[:nb_unfinished] = h[keep]
+                    c[:nb_unfinished] = c[keep]
+                    it[:nb_unfinished] = it[keep]
+                    n = nb_unfinished
+
+        return seq, seq_logprobs
+
+    def _get_decoding_buffers(self, fc_feats):
+        batch_size = fc_feats.size(0)
+        if self._decoding_buffers is None or self._decoding_buffers['xh'].size(0) != batch_size \
+                or self._decoding_buffers['xh'].device != fc_feats.device:
+            self._decoding_buffers = {
+                'xt': fc_feats.new_empty(batch_size, self.input_encoding_size),
+                'h': fc_feats.new_empty(batch_size, self.rnn_size),
+                'xh': fc_feats.new_empty(batch_size, self.input_encoding_size + self.rnn_size),
+                'c': fc_feats.new_empty(batch_size, self.rnn_size),
+                'gates': fc_feats.new_empty(batch_size, 5 * self.rnn_size),
+                'tmp': fc_feats.new_empty(batch_size, self.rnn_size),
+                'logits': fc_feats.new_empty(batch_size, self.vocab_size + 1),
+                'lse': fc_feats.new_empty(batch_size),
+                'sample_logprobs': fc_feats.new_empty(batch_size),
+                'it': fc_feats.new_empty(batch_size, dtype=torch.long),
+                # comparisons give uint8 tensors before torch 1.2
+                'unfinished': fc_feats.new_empty(batch_size, dtype=torch.uint8),
+            }
+        return self._decoding_buffers
+
+    def _normalized(self):
+        return bool(self.vbn_e or self.core.vbn or self.core.layer_n)
@@ -6,28 +6,141 @@
 import logging
 import os
 import pickle
+import struct
+import sys
+import threading
 import time
+from abc import ABC, abstractmethod
 from collections import deque
 from pprint import pformat
 
 import redis
 
+if sys.version_info < (3, 8):
+    try:
+        import pickle5 as pickle
+    except ImportError:
+        pass
+
 logger = logging.getLogger(__name__)
 
 EXP_KEY = 'nic:exp'
 TASK_ID_KEY = 'nic:task_id'
+# results of tasks older than this one are stale
+OLDEST_TASK_ID_KEY = 'nic:oldest_task_id'
 TASK_DATA_KEY = 'nic:task_data'
 TASK_CHANNEL = 'nic:task_channel'
+# the relay announces new tasks to the workers on its node on this channel
+LOCAL_TASK_CHANNEL = 'nic:local_task_channel'
 RESULTS_KEY = 'nic:results'
+# nb of results relays dropped because they were for an old task
+STALE_RESULTS_KEY = 'nic:stale_results'
+# work tokens of a task: a counter of evolve jobs left, and a list of indices of candidates left to evaluate
+EVOLVE_TOKENS_KEY = 'nic:evolve_tokens:{}'
+EVAL_TOKENS_KEY = 'nic:eval_tokens:{}'
+TOKENS_TTL = 24 * 60 * 60
+# claim an evolve token only if there is one left, check and decrement in one atomic step, so a reissue of the
+# tokens can't come in between and a missing (expired) key isn't recreated without TTL
+CLAIM_EVOLVE_TOKEN_SCRIPT = """
+local tokens = tonumber(redis.call('GET', KEYS[1]))
+if tokens == nil or tokens <= 0 then
+    return 0
+end
+redis.call('DECR', KEYS[1])
+return 1
+"""
+# give an evolve token back only if the tokens of the task weren't expired
+RELEASE_EVOLVE_TOKEN_SCRIPT = """
+if redis.call('EXISTS', KEYS[1]) == 1 then
+    redis.call('INCR', KEYS[1])
+end
+return 0
+"""
 ARCHIVE_KEY = 'nic:archive'
+# hash with the last heartbeat of every worker, by host:pid
+WORKERS_KEY = 'nic:workers'
+
+
+# Wire format, version 1:
+#   header: magic (4 bytes), version (1 byte), nb of buffers n (uint32), length of pickled body (uint64)
+#           followed by n buffer lengths (uint64 each)
+#   pickled body (pickle protocol 5, numpy arrays pickled out-of-band)
+#   n raw buffers, each one starting at an offset aligned to WIRE_ALIGN bytes
+# Without pickle protocol 5 (python < 3.8 without the pickle5 backport), messages are plain pickles.
+WIRE_MAGIC = b'NIC\x00'
+WIRE_VERSION = 1
+WIRE_ALIGN = 8
+_WIRE_HEADER = struct.Struct('<4sBIQ')
+_OUT_OF_BAND = hasattr(pickle, 'PickleBuffer')
+
+
+def _padding(offset):
+    return -offset % WIRE_ALIGN
 
 
 def serialize(x):
-    return pickle.dumps(x, protocol=-1)
+    if not _OUT_OF_BAND:
+        return pickle.dumps(x, protocol=-1)
+
+    buffers = []
+    body = pickle.dumps(x, protocol=5, buffer_callback=buffers.append)
+    raws = [b.raw() for b in buffers]
+
+    parts = [_WIRE_HEADER.pack(WIRE_MAGIC, WIRE_VERSION, len(raws), len(body)),
+             struct.pack('<{}Q'.format(len(raws)), *(r.nbytes for r in raws)),
+             body]
+    offset = sum(len(part) for part in parts)
+    for raw in raws:
+        parts.append(b'\x00' * _padding(offset))
+        parts.append(raw)
+        offset += _padding(offset) + raw.nbytes
+    return b''.join(parts)
 
 
 def deserialize(x):
-    return pickle.loads(x)
+    """
+    Numpy arrays in the message are decoded as read-only views on x, without copying
+    :param x: bytes or other bytes-like object
+    """
+    view = memoryview(x)
+    if bytes(view[:len(WIRE_MAGIC)]) != WIRE_MAGIC:
+        # plain pickle, from a sender without protocol 5 support
+        return pickle.loads(x)
+
+    _, version, nb_buffers, body_length = _WIRE_HEADER.unpack_from(x)
+    if version != WIRE_VERSION:
+        raise ValueError('Unsupported wire format version {}'.format(version))
+    offset = _WIRE_HEADER.size
+    lengths = struct.unpack_from('<{}Q'.format(nb_buffers), x, offset)
+    offset += 8 * nb_buffers
+
+    body = view[offset:offset + body_length]
+    offset += body_length
+    buffers = []
+    for length in lengths:
+        offset += _padding(offset)
+        buffers.append(view[offset:offset + length])
+        offset += length
+    return pickle.loads(body, buffers=buffers)
+
+
+# results are prefixed with the id of their task, so they can be dropped when stale without deserializing them
+_RESULT_HEADER = struct.Struct('<q')
+
+
+def serialize_result(task_id, result):
+    return _RESULT_HEADER.pack(task_id) + serialize((task_id, result))
+
+
+def result_task_id(x):
+    return _RESULT_HEADER.unpack_from(x)[0]
+
+
+def deserialize_result(x):
+    """
+    :return: (task_id, result)
+    """
+    return deserialize(memoryview(x)[_RESULT_HEADER.size:])
 
 
 def retry_connect(redis_cfg, tries=300, base_delay=4.):
@@ -65,33 +178,237 @@ def retry_get(pipe, key, tries=300, base_delay=4.):
     raise RuntimeError('{} not set'.format(key))
 
 
-class MasterClient:
+def pop_batch(r, key, max_n, timeout=0):
+    """
+    Pop up to max_n elements from list key: a blocking pop for the first one, and the rest
+        in one pipelined LRANGE + LTRIM round trip
+    :param timeout: seconds to wait for the first element, 0 means wait forever
+    :return: list of popped elements, empty if timed out
+    """
+    first = r.blpop(key, timeout=timeout)
+    if first is None:
+        return []
+    return [first[1]] + drain(r, key, max_n - 1)
+
+
+def drain(r, key, max_n):
+    """
+    Pop up to max_n elements from list key without blocking, in one pipelined LRANGE + LTRIM round trip
+    """
+    if max_n <= 0:
+        return []
+    popped, _ = r.pipeline().lrange(key, 0, max_n - 1).ltrim(key, max_n, -1).execute()
+    return popped
+
+
+class MasterTransport(ABC):
+    """
+    Master side of the communication between master and workers: broadcasts tasks and collects results
+    """
+
+    @abstractmethod
+    def declare_experiment(self, exp):
+        raise NotImplementedError
+
+    @abstractmethod
+    def declare_task(self, task_data, tokens=None):
+        """
+        :param tokens: optionally (nb_evolve, eval_indices), the work tokens to issue for the task (see issue_tokens)
+                       before workers can see it
+        :return: the id of the new task
+        """
+        raise NotImplementedError
+
+    @abstractmethod
+    def pop_result(self):
+        """
+        :return: (task_id, result), waits until there is one
+        """
+        raise NotImplementedError
+
+    @abstractmethod
+    def pop_results(self, max_n, timeout=0):
+        """
+        Results of tasks older than allowed by set_max_staleness are dropped, and counted in pop_stale_count
+        :param timeout: seconds to wait for a first result, 0 means wait forever
+        :return: list of up to max_n (task_id, result), empty if timed out or all results were stale
+        """
+        raise NotImplementedError
+
+    @abstractmethod
+    def pop_stale_count(self):
+        """
+        :return: the nb of stale results dropped since the last call
+        """
+        raise NotImplementedError
+
+    @abstractmethod
+    def set_max_staleness(self, max_staleness):
+        """
+        Keep accepting results of the max_staleness tasks declared before the current one (default 0)
+        """
+        raise NotImplementedError
+
+    @abstractmethod
+    def issue_tokens(self, task_id, nb_evolve, eval_indices):
+        """
+        (Re)set the work that workers can claim for a task, replacing the tokens that are left
+        :param nb_evolve:       nb of evolve jobs
+        :param eval_indices:    indices of the candidates to evaluate, one eval job per index
+        """
+        raise NotImplementedError
+
+    @abstractmethod
+    def flush_results(self):
+        """
+        Throw away all results waiting to be popped
+        :return: the nb of results thrown away
+        """
+        raise NotImplementedError
+
+    @abstractmethod
+    def add_to_novelty_archive(self, novelty_vector):
+        raise NotImplementedError
+
+    @abstractmethod
+    def get_archive(self):
+        raise NotImplementedError
+
+    @abstractmethod
+    def get_workers(self):
+        """
+        :return: dict with the last heartbeat of every worker, by worker key
+        """
+        raise NotImplementedError
+
+
+class WorkerTransport(ABC):
+    """
+    Worker side of the communication between master and workers: fetches tasks and sends back results
+    """
+
+    @abstractmethod
+    def get_experiment(self):
+        raise NotImplementedError
+
+    @abstractmethod
+    def get_archive(self):
+        raise NotImplementedError
+
+    @abstractmethod
+    def get_current_task(self):
+        """
+        :return: (task_id, task_data) of the task the master declared last
+        """
+        raise NotImplementedError
+
+    @abstractmethod
+    def push_result(self, task_id, result):
+        raise NotImplementedError
+
+    @abstractmethod
+    def claim_evolve_token(self, task_id):
+        """
+        :return: True if an evolve job of the task was claimed, False if none are left
+        """
+        raise NotImplementedError
+
+    @abstractmethod
+    def claim_eval_token(self, task_id):
+        """
+        :return: the index of the candidate to evaluate, or None if no eval jobs of the task are left
+        """
+        raise NotImplementedError
+
+    @abstractmethod
+    def release_evolve_token(self, task_id):
+        raise NotImplementedError
+
+    @abstractmethod
+    def release_eval_token(self, task_id, index):
+        raise NotImplementedError
+
+    @abstractmethod
+    def heartbeat(self, key, heartbeat):
+        """
+        Replace the last heartbeat of this worker
+        :param key: unique key of the worker, host:pid
+        """
+        raise NotImplementedError
+
+
+class MasterClient(MasterTransport):
     def __init__(self, master_redis_cfg):
         self.task_counter = 0
+        self.stale_results = 0
+        self.max_staleness = 0
         self.master_redis = retry_connect(master_redis_cfg)
         logger.info('[master] Connected to Redis: {}'.format(self.master_redis))
 
     def declare_experiment(self, exp):
-        self.master_redis.set(EXP_KEY, serialize(exp))
+        # heartbeats of workers of a previous experiment
+        (self.master_redis.pipeline()
+         .set(EXP_KEY, serialize(exp))
+         .delete(WORKERS_KEY)
+         .execute())
         logger.info('[master] Declared experiment {}'.format(pformat(exp)))
 
-    def declare_task(self, task_data):
+    def declare_task(self, task_data, tokens=None):
         task_id = self.task_counter
         self.task_counter += 1
 
         serialized_task_data = serialize(task_data)
-        (self.master_redis.pipeline()
-         .mset({TASK_ID_KEY: task_id, TASK_DATA_KEY: serialized_task_data})
-         .publish(TASK_CHANNEL, serialize((task_id, serialized_task_data)))
+        pipe = self.master_redis.pipeline()
+        if tokens is not None:
+            self._issue_tokens(pipe, task_id, *tokens)
+        oldest_task_id = max(task_id - self.max_staleness, 0)
+        (pipe
+         .mset({TASK_ID_KEY: task_id, TASK_DATA_KEY: serialized_task_data, OLDEST_TASK_ID_KEY: oldest_task_id})
+         .publish(TASK_CHANNEL, serialize((task_id, serialized_task_data, oldest_task_id)))
          .execute())
         logger.debug('[master] Declared task {}'.format(task_id))
         return task_id
 
     def pop_result(self):
-        task_id, result = deserialize(self.master_redis.blpop(RESULTS_KEY)[1])
+        task_id, result = deserialize_result(self.master_redis.blpop(RESULTS_KEY)[1])
         logger.debug('[master] Popped a result for task {}'.format(task_id))
         return task_id, result
 
+    def pop_results(self, max_n, timeout=0):
+        """
+        Pop and deserialize up to max_n results in one go, stale results are dropped without deserializing them
+        :param timeout: seconds to wait for a first result, 0 means wait forever
+        :return: list of (task_id, result), empty if timed out or all results were stale
+        """
+        popped = pop_batch(self.master_redis, RESULTS_KEY, max_n, timeout)
+        oldest_task_id = self.task_counter - 1 - self.max_staleness
+        results = [deserialize_result(r) for r in popped if result_task_id(r) >= oldest_task_id]
+        self.stale_results += len(popped) - len(results)
+        logger.debug('[master] Popped {} results'.format(len(results)))
+        return results
+
+    def set_max_staleness(self, max_staleness):
+        self.max_staleness = max_staleness
+
+    def pop_stale_count(self):
+        # results dropped here, and results dropped by the relays before they reached the master
+        relay_stale_results = int(self.master_redis.getset(STALE_RESULTS_KEY, 0) or 0)
+        stale_results, self.stale_results = self.stale_results + relay_stale_results, 0
+        return stale_results
+
+    def issue_tokens(self, task_id, nb_evolve, eval_indices):
+        self._issue_tokens(self.master_redis.pipeline(), task_id, nb_evolve, eval_indices).execute()
+
+    @staticmethod
+    def _issue_tokens(pipe, task_id, nb_evolve, eval_indices):
+        evolve_key, eval_key = EVOLVE_TOKENS_KEY.format(task_id), EVAL_TOKENS_KEY.format(task_id)
+        pipe.set(evolve_key, nb_evolve, ex=TOKENS_TTL).delete(eval_key)
+        if eval_indices:
+            pipe.rpush(eval_key, *eval_indices).expire(eval_key, TOKENS_TTL)
+        logger.debug('[master] Issued {} evolve and {} eval tokens for task {}'
+                     .format(nb_evolve, len(eval_indices), task_id))
+        return pipe
+
     def flush_results(self):
         return max(self.master_redis.pipeline().llen(RESULTS_KEY).ltrim(RESULTS_KEY, -1, -1).execute()[0] - 1, 0)
 
@@ -103,6 +420,10 @@ class MasterClient:
         archive = self.master_redis.lrange(ARCHIVE_KEY, 0, -1)
         return [deserialize(novelty_vector) for novelty_vector in archive]
 
+    def get_workers(self):
+        return {key.decode(): deserialize(heartbeat)
+                for key, heartbeat in self.master_redis.hgetall(WORKERS_KEY).items()}
+
 
 class RelayClient:
     """
@@ -110,39 +431,104 @@ class RelayClient:
     Batches and pushes results from workers to the master
     """
 
-    def __init__(self, master_redis_cfg, relay_redis_cfg):
+    def __init__(self, master_redis_cfg, relay_redis_cfg, max_batch_size=256, max_latency=0.002):
+        """
+        :param max_batch_size:  max nb of results forwarded to the master in one push
+        :param max_latency:     max nb of seconds the first result of a batch waits for more results
+        """
         self.master_redis = retry_connect(master_redis_cfg)
         logger.info('[relay] Connected to master: {}'.format(self.master_redis))
         self.local_redis = retry_connect(relay_redis_cfg)
         logger.info('[relay] Connected to relay: {}'.format(self.local_redis))
+        self.max_batch_size = max_batch_size
+        self.max_latency = max_latency
+
         self.results_published = 0
+        self.batches_forwarded = 0
+        self.bytes_forwarded = 0
+        self.stale_results = 0
+        self.task_id, self.oldest_task_id = None, None
 
     def run(self):
         # Initialization: read exp and latest task from master
         self.local_redis.set(EXP_KEY, retry_get(self.master_redis, EXP_KEY))
-        self._declare_task_local(*retry_get(self.master_redis, (TASK_ID_KEY, TASK_DATA_KEY)))
+        self._declare_task_local(*retry_get(self.master_redis, (TASK_ID_KEY, TASK_DATA_KEY, OLDEST_TASK_ID_KEY)))
 
-        # Start subscribing to tasks
-        p = self.master_redis.pubsub(ignore_subscribe_messages=True)
-        p.subscribe(**{TASK_CHANNEL: lambda msg: self._declare_task_local(*deserialize(msg['data']))})
-        p.run_in_thread(sleep_time=0.001)
+        # Start subscribing to tasks, the thread blocks on the subscription socket until a task comes in
+        threading.Thread(target=self._listen, daemon=True).start()
 
         # Loop on RESULTS_KEY and push to master
-        batch_sizes, last_print_time = deque(maxlen=20), time.time()  # for logging
+        batch_sizes, latencies = deque(maxlen=100), deque(maxlen=100)  # for logging
+        last_print_time, last_print_bytes = time.time(), 0
         while True:
-            results = []
-            start_time = curr_time = time.time()
-            while curr_time - start_time < 0.001:
-                results.append(self.local_redis.blpop(RESULTS_KEY)[1])
-                curr_time = time.time()
+            results, first_time = self._pop_batch()
+
+            # drop results of old tasks, the master would throw them away anyway
+            oldest_task_id = self.oldest_task_id
+            nb_popped = len(results)
+            results = [r for r in results if result_task_id(r) >= oldest_task_id]
+            nb_stale = nb_popped - len(results)
+
+            pipe = self.master_redis.pipeline()
+            if results:
+                pipe.rpush(RESULTS_KEY, *results)
+            if nb_stale:
+                pipe.incrby(STALE_RESULTS_KEY, nb_stale)
+            pipe.execute()
+            curr_time = time.time()
+            self.stale_results += nb_stale
+
             self.results_published += len(results)
-            self.master_redis.rpush(RESULTS_KEY, *results)
-            # Log
+            self.batches_forwarded += 1
+            self.bytes_forwarded += sum(len(r) for r in results)
             batch_sizes.append(len(results))
+            latencies.append(curr_time - first_time)
+
+            # Log
             if curr_time - last_print_time > 5.0:
-                logger.info('[relay] Average batch size {:.3f} ({} total)'.format(sum(batch_sizes) / len(batch_sizes),
-                                                                                  self.results_published))
-                last_print_time = curr_time
+                logger.info('[relay] Average batch size {:.3f}, forward latency {:.2f}ms, {:.2f}MB/s '
+                            '({} results, {} batches, {} stale results dropped total)'
+                            .format(sum(batch_sizes) / len(batch_sizes), 1000 * sum(latencies) / len(latencies),
+                                    (self.bytes_forwarded - last_print_bytes) / (curr_time - last_print_time) / 2**20,
+                                    self.results_published, self.batches_forwarded, self.stale_results))
+                last_print_time, last_print_bytes = curr_time, self.bytes_forwarded
+
+    def _pop_batch(self):
+        """
+        Wait for a first result, then keep collecting results until there are max_batch_size of them
+            or the first one has waited max_latency seconds
+        :return: the results, and the time the first one was popped
+        """
+        results = pop_batch(self.local_redis, RESULTS_KEY, self.max_batch_size)
+        first_time = time.time()
+        deadline = first_time + self.max_latency
+        while len(results) < self.max_batch_size and time.time() < deadline:
+            more = drain(self.local_redis, RESULTS_KEY, self.max_batch_size - len(results))
+            if more:
+                results += more
+            else:
+                time.sleep(min(0.0005, max(deadline - time.time(), 0)))
+        return results, first_time
+
+    def _listen(self):
+        # without the subscription workers only see new tasks every check_interval, so it is restored if it drops
+        while True:
+            pubsub = self.master_redis.pubsub(ignore_subscribe_messages=True)
+            try:
+                pubsub.subscribe(TASK_CHANNEL)
+                # tasks declared while not subscribed were missed
+                task = self.master_redis.mget((TASK_ID_KEY, TASK_DATA_KEY, OLDEST_TASK_ID_KEY))
+                if task[0] is not None and int(task[0]) != self.task_id:
+                    self._declare_task_local(*task)
+
+                for msg in pubsub.listen():
+                    if msg['type'] == 'message':
+                        self._declare_task_local(*deserialize(msg['data']))
+            except (redis.ConnectionError, redis.TimeoutError) as e:
+                logger.warning('[relay] Lost task subscription, resubscribing: {}'.format(e))
+                time.sleep(1.)
+            finally:
+                pubsub.close()
 
     def flush_results(self):
         number_flushed = max(self.local_redis.pipeline().llen(RESULTS_KEY).ltrim(RESULTS_KEY, -1, -1).execute()[0] - 1,
@@ -152,22 +538,40 @@ class RelayClient:
         logger.warning('[relay] Flushed {} results from worker redis and {} from master'
                        .format(number_flushed, number_flushed_master))
 
-    def _declare_task_local(self, task_id, task_data):
+    def _declare_task_local(self, task_id, task_data, oldest_task_id):
         logger.info('[relay] Received task {}'.format(task_id))
+        self.task_id, self.oldest_task_id = int(task_id), int(oldest_task_id)
         self.results_published = 0
-        self.local_redis.mset({TASK_ID_KEY: task_id, TASK_DATA_KEY: task_data})
-        self.flush_results()
+        (self.local_redis.pipeline()
+         .mset({TASK_ID_KEY: task_id, TASK_DATA_KEY: task_data})
+         .publish(LOCAL_TASK_CHANNEL, task_id)
+         .execute())
+        if self.oldest_task_id == int(task_id):
+            # results of previous tasks aren't accepted anymore
+            self.flush_results()
 
 
-class WorkerClient:
-    def __init__(self, relay_redis_cfg, master_redis_cfg):
+class WorkerClient(WorkerTransport):
+    def __init__(self, relay_redis_cfg, master_redis_cfg, check_interval=1.):
+        """
+        :param check_interval: seconds after which the task id is checked even without notification of a new task
+        """
         self.local_redis = retry_connect(relay_redis_cfg)
         logger.info('[worker] Connected to relay: {}'.format(self.local_redis))
         self.master_redis = retry_connect(master_redis_cfg)
         logger.warning('[worker] Connected to master: {}'.format(self.master_redis))
 
+        # new tasks are announced by the relay, so the cached task can be used without asking redis
+        self.task_notifications = self.local_redis.pubsub(ignore_subscribe_messages=True)
+        self.task_notifications.subscribe(LOCAL_TASK_CHANNEL)
+        self.check_interval = check_interval
+        self.last_check_time = 0.
+
         self.cached_task_id, self.cached_task_data = None, None
 
+        self._claim_evolve_token = self.master_redis.register_script(CLAIM_EVOLVE_TOKEN_SCRIPT)
+        self._release_evolve_token = self.master_redis.register_script(RELEASE_EVOLVE_TOKEN_SCRIPT)
+
     def get_experiment(self):
         # Grab experiment info
         exp = deserialize(retry_get(self.local_redis, EXP_KEY))
@@ -179,23 +583,41 @@ class WorkerClient:
         return [deserialize(novelty_vector) for novelty_vector in archive]
 
     def get_current_task(self):
-        with self.local_redis.pipeline() as pipe:
-            while True:
-                try:
-                    pipe.watch(TASK_ID_KEY)
-                    task_id = int(retry_get(pipe, TASK_ID_KEY))
-                    if task_id == self.cached_task_id:
-                        logger.debug('[worker] Returning cached task {}'.format(task_id))
-                        break
-                    pipe.multi()
-                    pipe.get(TASK_DATA_KEY)
-                    logger.info('[worker] Getting new task {}. Cached task was {}'.format(task_id, self.cached_task_id))
-                    self.cached_task_id, self.cached_task_data = task_id, deserialize(pipe.execute()[0])
-                    break
-                except redis.WatchError:
-                    continue
+        # reading pending notifications only polls the subscription socket, no round trip to redis
+        notified = False
+        while self.task_notifications.get_message() is not None:
+            notified = True
+        if not notified and self.cached_task_id is not None \
+                and time.time() - self.last_check_time < self.check_interval:
+            logger.debug('[worker] Returning cached task {}'.format(self.cached_task_id))
+            return self.cached_task_id, self.cached_task_data
+
+        self.last_check_time = time.time()
+        if int(retry_get(self.local_redis, TASK_ID_KEY)) != self.cached_task_id:
+            # MGET is atomic, so the id and data always belong to the same task
+            task_id, task_data = retry_get(self.local_redis, (TASK_ID_KEY, TASK_DATA_KEY))
+            logger.info('[worker] Getting new task {}. Cached task was {}'.format(int(task_id), self.cached_task_id))
+            self.cached_task_id, self.cached_task_data = int(task_id), deserialize(task_data)
         return self.cached_task_id, self.cached_task_data
 
     def push_result(self, task_id, result):
-        self.local_redis.rpush(RESULTS_KEY, serialize((task_id, result)))
+        self.local_redis.rpush(RESULTS_KEY, serialize_result(task_id, result))
         logger.debug('[worker] Pushed result for task {}'.format(task_id))
+
+    # tokens are kept in the master redis, since they are shared by the workers of all nodes
+    def claim_evolve_token(self, task_id):
+        return self._claim_evolve_token(keys=[EVOLVE_TOKENS_KEY.format(task_id)]) == 1
+
+    def claim_eval_token(self, task_id):
+        index = self.master_redis.lpop(EVAL_TOKENS_KEY.format(task_id))
+        return int(index) if index is not None else None
+
+    def release_evolve_token(self, task_id):
+        self._release_evolve_token(keys=[EVOLVE_TOKENS_KEY.format(task_id)])
+
+    def release_eval_token(self, task_id, index):
+        self.master_redis.rpush(EVAL_TOKENS_KEY.format(task_id), index)
+
+    def heartbeat(self, key, heartbeat):
+        # straight to the master, heartbeats are small and infrequent
+        self.master_redis.hset(WORKERS_KEY, key, serialize(heartbeat))
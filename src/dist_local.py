@@ -0,0 +1,225 @@
+"""
+    Single-node alternative to the Redis communication in dist.py, for running master and workers
+    on one machine without a redis-server: tasks are written to a file in shared memory (/dev/shm)
+    and results are sent over a multiprocessing queue.
+"""
+
+import logging
+import multiprocessing
+import os
+import queue
+import shutil
+import tempfile
+import time
+
+from dist import MasterTransport, WorkerTransport, serialize, deserialize, serialize_result, deserialize_result, \
+    result_task_id
+
+logger = logging.getLogger(__name__)
+
+MAX_EVAL_TOKENS = 1024
+
+
+class LocalTransport(object):
+    """
+    State shared by the master and the workers on this node. Create it before the workers are started
+        and pass it to them, then create one LocalMasterClient and one LocalWorkerClient per worker.
+    """
+
+    def __init__(self, directory=None):
+        if directory is None:
+            # /dev/shm keeps the files in RAM
+            directory = '/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir()
+        self.directory = tempfile.mkdtemp(prefix='nic_local_', dir=directory)
+
+        # id of the last declared task, -1 while there is none
+        self.task_id = multiprocessing.Value('q', -1)
+        self.archive_size = multiprocessing.Value('i', 0)
+        self.results = multiprocessing.Queue()
+
+        # work tokens, only for the task with id token_task_id
+        self.tokens_lock = multiprocessing.Lock()
+        self.token_task_id = multiprocessing.Value('q', -1, lock=False)
+        self.evolve_tokens = multiprocessing.Value('q', 0, lock=False)
+        self.eval_tokens = multiprocessing.Array('q', MAX_EVAL_TOKENS, lock=False)
+        self.nb_eval_tokens = multiprocessing.Value('i', 0, lock=False)
+
+    def exp_path(self):
+        return os.path.join(self.directory, 'exp')
+
+    def task_path(self):
+        return os.path.join(self.directory, 'task')
+
+    def archive_path(self, i):
+        return os.path.join(self.directory, 'archive_{}'.format(i))
+
+    def heartbeat_path(self, key):
+        return os.path.join(self.directory, 'worker_{}'.format(key))
+
+    def cleanup(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+
+def _write_atomic(path, data):
+    # readers either see the old or the new file, never a partially written one
+    tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+    with open(tmp_path, 'wb') as f:
+        f.write(data)
+    os.rename(tmp_path, path)
+
+
+def _read(path):
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+class LocalMasterClient(MasterTransport):
+    def __init__(self, transport: LocalTransport):
+        self.task_counter = 0
+        self.stale_results = 0
+        self.max_staleness = 0
+        self.transport = transport
+        logger.info('[master] Using local transport in {}'.format(transport.directory))
+
+    def declare_experiment(self, exp):
+        _write_atomic(self.transport.exp_path(), serialize(exp))
+        logger.info('[master] Declared experiment')
+
+    def declare_task(self, task_data, tokens=None):
+        task_id = self.task_counter
+        self.task_counter += 1
+
+        if tokens is not None:
+            self.issue_tokens(task_id, *tokens)
+        # the id is stored with the data, so workers never combine an id with the data of another task
+        _write_atomic(self.transport.task_path(), serialize((task_id, serialize(task_data))))
+        self.transport.task_id.value = task_id
+        logger.debug('[master] Declared task {}'.format(task_id))
+        return task_id
+
+    def pop_result(self):
+        task_id, result = deserialize_result(self.transport.results.get())
+        logger.debug('[master] Popped a result for task {}'.format(task_id))
+        return task_id, result
+
+    def pop_results(self, max_n, timeout=0):
+        try:
+            results = [self.transport.results.get(timeout=timeout or None)]
+        except queue.Empty:
+            return []
+        while len(results) < max_n:
+            try:
+                results.append(self.transport.results.get_nowait())
+            except queue.Empty:
+                break
+        oldest_task_id = self.task_counter - 1 - self.max_staleness
+        current = [deserialize_result(r) for r in results if result_task_id(r) >= oldest_task_id]
+        self.stale_results += len(results) - len(current)
+        logger.debug('[master] Popped {} results'.format(len(current)))
+        return current
+
+    def set_max_staleness(self, max_staleness):
+        self.max_staleness = max_staleness
+
+    def pop_stale_count(self):
+        stale_results, self.stale_results = self.stale_results, 0
+        return stale_results
+
+    def issue_tokens(self, task_id, nb_evolve, eval_indices):
+        assert len(eval_indices) <= MAX_EVAL_TOKENS
+        t = self.transport
+        with t.tokens_lock:
+            t.token_task_id.value = task_id
+            t.evolve_tokens.value = nb_evolve
+            t.eval_tokens[:len(eval_indices)] = list(eval_indices)
+            t.nb_eval_tokens.value = len(eval_indices)
+        logger.debug('[master] Issued {} evolve and {} eval tokens for task {}'
+                     .format(nb_evolve, len(eval_indices), task_id))
+
+    def flush_results(self):
+        number_flushed = 0
+        while True:
+            try:
+                self.transport.results.get_nowait()
+                number_flushed += 1
+            except queue.Empty:
+                return number_flushed
+
+    def add_to_novelty_archive(self, novelty_vector):
+        with self.transport.archive_size.get_lock():
+            _write_atomic(self.transport.archive_path(self.transport.archive_size.value), serialize(novelty_vector))
+            self.transport.archive_size.value += 1
+        logger.info('[master] Added novelty vector to archive')
+
+    def get_archive(self):
+        return [deserialize(_read(self.transport.archive_path(i)))
+                for i in range(self.transport.archive_size.value)]
+
+    def get_workers(self):
+        prefix = 'worker_'
+        return {file[len(prefix):]: deserialize(_read(os.path.join(self.transport.directory, file)))
+                for file in os.listdir(self.transport.directory) if file.startswith(prefix) and not file.endswith('.tmp')}
+
+
+class LocalWorkerClient(WorkerTransport):
+    def __init__(self, transport: LocalTransport):
+        self.transport = transport
+        self.cached_task_id, self.cached_task_data = None, None
+
+    def get_experiment(self, tries=300, delay=1.):
+        for i in range(tries):
+            if os.path.exists(self.transport.exp_path()):
+                exp = deserialize(_read(self.transport.exp_path()))
+                logger.info('[worker] Experiment: {}'.format(exp))
+                return exp
+            time.sleep(delay)
+        raise RuntimeError('Experiment not declared')
+
+    def get_archive(self):
+        return [deserialize(_read(self.transport.archive_path(i)))
+                for i in range(self.transport.archive_size.value)]
+
+    def get_current_task(self):
+        while self.transport.task_id.value < 0:
+            time.sleep(0.1)
+        if self.transport.task_id.value != self.cached_task_id:
+            task_id, task_data = deserialize(_read(self.transport.task_path()))
+            logger.info('[worker] Getting new task {}. Cached task was {}'.format(task_id, self.cached_task_id))
+            self.cached_task_id, self.cached_task_data = task_id, deserialize(task_data)
+        return self.cached_task_id, self.cached_task_data
+
+    def push_result(self, task_id, result):
+        self.transport.results.put(serialize_result(task_id, result))
+        logger.debug('[worker] Pushed result for task {}'.format(task_id))
+
+    def claim_evolve_token(self, task_id):
+        t = self.transport
+        with t.tokens_lock:
+            if t.token_task_id.value != task_id or t.evolve_tokens.value <= 0:
+                return False
+            t.evolve_tokens.value -= 1
+            return True
+
+    def claim_eval_token(self, task_id):
+        t = self.transport
+        with t.tokens_lock:
+            if t.token_task_id.value != task_id or t.nb_eval_tokens.value <= 0:
+                return None
+            t.nb_eval_tokens.value -= 1
+            return t.eval_tokens[t.nb_eval_tokens.value]
+
+    def release_evolve_token(self, task_id):
+        t = self.transport
+        with t.tokens_lock:
+            if t.token_task_id.value == task_id:
+                t.evolve_tokens.value += 1
+
+    def release_eval_token(self, task_id, index):
+        t = self.transport
+        with t.tokens_lock:
+            if t.token_task_id.value == task_id and t.nb_eval_tokens.value < MAX_EVAL_TOKENS:
+                t.eval_tokens[t.nb_eval_tokens.value] = index
+                t.nb_eval_tokens.value += 1
+
+    def heartbeat(self, key, heartbeat):
+        _write_atomic(self.transport.heartbeat_path(key), serialize(heartbeat))
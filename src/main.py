@@ -23,7 +23,7 @@ from dist import RelayClient
 
 def run():
     parser = argparse.ArgumentParser()
-    parser.add_argument('who', type=str, choices=['master', 'workers'])
+    parser.add_argument('who', type=str, choices=['master', 'workers', 'local'])
 
     # MASTER
     parser.add_argument('--algo', type=str, default='nic_es', help='')
@@ -35,8 +35,15 @@ def run():
     parser.add_argument('--master_host', type=str, default='localhost', help='')
     parser.add_argument('--master_port', type=int, default=6379, help='')
     parser.add_argument('--relay_socket_path', type=str, default='/tmp/es_redis_relay_6379.sock', help='')
+    parser.add_argument('--relay_max_batch_size', type=int, default=256,
+                        help='max nb of results the relay forwards to the master in one push')
+    parser.add_argument('--relay_max_latency', type=float, default=0.002,
+                        help='max nb of seconds a result waits in the relay for more results to batch with')
     parser.add_argument('--num_workers', type=int, help='')
 
+    # LOCAL: master and workers on this machine, without redis
+    # (uses --algo, --exp_file, --plot and --num_workers)
+
     args = parser.parse_args()
 
     logging.basicConfig(
@@ -47,10 +54,13 @@ def run():
     if args.who == 'master':
         master(args.algo, args.exp_file, args.master_socket_path, args.plot)
     elif args.who == 'workers':
-        workers(args.algo, args.master_host, args.master_port, args.relay_socket_path, args.num_workers)
+        workers(args.algo, args.master_host, args.master_port, args.relay_socket_path, args.num_workers,
+                args.relay_max_batch_size, args.relay_max_latency)
+    elif args.who == 'local':
+        local(args.algo, args.exp_file, args.plot, args.num_workers)
 
 
-def master(algo, exp_file, master_socket_path, plot):
+def master(algo, exp_file, master_socket_path, plot, master_client=None):
     # start the master
 
     if exp_file:
@@ -62,17 +72,18 @@ def master(algo, exp_file, master_socket_path, plot):
     if algo == 'nic_es':
         from algorithm.nic_es.nic_es_master import ESMaster
         logging.info('RUNNING NIC-ES')
-        master_alg = ESMaster(exp, {'unix_socket_path': master_socket_path})
+        master_alg = ESMaster(exp, {'unix_socket_path': master_socket_path}, master_client=master_client)
     else:
         # algo == 'nic_nes':
         logging.info('RUNNING NIC-NES')
         from algorithm.nic_nes.nic_nes_master import NESMaster
-        master_alg = NESMaster(exp, {'unix_socket_path': master_socket_path})
+        master_alg = NESMaster(exp, {'unix_socket_path': master_socket_path}, master_client=master_client)
 
     master_alg.run_master(plot=plot)
 
 
-def workers(algo, master_host, master_port, relay_socket_path, num_workers):
+def workers(algo, master_host, master_port, relay_socket_path, num_workers, relay_max_batch_size=256,
+            relay_max_latency=0.002):
 
     # start the relay process
     master_redis_cfg = {'host': master_host, 'port': master_port}
@@ -80,7 +91,7 @@ def workers(algo, master_host, master_port, relay_socket_path, num_workers):
 
     relay_pid = os.fork()
     if relay_pid == 0:
-        RelayClient(master_redis_cfg, relay_redis_cfg).run()
+        RelayClient(master_redis_cfg, relay_redis_cfg, relay_max_batch_size, relay_max_latency).run()
         return
 
     if algo == 'nic_es':
@@ -141,12 +152,35 @@ def workers(algo, master_host, master_port, relay_socket_path, num_workers):
             os.kill(relay_pid, signal.SIGKILL)
 
 
-def spawn_workers(num_workers, run_func, master_redis_cfg, relay_redis_cfg):
+def local(algo, exp_file, plot, num_workers):
+    # start master and workers on this machine, communicating through shared memory instead of redis
+    from dist_local import LocalTransport, LocalMasterClient
+
+    if algo == 'nic_es':
+        from algorithm.nic_es.nic_es_worker import start_and_run_worker
+        run_func = start_and_run_worker
+    else:
+        # algo == 'nic_nes':
+        from algorithm.nic_nes.nic_nes_worker import start_and_run_worker
+        run_func = start_and_run_worker
+
+    transport = LocalTransport()
+    num_workers = num_workers if num_workers else os.cpu_count() - 2
+    # workers wait until the master has declared the experiment and a first task
+    processes = spawn_workers(num_workers, run_func, None, None, transport)
+    try:
+        master(algo, exp_file, None, plot, master_client=LocalMasterClient(transport))
+    finally:
+        [p.kill() for p in processes]
+        transport.cleanup()
+
+
+def spawn_workers(num_workers, run_func, master_redis_cfg, relay_redis_cfg, local_transport=None):
     logging.info('Spawning {} workers'.format(num_workers))
     procs = []
     for _id in range(num_workers):
 
-        p = mp.Process(target=run_func, args=(0, master_redis_cfg, relay_redis_cfg))
+        p = mp.Process(target=run_func, args=(0, master_redis_cfg, relay_redis_cfg, local_transport))
         p.start()
         procs += [p]
 
@@ -0,0 +1,100 @@
+"""
+    Run from src/ with: python -m unittest discover -s tests
+"""
+import unittest
+
+import torch
+
+from algorithm.policies import ModelOptions
+from captioning.nets import FCModel
+
+
+def small_fc_model(seed, eos_bias=None):
+    torch.manual_seed(seed)
+    options = ModelOptions(vocab_size=50, input_encoding_size=16, rnn_type='lstm', rnn_size=16, num_layers=1,
+                           seq_length=16, fc_feat_size=32)
+    model = FCModel(options=options)
+    with torch.no_grad():
+        # peaked word distributions, so greedy decoding has no near ties that rounding could break differently
+        model.logit.weight.mul_(15)
+        if eos_bias is not None:
+            # the higher the bias of the end token, the shorter the sequences
+            model.logit.bias[0] = eos_bias
+    return model
+
+
+def unfused_sample(model, fc_feats):
+    # with autograd enabled _sample doesn't take the fused path
+    with torch.enable_grad():
+        seq, seq_logprobs = model._sample(fc_feats)
+    return seq, seq_logprobs.detach()
+
+
+def fused_sample(model, fc_feats):
+    with torch.no_grad():
+        return model._sample(fc_feats)
+
+
+def used_positions(seq):
+    """
+    :return: mask of the positions the fitness criteria use, the words of a sequence up to and including its end
+    """
+    mask = seq > 0
+    return torch.cat([mask.new_ones(mask.size(0), 1), mask[:, :-1]], 1)
+
+
+class DecodingTestCase(unittest.TestCase):
+
+    def assert_same_decoding(self, model, fc_feats):
+        seq, seq_logprobs = unfused_sample(model, fc_feats)
+        fused_seq, fused_seq_logprobs = fused_sample(model, fc_feats)
+
+        self.assertTrue(torch.equal(seq, fused_seq))
+        used = used_positions(seq)
+        self.assertTrue(torch.allclose(seq_logprobs[used], fused_seq_logprobs[used], atol=1e-5))
+        return seq
+
+
+class FusedDecodingTest(DecodingTestCase):
+
+    def test_fused_matches_unfused(self):
+        for seed in range(3):
+            model = small_fc_model(seed)
+            fc_feats = torch.randn(32, 32) * 3
+            self.assert_same_decoding(model, fc_feats)
+
+    def test_buffers_reused_across_batch_sizes_and_params(self):
+        model = small_fc_model(0)
+        for batch_size in [8, 32, 8]:
+            self.assert_same_decoding(model, torch.randn(batch_size, 32) * 3)
+            # the fused weights are refreshed from the params every rollout
+            model.evolve(0.05)
+
+
+class RowCompactionTest(DecodingTestCase):
+    """
+    The fused decoding drops finished rows, the unfused one keeps decoding the full batch
+    """
+
+    def assert_compacted_like_full_batch(self, model, fc_feats):
+        seq = self.assert_same_decoding(model, fc_feats)
+        # positions after the end of a sequence are not decoded by the fused decoding
+        _, fused_seq_logprobs = fused_sample(model, fc_feats)
+        self.assertTrue(bool((fused_seq_logprobs[used_positions(seq) == 0] == 0).all()))
+        return (seq > 0).sum(1)
+
+    def test_mixed_lengths(self):
+        for seed in range(3):
+            lengths = self.assert_compacted_like_full_batch(small_fc_model(seed, eos_bias=1.),
+                                                            torch.randn(32, 32) * 3)
+            # rows finish at different steps, so the batch is compacted several times
+            self.assertGreater(len(set(lengths.tolist())), 2)
+
+    def test_all_rows_finish_before_seq_length(self):
+        model = small_fc_model(0, eos_bias=3.)
+        lengths = self.assert_compacted_like_full_batch(model, torch.randn(32, 32) * 3)
+        self.assertLess(int(lengths.max()), model.seq_length)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,107 @@
+"""
+    Run from src/ with: python -m unittest discover -s tests
+    The redis tests need fakeredis (with lupa for the lua scripts), they are skipped otherwise.
+"""
+import threading
+import time
+import unittest
+from unittest import mock
+
+import redis
+
+from dist import EVOLVE_TOKENS_KEY, TASK_ID_KEY, MasterClient, RelayClient, WorkerClient, WorkerTransport
+from dist_local import LocalTransport, LocalWorkerClient
+
+try:
+    import fakeredis
+    fakeredis.FakeStrictRedis().eval('return 1', 0)
+    FAKEREDIS = True
+except Exception:
+    FAKEREDIS = False
+
+
+@unittest.skipUnless(FAKEREDIS, 'needs fakeredis with lua support')
+class EvolveTokensTest(unittest.TestCase):
+
+    def setUp(self):
+        redis = fakeredis.FakeStrictRedis()
+        with mock.patch('dist.retry_connect', return_value=redis):
+            self.master = MasterClient({})
+            self.worker = WorkerClient({}, {})
+        self.redis = redis
+        self.key = EVOLVE_TOKENS_KEY.format(0)
+
+    def test_claims_exactly_the_issued_tokens(self):
+        self.master.issue_tokens(0, 3, [])
+        claims = [self.worker.claim_evolve_token(0) for _ in range(5)]
+        self.assertEqual(claims, [True, True, True, False, False])
+        self.assertEqual(int(self.redis.get(self.key)), 0)
+        self.assertGreater(self.redis.ttl(self.key), 0)
+
+    def test_released_token_is_claimed_again(self):
+        self.master.issue_tokens(0, 1, [])
+        self.assertTrue(self.worker.claim_evolve_token(0))
+        self.worker.release_evolve_token(0)
+        self.assertTrue(self.worker.claim_evolve_token(0))
+        self.assertFalse(self.worker.claim_evolve_token(0))
+
+    def test_expired_tokens_are_not_recreated(self):
+        self.assertFalse(self.worker.claim_evolve_token(0))
+        self.worker.release_evolve_token(0)
+        self.assertFalse(self.redis.exists(self.key))
+
+
+class DroppedPubSub(object):
+
+    def subscribe(self, channel):
+        pass
+
+    def listen(self):
+        raise redis.ConnectionError('connection dropped')
+
+    def close(self):
+        pass
+
+
+@unittest.skipUnless(FAKEREDIS, 'needs fakeredis with lua support')
+class RelayListenerTest(unittest.TestCase):
+
+    def test_resubscribes_after_a_dropped_connection(self):
+        master_redis, relay_redis = fakeredis.FakeStrictRedis(), fakeredis.FakeStrictRedis()
+        with mock.patch('dist.retry_connect', side_effect=[master_redis, master_redis, relay_redis]):
+            master = MasterClient({})
+            relay = RelayClient({}, {})
+        master.declare_task('task 0')
+
+        pubsubs = [DroppedPubSub(), master_redis.pubsub(ignore_subscribe_messages=True)]
+        with mock.patch.object(relay.master_redis, 'pubsub', side_effect=pubsubs):
+            threading.Thread(target=relay._listen, daemon=True).start()
+            # the task declared before the subscription is picked up, then the next one is received
+            self.assertTrue(self.wait_for_task(relay_redis, 0))
+            while pubsubs[1].connection is None:
+                time.sleep(.01)
+            master.declare_task('task 1')
+            self.assertTrue(self.wait_for_task(relay_redis, 1))
+
+    @staticmethod
+    def wait_for_task(relay_redis, task_id, timeout=5.):
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            if relay_redis.get(TASK_ID_KEY) == str(task_id).encode():
+                return True
+            time.sleep(.01)
+        return False
+
+
+class TransportInterfaceTest(unittest.TestCase):
+
+    def test_incomplete_transport_fails_on_construction(self):
+        class NoHeartbeatClient(LocalWorkerClient):
+            heartbeat = WorkerTransport.heartbeat
+
+        with self.assertRaises(TypeError):
+            NoHeartbeatClient(LocalTransport())
+
+
+if __name__ == '__main__':
+    unittest.main()
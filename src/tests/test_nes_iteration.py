@@ -0,0 +1,52 @@
+"""
+    Run from src/ with: python -m unittest discover -s tests
+"""
+import tempfile
+import unittest
+
+import numpy as np
+
+from algorithm.nic_nes.iteration import NESIteration
+from algorithm.nic_nes.nic_nes_master import NESResult
+from algorithm.tools.utils import Config
+
+
+class SamplesUsedTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.it = NESIteration(Config(batch_size=4, noise_stdev=.01),
+                               {'nb_offspring': 4, 'log_dir': self.directory.name, 'num_elites': 1})
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def record(self, staleness):
+        results = [NESResult(fitness=np.zeros(2), noise_index=0) for _ in staleness]
+        self.it.record_task_results(results, staleness)
+
+    def test_sync_counts_one_batch_per_iteration(self):
+        self.it.incr_iteration()
+        self.record([0, 0, 0, 0])
+        self.assertEqual(self.it.nb_samples_used(), 4)
+
+    def test_async_counts_one_batch_per_task_of_an_update(self):
+        self.it.set_max_staleness(2)
+        self.it.incr_iteration()
+        self.assertEqual(self.it.nb_samples_used(), 0)
+
+        # results of the current task and of the task before it
+        self.it.incr_update(2)
+        self.record([0, 1])
+        self.it.record_update_samples()
+        self.assertEqual(self.it.nb_samples_used(), 8)
+
+        # the results that weren't needed don't count
+        self.it.incr_update(2)
+        self.record([0, 0, 2])
+        self.it.record_update_samples()
+        self.assertEqual(self.it.nb_samples_used(), 12)
+
+
+if __name__ == '__main__':
+    unittest.main()
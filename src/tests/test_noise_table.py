@@ -0,0 +1,62 @@
+"""
+    Run from src/ with: python -m unittest discover -s tests
+"""
+import os
+import subprocess
+import sys
+import tempfile
+import time
+import unittest
+
+import numpy as np
+
+from algorithm.nic_nes.noise_table import SharedNoiseTable
+
+
+class StaleLockTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, 'nic_noise_table_s1_n1000.npy')
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def assert_built(self):
+        table = SharedNoiseTable(1000, seed=1, directory=self.directory.name, chunk_size=300)
+        self.assertTrue(np.array_equal(table.get(0, 1000), np.random.RandomState(1).randn(1000).astype(np.float32)))
+        self.assertEqual(os.listdir(self.directory.name), [os.path.basename(self.path)])
+
+    def test_lock_of_dead_builder_is_broken(self):
+        builder = subprocess.Popen([sys.executable, '-c', 'pass'])
+        builder.wait()
+        with open(self.path + '.lock', 'w') as f:
+            f.write(str(builder.pid))
+        open(self.path + '.{}.tmp'.format(builder.pid), 'w').close()
+        self.assert_built()
+
+    def test_lock_without_progress_is_broken(self):
+        open(self.path + '.lock', 'w').close()
+        old = time.time() - SharedNoiseTable.STALE_AFTER - 1
+        os.utime(self.path + '.lock', (old, old))
+        self.assert_built()
+
+    def test_slow_builder_keeps_the_lock_of_its_successor(self):
+        lock_path = self.path + '.lock'
+
+        class SlowTable(SharedNoiseTable):
+            @staticmethod
+            def _touch(lock_path, token):
+                # a waiter broke the lock of this slow build and took its own
+                os.remove(lock_path)
+                with open(lock_path, 'w') as f:
+                    f.write('999999')
+
+        table = SlowTable(1000, seed=1, directory=self.directory.name, chunk_size=300)
+        self.assertEqual(table.size(), 1000)
+        with open(lock_path) as f:
+            self.assertEqual(f.read(), '999999')
+
+
+if __name__ == '__main__':
+    unittest.main()
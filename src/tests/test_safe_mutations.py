@@ -0,0 +1,109 @@
+"""
+    Run from src/ with: python -m unittest discover -s tests
+"""
+import unittest
+
+import torch
+
+from algorithm.nets import Mutation
+from algorithm.policies import ModelOptions
+from algorithm.safe_mutations import BATCHED_GRADS, Sensitivity
+from classification.nets import MnistNet
+
+
+def mnist_sensitivity(mutations, batched, vbn=False):
+    torch.manual_seed(0)
+    net = MnistNet(options=ModelOptions(safe_mutations=mutations.value, safe_mutation_underflow=0.01), vbn=vbn)
+    sensitivity = Sensitivity(net, 0.01, mutations)
+    sensitivity._batched_vjps = batched
+    sensitivity._orig_batch_size = 4
+
+    torch.set_grad_enabled(True)
+    for param in net.parameters():
+        param.requires_grad = True
+    try:
+        return sensitivity._calc_sensitivity((torch.randn(4, 1, 28, 28), None))
+    finally:
+        torch.set_grad_enabled(False)
+
+
+class VjpFallbackTest(unittest.TestCase):
+
+    @unittest.skipUnless(BATCHED_GRADS, 'batched backward passes need torch >= 1.11')
+    def test_one_at_a_time_matches_batched(self):
+        for mutations in [Mutation.SAFE_GRAD_SUM, Mutation.SAFE_GRAD_ABS]:
+            batched = mnist_sensitivity(mutations, batched=True)
+            one_at_a_time = mnist_sensitivity(mutations, batched=False)
+            self.assertTrue(torch.allclose(batched, one_at_a_time, rtol=1e-4, atol=1e-7))
+
+
+def abs_sensitivity_loop(vbn):
+    """
+    SM-G-ABS as originally computed: one forward pass per sample and one backward pass per output.
+    """
+    torch.manual_seed(0)
+    net = MnistNet(options=ModelOptions(safe_mutations=Mutation.SAFE_GRAD_ABS.value,
+                                        safe_mutation_underflow=0.01), vbn=vbn)
+    experiences = (torch.randn(4, 1, 28, 28), None)
+
+    with torch.enable_grad():
+        for param in net.parameters():
+            param.requires_grad = True
+        abs_sum = torch.zeros(10, net.nb_params)
+        for i in range(4):
+            output = net.forward_for_sensitivity(experiences, i=i)
+            for k in range(10):
+                grads = torch.autograd.grad(output[0, k], list(net.parameters()), retain_graph=True)
+                abs_sum[k] += torch.cat([g.reshape(-1) for g in grads]).abs()
+    return (abs_sum / 4).pow(2).sum(0).sqrt()
+
+
+class AbsSensitivityTest(unittest.TestCase):
+
+    def test_matches_loop(self):
+        for vbn in [False, True]:
+            batched = mnist_sensitivity(Mutation.SAFE_GRAD_ABS, batched=BATCHED_GRADS, vbn=vbn)
+            self.assertTrue(torch.allclose(batched, abs_sensitivity_loop(vbn), rtol=1e-4, atol=1e-7))
+
+
+class ReuseTest(unittest.TestCase):
+
+    def setUp(self):
+        torch.manual_seed(0)
+        self.net = MnistNet(options=ModelOptions(safe_mutations=Mutation.SAFE_GRAD_SUM.value,
+                                                 safe_mutation_underflow=0.01))
+        self.sensitivity = Sensitivity(self.net, 0.01, Mutation.SAFE_GRAD_SUM, reuse_every=3, reuse_drift=0.01,
+                                       reuse_capacity=2)
+        self.computed = []
+        self.sensitivity._compute_sensitivity = lambda experiences, batch_size: \
+            self.computed.append(1) or torch.full((self.net.nb_params,), float(len(self.computed)))
+
+    def move_params(self, relative_drift):
+        params = self.net.parameter_vector()
+        direction = torch.randn_like(params)
+        self.net.set_from_vector(params + relative_drift * params.norm() / direction.norm() * direction)
+
+    def test_reuses_close_params_within_reuse_every(self):
+        first = self.sensitivity._reuse_or_compute(0, None, 4)
+        self.move_params(0.001)
+        self.assertIs(self.sensitivity._reuse_or_compute(1, None, 4), first)
+        self.sensitivity._reuse_or_compute(3, None, 4)
+        self.assertEqual(len(self.computed), 2)
+
+    def test_recomputes_for_distant_params(self):
+        self.sensitivity._reuse_or_compute(0, None, 4)
+        self.move_params(0.1)
+        self.sensitivity._reuse_or_compute(1, None, 4)
+        self.assertEqual(len(self.computed), 2)
+
+    def test_keeps_capacity_fingerprints(self):
+        for task_id in range(4):
+            self.move_params(0.1)
+            self.sensitivity._reuse_or_compute(task_id, None, 4)
+        self.assertEqual(len(self.sensitivity._computed), 2)
+        fingerprint = self.sensitivity._computed[0][0]
+        self.assertEqual(fingerprint.numel(), min(Sensitivity.FINGERPRINT_SIZE, self.net.nb_params))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,112 @@
+"""
+    Run from src/ with: python -m unittest discover -s tests
+"""
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import unittest
+
+import torch
+
+from algorithm.tools.sensitivity_store import SensitivityStore
+from algorithm.tools.utils import read_lock, remove_lock_if_owned
+
+
+def write_lock(path, token, age=0.):
+    with open(path, 'w') as f:
+        f.write(token)
+    touched = time.time() - age
+    os.utime(path, (touched, touched))
+
+
+def dead_pid():
+    process = subprocess.Popen([sys.executable, '-c', 'pass'])
+    process.wait()
+    return process.pid
+
+
+class StaleLockTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.store = SensitivityStore(self.directory.name, poll_interval=.01, stale_after=.4)
+        self.lock_path = self.store.path(1, 0) + '.lock'
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def get_or_compute(self):
+        start_time = time.time()
+        sensitivity = self.store.get_or_compute(1, 0, lambda: torch.ones(3))
+        self.assertTrue(torch.equal(sensitivity, torch.ones(3)))
+        self.assertFalse(os.path.exists(self.lock_path))
+        return time.time() - start_time
+
+    def test_lock_of_dead_holder_is_broken_at_once(self):
+        write_lock(self.lock_path, '{}:{}:x'.format(socket.gethostname(), dead_pid()))
+        self.assertLess(self.get_or_compute(), .3)
+
+    def test_untouched_lock_is_broken(self):
+        write_lock(self.lock_path, 'other-host:1:x', age=1.)
+        self.assertLess(self.get_or_compute(), .3)
+
+    def test_touched_lock_is_kept(self):
+        write_lock(self.lock_path, 'other-host:1:x')
+        self.assertGreater(self.get_or_compute(), .3)
+
+    def test_empty_lock_is_broken_once_untouched(self):
+        write_lock(self.lock_path, '')
+        self.assertGreater(self.get_or_compute(), .3)
+
+    def test_live_holder_computing_longer_than_stale_after_is_waited_for(self):
+        computations = []
+
+        def compute():
+            computations.append(threading.current_thread().name)
+            time.sleep(1.)
+            return torch.ones(3)
+
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(self.store.get_or_compute(1, 0, compute)))
+                   for _ in range(3)]
+        for thread in threads:
+            thread.start()
+            time.sleep(.05)
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(len(computations), 1)
+        self.assertEqual(len(results), 3)
+        self.assertTrue(all(torch.equal(result, torch.ones(3)) for result in results))
+        self.assertFalse(os.path.exists(self.lock_path))
+
+
+class OwnedLockTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.lock_path = os.path.join(self.directory.name, 'x.lock')
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_other_lock_is_kept(self):
+        # e.g. a stale lock was broken and taken by another worker after it was judged stale
+        write_lock(self.lock_path, 'host:2:new')
+        self.assertFalse(remove_lock_if_owned(self.lock_path, 'host:1:old'))
+        self.assertEqual(read_lock(self.lock_path), 'host:2:new')
+        self.assertEqual(os.listdir(self.directory.name), ['x.lock'])
+
+    def test_own_lock_is_removed(self):
+        write_lock(self.lock_path, 'host:1:old')
+        self.assertTrue(remove_lock_if_owned(self.lock_path, 'host:1:old'))
+        self.assertFalse(remove_lock_if_owned(self.lock_path, 'host:1:old'))
+        self.assertEqual(os.listdir(self.directory.name), [])
+
+
+if __name__ == '__main__':
+    unittest.main()